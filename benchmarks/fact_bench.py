@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# - coding: utf-8 -
+
+# This file is part of Project Hamster.
+
+# Project Hamster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Project Hamster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
+
+"""per fact cost of building lib.Fact objects out of storage rows - through
+the parsing constructor as the client used to, and through Fact.from_row.
+also reports what the fact objects themselves take in memory (the field
+values are not counted as they are the same whatever the container)
+
+    python benchmarks/fact_bench.py --count 100000
+"""
+
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import time
+import datetime as dt
+import resource
+
+from hamster.lib import Fact, RedmineFact
+
+
+def rows(count):
+    """fields the way client.from_dbus_fact gets them"""
+    start = dt.datetime(2013, 5, 6, 9, 0)
+    res = []
+    for i in range(count):
+        fields = dict(start_time = start + dt.timedelta(hours = i),
+                      end_time = start + dt.timedelta(hours = i, minutes = 45),
+                      description = u"description of fact %d" % i if i % 2 else u"",
+                      activity_id = i % 200,
+                      category = u"category %d" % (i % 25),
+                      tags = [u"tag%d" % (i % 40)] if i % 3 else [],
+                      date = start.date(),
+                      delta = dt.timedelta(minutes = 45),
+                      id = i)
+        redmine = (i % 300, i % 8) if i % 10 < 3 else None
+        res.append((u"activity %d" % (i % 200), redmine, fields))
+    return res
+
+
+def parsed(activity, redmine, fields):
+    fields = dict(fields, tags = ", ".join(fields["tags"]))
+    if redmine:
+        return RedmineFact(activity, redmine[0], redmine[1], **fields)
+    return Fact(activity, **fields)
+
+
+def from_row(activity, redmine, fields):
+    if redmine:
+        return RedmineFact.from_row(activity, redmine[0], redmine[1], **fields)
+    return Fact.from_row(activity, **fields)
+
+
+def measure(build, facts, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for activity, redmine, fields in facts:
+            build(activity, redmine, fields)
+        elapsed = time.time() - start
+        best = min(best, elapsed) if best is not None else elapsed
+    return best
+
+
+def memory(facts):
+    """bytes taken by fact objects (and their __dict__ if they have one) and
+    growth of the process in the meantime"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    built = [from_row(activity, redmine, fields) for activity, redmine, fields in facts]
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+
+    size = 0
+    for fact in built:
+        size += sys.getsizeof(fact)
+        if hasattr(fact, "__dict__"):
+            size += sys.getsizeof(fact.__dict__)
+    return size, rss * 1024
+
+
+if __name__ == "__main__":
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option("--count", type = "int", default = 100000,
+                      help = "facts to build per run [default: %default]")
+    parser.add_option("--repeat", type = "int", default = 5,
+                      help = "runs, the best one is reported [default: %default]")
+    options, args = parser.parse_args()
+
+    facts = rows(options.count)
+
+    # memory first, before the timing runs have grown the heap
+    size, rss = memory(facts)
+    print "%d facts take %.1f MB in objects, process grew by %.1f MB" % (options.count, size / 1048576.0,
+                                                                       rss / 1048576.0)
+    for label, build in (("Fact()", parsed), ("Fact.from_row()", from_row)):
+        best = measure(build, facts, options.repeat)
+        print "%-16s %7.2f us per fact, %6.0f ms per %d" % (label, best / options.count * 1000000,
+                                                         best * 1000, options.count)
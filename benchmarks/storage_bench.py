@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# - coding: utf-8 -
+
+# This file is part of Project Hamster.
+
+# Project Hamster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Project Hamster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
+
+"""times db.Storage operations against synthetic databases.
+talks to the storage directly, so there is no need for d-bus or gtk.
+
+    python benchmarks/storage_bench.py --sizes 10000,100000 --output results.json
+    python benchmarks/storage_bench.py --baseline results.json
+
+results are written as json. when a baseline is given, operations that got
+slower than the tolerance allows are listed and the script exits with 1"""
+
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+# storage chats on stdout, keep that one clean for the results
+results_out, sys.stdout = sys.stdout, sys.stderr
+
+import json
+import shutil
+import tempfile
+import time
+import datetime as dt
+
+import synthetic
+from hamster import db
+
+
+def measure(func, repeat):
+    """returns timings in milliseconds and the result of the last call"""
+    timings, result = [], None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        timings.append((time.time() - start) * 1000)
+    return timings, result
+
+
+def summary(size, operation, timings, rows = None):
+    timings = sorted(timings)
+    return {
+        "size": size,
+        "operation": operation,
+        "runs": len(timings),
+        "min_ms": round(timings[0], 3),
+        "median_ms": round(timings[len(timings) // 2], 3),
+        "mean_ms": round(sum(timings) / len(timings), 3),
+        "rows": rows,
+    }
+
+
+def bench_reads(storage, size, repeat):
+    results = []
+    today = dt.date.today()
+    first = storage.fetchone("SELECT min(start_time) FROM facts")[0]
+    first = dt.datetime.strptime(first[:10], "%Y-%m-%d").date() if first else today
+
+    ranges = [
+        ("day", today, today),
+        ("week", today - dt.timedelta(days = 6), today),
+        ("month", today - dt.timedelta(days = 30), today),
+        ("year", today - dt.timedelta(days = 364), today),
+        ("all", first, today),
+    ]
+    for label, start, end in ranges:
+        # all-time loads are expensive, don't wait for them forever
+        runs = repeat if label != "all" else max(1, repeat // 5)
+        timings, facts = measure(lambda: storage.get_facts(start, end, ""), runs)
+        results.append(summary(size, "get_facts.%s" % label, timings, len(facts)))
+
+    timings, count = measure(lambda: sum(1 for fact in storage.iter_facts(first, today, "")), max(1, repeat // 5))
+    results.append(summary(size, "iter_facts.all", timings, count))
+
+    for group_by in ("category", "tag", "day"):
+        timings, totals = measure(lambda: storage.get_totals(first, today, "", group_by), max(1, repeat // 5))
+        results.append(summary(size, "get_totals.all.%s" % group_by, timings, len(totals)))
+
+    timings, facts = measure(storage.get_todays_facts, repeat)
+    results.append(summary(size, "get_todays_facts", timings, len(facts)))
+
+    start = today - dt.timedelta(days = 30)
+    term = storage.fetchone("SELECT name FROM tags ORDER BY id LIMIT 1")["name"]
+    timings, facts = measure(lambda: storage.get_facts(start, today, term), repeat)
+    results.append(summary(size, "search.month", timings, len(facts)))
+
+    for prefix in ("", "l", "lo", "lorem"):
+        timings, activities = measure(lambda: storage.get_activities(prefix), repeat)
+        results.append(summary(size, "get_activities.%r" % prefix, timings, len(activities)))
+
+    return results
+
+
+def bench_writes(storage, size, repeat):
+    """mutating operations, run against a throwaway copy"""
+    results = []
+    today = dt.date.today()
+
+    # renaming a busy category reindexes every fact filed under it
+    category = storage.fetchone("""SELECT a.category_id AS id, count(*) AS facts
+                                     FROM facts f
+                                     JOIN activities a ON a.id = f.activity_id
+                                    WHERE a.category_id != -1
+                                 GROUP BY a.category_id
+                                 ORDER BY facts DESC LIMIT 1""")
+    names = ["renamed %d" % i for i in range(max(1, repeat // 2))]
+    timings, res = measure(lambda: storage.update_category(category["id"], names.pop()), len(names))
+    results.append(summary(size, "update_category.busiest", timings, category["facts"]))
+
+    # past facts landing in the middle of a tracked day, so that they have to
+    # split and shift the ones around them
+    day = today - dt.timedelta(days = 10)
+    def add_overlapping():
+        day_start = dt.datetime.combine(day, dt.time(10))
+        return storage.add_fact("benchmark@bench, overlapping #bench",
+                                day_start, day_start + dt.timedelta(minutes = 90))
+    timings, fact_id = measure(add_overlapping, repeat)
+    results.append(summary(size, "add_fact.overlap", timings))
+
+    def add_ongoing():
+        return storage.add_fact("benchmark ongoing@bench", dt.datetime.now(), None)
+    timings, fact_id = measure(add_ongoing, repeat)
+    results.append(summary(size, "add_fact.ongoing", timings))
+
+    return results
+
+
+def run(sizes, cache_dir, repeat):
+    results = []
+    for size in sizes:
+        database_dir = synthetic.build(cache_dir, size)
+
+        storage = db.Storage(database_dir = database_dir)
+        results.extend(bench_reads(storage, size, repeat))
+        storage.connection.close()
+
+        scratch_dir = tempfile.mkdtemp()
+        try:
+            shutil.copy(os.path.join(database_dir, "hamster.db"), scratch_dir)
+            storage = db.Storage(database_dir = scratch_dir)
+            results.extend(bench_writes(storage, size, repeat))
+            storage.connection.close()
+        finally:
+            shutil.rmtree(scratch_dir)
+
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """compares medians against the baseline run"""
+    previous = dict(((res["size"], res["operation"]), res) for res in baseline["results"])
+    slower = []
+    for res in results:
+        prev = previous.get((res["size"], res["operation"]))
+        if prev and res["median_ms"] > prev["median_ms"] * (1 + tolerance) and res["median_ms"] - prev["median_ms"] > 1:
+            slower.append((res, prev))
+    return slower
+
+
+if __name__ == "__main__":
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option("--sizes", default = "10000,100000,1000000",
+                      help = "comma separated fact counts [default: %default]")
+    parser.add_option("--repeat", type = "int", default = 10,
+                      help = "runs per operation [default: %default]")
+    parser.add_option("--cache-dir", default = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data"),
+                      help = "where to keep the generated databases")
+    parser.add_option("--output", help = "write json here instead of stdout")
+    parser.add_option("--baseline", help = "json of a previous run to compare against")
+    parser.add_option("--tolerance", type = "float", default = 0.25,
+                      help = "allowed slowdown against baseline [default: %default]")
+    options, args = parser.parse_args()
+
+    sizes = [int(size) for size in options.sizes.split(",")]
+    results = run(sizes, options.cache_dir, options.repeat)
+
+    report = {
+        "created": dt.datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "sqlite": db.sqlite.sqlite_version,
+        "results": results,
+    }
+
+    output = json.dumps(report, indent = 2, sort_keys = True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output)
+    else:
+        results_out.write(output + "\n")
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            slower = regressions(results, json.load(f), options.tolerance)
+        for res, prev in slower:
+            sys.stderr.write("%(size)d %(operation)s: " % res)
+            sys.stderr.write("%.1fms -> %.1fms\n" % (prev["median_ms"], res["median_ms"]))
+        if slower:
+            sys.exit(1)
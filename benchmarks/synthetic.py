@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# - coding: utf-8 -
+
+# This file is part of Project Hamster.
+
+# Project Hamster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Project Hamster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
+
+"""builds synthetic hamster.db files for the benchmarks.
+the databases are created through db.Storage so that they carry the current
+schema, and then filled in bulk with raw inserts as going through add_fact for
+a million facts would take all day"""
+
+import sys, os
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import random
+import datetime as dt
+
+from hamster import db
+
+WORDS = """lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod
+tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam quis
+nostrud exercitation ullamco laboris nisi aliquip ex ea commodo consequat duis
+aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur
+excepteur sint occaecat cupidatat non proident sunt culpa qui officia deserunt
+mollit anim id est laborum""".split()
+
+CATEGORY_COUNT = 25
+ACTIVITY_COUNT = 200
+TAG_COUNT = 40
+REDMINE_ISSUE_COUNT = 300
+REDMINE_ACTIVITY_COUNT = 8
+REDMINE_SHARE = 0.3 # portion of facts that are bound to a redmine issue
+FACTS_PER_DAY = 14
+
+
+def zipf_weights(count, exponent = 1.1):
+    """few things are used all the time, most of them rarely"""
+    weights = [1.0 / (rank ** exponent) for rank in range(1, count + 1)]
+    total = sum(weights)
+    return [weight / total for weight in weights]
+
+
+class WeightedChoice(object):
+    def __init__(self, items, weights):
+        self.items = items
+        self.cumulative = []
+        running = 0
+        for weight in weights:
+            running += weight
+            self.cumulative.append(running)
+
+    def pick(self, rnd):
+        point = rnd.random() * self.cumulative[-1]
+        lo, hi = 0, len(self.cumulative) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.cumulative[mid] < point:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.items[lo]
+
+
+def sentence(rnd, min_words, max_words):
+    return " ".join(rnd.choice(WORDS) for i in range(rnd.randint(min_words, max_words)))
+
+
+def database_path(cache_dir, size):
+    return os.path.join(cache_dir, str(size), "hamster.db")
+
+
+def build(cache_dir, size, seed = 1, rebuild = False):
+    """makes sure that there is a database with `size` facts in
+    cache_dir/size/hamster.db and returns the directory it lives in.
+    the last fact ends today and is left open"""
+    database_dir = os.path.dirname(database_path(cache_dir, size))
+    if os.path.exists(database_path(cache_dir, size)):
+        if not rebuild:
+            return database_dir
+        os.remove(database_path(cache_dir, size))
+
+    storage = db.Storage(database_dir = database_dir)
+    con = storage.connection
+    rnd = random.Random(seed)
+
+    categories = [(i, "%s %d" % (sentence(rnd, 1, 2).title(), i)) for i in range(1, CATEGORY_COUNT + 1)]
+    con.executemany("INSERT INTO categories (id, name, search_name) VALUES (?, ?, ?)",
+                    [(id, name, name.lower()) for id, name in categories])
+
+    activities = []
+    for i in range(1, ACTIVITY_COUNT + 1):
+        name = "%s %d" % (sentence(rnd, 1, 3), i)
+        category_id = rnd.choice(categories)[0] if rnd.random() > 0.1 else -1
+        activities.append((i, name, name.lower(), category_id))
+    con.executemany("INSERT INTO activities (id, name, search_name, category_id) VALUES (?, ?, ?, ?)",
+                    activities)
+
+    tags = [(i, "%s%d" % (rnd.choice(WORDS), i)) for i in range(1, TAG_COUNT + 1)]
+    con.executemany("INSERT INTO tags (id, name, autocomplete) VALUES (?, ?, 'true')", tags)
+
+    activity_choice = WeightedChoice([activity[0] for activity in activities], zipf_weights(ACTIVITY_COUNT))
+    tag_choice = WeightedChoice([tag[0] for tag in tags], zipf_weights(TAG_COUNT))
+    tag_count_choice = WeightedChoice([0, 1, 2, 3], [0.4, 0.35, 0.2, 0.05])
+    issue_choice = WeightedChoice(range(1, REDMINE_ISSUE_COUNT + 1), zipf_weights(REDMINE_ISSUE_COUNT, 0.8))
+
+    # lay out the days first so that the most recent facts end up today
+    day_counts = []
+    while sum(day_counts) < size:
+        day_counts.append(rnd.randint(FACTS_PER_DAY - 4, FACTS_PER_DAY + 4))
+    day = dt.date.today() - dt.timedelta(days = len(day_counts) - 1)
+
+    facts, fact_tags, redmine_facts = [], [], []
+    def flush():
+        con.executemany("INSERT INTO facts (id, activity_id, start_time, end_time, description) VALUES (?, ?, ?, ?, ?)", facts)
+        con.executemany("INSERT INTO fact_tags (fact_id, tag_id) VALUES (?, ?)", fact_tags)
+        con.executemany("INSERT INTO redmine_facts VALUES (?, ?, ?)", redmine_facts)
+        del facts[:], fact_tags[:], redmine_facts[:]
+
+    fact_id = 0
+    activity_id = activity_choice.pick(rnd)
+    for day_count in day_counts:
+        start_time = dt.datetime.combine(day, dt.time(8)) + dt.timedelta(minutes = rnd.randint(0, 120))
+        for i in range(day_count):
+            if fact_id >= size:
+                break
+            fact_id += 1
+
+            # people tend to come back to what they were doing
+            if rnd.random() > 0.3:
+                activity_id = activity_choice.pick(rnd)
+
+            end_time = start_time + dt.timedelta(minutes = int(rnd.expovariate(1 / 40.0)) + 5)
+            if fact_id == size:
+                end_time = None
+
+            description = sentence(rnd, 2, 10) if rnd.random() > 0.5 else None
+            facts.append((fact_id, activity_id, start_time, end_time, description))
+
+            for tag_id in set(tag_choice.pick(rnd) for j in range(tag_count_choice.pick(rnd))):
+                fact_tags.append((fact_id, tag_id))
+
+            if rnd.random() < REDMINE_SHARE:
+                redmine_facts.append((fact_id, issue_choice.pick(rnd), rnd.randint(1, REDMINE_ACTIVITY_COUNT)))
+            else:
+                redmine_facts.append((fact_id, -1, -1))
+
+            start_time = (end_time or start_time) + dt.timedelta(minutes = rnd.randint(0, 15))
+
+        if len(facts) > 10000:
+            flush()
+
+        day += dt.timedelta(days = 1)
+
+    flush()
+    con.commit()
+    con.close()
+
+    return database_dir
+
+
+if __name__ == "__main__":
+    import optparse
+    parser = optparse.OptionParser(usage = "%prog [options] size [size ...]")
+    parser.add_option("--cache-dir", default = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data"),
+                      help = "where to keep the generated databases")
+    parser.add_option("--seed", type = "int", default = 1)
+    parser.add_option("--rebuild", action = "store_true", default = False)
+    options, args = parser.parse_args()
+
+    for size in args or ["10000"]:
+        print build(options.cache_dir, int(size), options.seed, options.rebuild)
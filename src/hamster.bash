@@ -18,7 +18,7 @@ _hamster()
     #
     #  The basic options we'll complete.
     #
-    opts="activities categories current export list search start stop "
+    opts="activities categories current export import list search start stop "
 
 
     #
@@ -26,7 +26,7 @@ _hamster()
     #
     case "${prev}" in
 
-    start|export)
+    start|export|import)
         _hamster_helper "assist" "$prev" "$cur"
         return 0
         ;;
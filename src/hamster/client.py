@@ -20,6 +20,7 @@
 # along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import logging
 import datetime as dt
 from calendar import timegm
 import dbus, dbus.mainloop.glib
@@ -31,32 +32,25 @@ from lib import trophies
 
 def from_dbus_fact(fact):
     """unpack the struct into a proper dict"""
+    fields = dict(start_time  = dt.datetime.utcfromtimestamp(fact[1]),
+                  end_time = dt.datetime.utcfromtimestamp(fact[2]) if fact[2] else None,
+                  description = fact[3],
+                  activity_id = fact[5],
+                  category = fact[6],
+                  tags = fact[7],
+                  date = dt.datetime.utcfromtimestamp(fact[8]).date(),
+                  delta = dt.timedelta(days = fact[9] // (24 * 60 * 60),
+                                       seconds = fact[9] % (24 * 60 * 60)),
+                  id = fact[0])
+
+    # the fields are there already, no need to parse
     if fact[10] == -1 or fact[11] == -1:
-        return Fact(fact[4],
-                    start_time  = dt.datetime.utcfromtimestamp(fact[1]),
-                    end_time = dt.datetime.utcfromtimestamp(fact[2]) if fact[2] else None,
-                    description = fact[3],
-                    activity_id = fact[5],
-                    category = fact[6],
-                    tags = fact[7],
-                    date = dt.datetime.utcfromtimestamp(fact[8]).date(),
-                    delta = dt.timedelta(days = fact[9] // (24 * 60 * 60),
-                                         seconds = fact[9] % (24 * 60 * 60)),
-                    id = fact[0]
-                    )
+        return Fact.from_row(fact[4], **fields)
     else:
-        return RedmineFact(fact[4],
-            start_time  = dt.datetime.utcfromtimestamp(fact[1]),
-            end_time = dt.datetime.utcfromtimestamp(fact[2]) if fact[2] else None,
-            description = fact[3],
-            activity_id = fact[5],
-            category = fact[6],
-            tags = fact[7],
-            date = dt.datetime.utcfromtimestamp(fact[8]).date(),
-            delta = dt.timedelta(days = fact[9] // (24 * 60 * 60),
-                                 seconds = fact[9] % (24 * 60 * 60)), redmine_issue_id = fact[10], redmine_time_activity_id = fact[11],
-            id = fact[0]
-            )
+        return RedmineFact.from_row(fact[4],
+                                    redmine_issue_id = fact[10],
+                                    redmine_time_activity_id = fact[11],
+                                    **fields)
 
 class Storage(gobject.GObject):
     """Hamster client class, communicating to hamster storage daemon via d-bus.
@@ -70,11 +64,26 @@ class Storage(gobject.GObject):
        we use term 'activity'.
        The relationship is - one activity can be used in several facts.
        The rest is hopefully obvious. But if not, please file bug reports!
+
+       The `*-changed-detailed` signals come right before the plain ones
+       and tell what has changed: `facts-changed-detailed` passes the fact
+       ids and the first and last date they were or are in (None when
+       unknown - then anything could have changed),
+       `activities-changed-detailed` activity and category ids and
+       `tags-changed-detailed` the tag ids.
+
+       Facts are cached by range until a change signal touches the range,
+       so asking for the same range again is cheap.
     """
     __gsignals__ = {
         "tags-changed": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
         "facts-changed": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
         "activities-changed": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+        "tags-changed-detailed": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        "facts-changed-detailed": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                                   (gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT)),
+        "activities-changed-detailed": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                                        (gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT)),
         "toggle-called": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
     }
 
@@ -85,9 +94,15 @@ class Storage(gobject.GObject):
         self.bus = dbus.SessionBus()
         self._connection = None # will be initiated on demand
 
+        # facts by (start date, end date, search terms, day start)
+        self._facts_cache = {}
+
         self.bus.add_signal_receiver(self._on_tags_changed, 'TagsChanged', 'org.gnome.Hamster')
         self.bus.add_signal_receiver(self._on_facts_changed, 'FactsChanged', 'org.gnome.Hamster')
         self.bus.add_signal_receiver(self._on_activities_changed, 'ActivitiesChanged', 'org.gnome.Hamster')
+        self.bus.add_signal_receiver(self._on_tags_changed_detailed, 'TagsChangedDetailed', 'org.gnome.Hamster')
+        self.bus.add_signal_receiver(self._on_facts_changed_detailed, 'FactsChangedDetailed', 'org.gnome.Hamster')
+        self.bus.add_signal_receiver(self._on_activities_changed_detailed, 'ActivitiesChangedDetailed', 'org.gnome.Hamster')
         self.bus.add_signal_receiver(self._on_toggle_called, 'ToggleCalled', 'org.gnome.Hamster')
 
         self.bus.add_signal_receiver(self._on_dbus_connection_change, 'NameOwnerChanged',
@@ -106,16 +121,73 @@ class Storage(gobject.GObject):
 
     def _on_dbus_connection_change(self, name, old, new):
         self._connection = None
+        self._forget_facts()
 
     def _on_tags_changed(self):
+        self._forget_facts()
         self.emit("tags-changed")
 
     def _on_facts_changed(self):
+        # the cache has been sorted out by the detailed signal
         self.emit("facts-changed")
 
     def _on_activities_changed(self):
+        self._forget_facts()
         self.emit("activities-changed")
 
+    def _on_tags_changed_detailed(self, ids):
+        self.emit("tags-changed-detailed", list(ids))
+
+    def _on_facts_changed_detailed(self, ids, start_date, end_date):
+        start_date = dt.datetime.utcfromtimestamp(start_date).date() if start_date else None
+        end_date = dt.datetime.utcfromtimestamp(end_date).date() if end_date else None
+        self._forget_facts(start_date, end_date)
+        self.emit("facts-changed-detailed", list(ids), start_date, end_date)
+
+    def _on_activities_changed_detailed(self, activity_ids, category_ids):
+        self.emit("activities-changed-detailed", list(activity_ids), list(category_ids))
+
+    def _forget_facts(self, start_date = None, end_date = None):
+        """drops cached ranges that overlap with the given dates, or all
+        of them if there are no dates"""
+        if not start_date or not end_date:
+            self._facts_cache = {}
+            return
+
+        for key in self._facts_cache.keys():
+            if key[0] <= end_date and key[1] >= start_date:
+                del self._facts_cache[key]
+
+    def _day_start(self):
+        try:
+            from configuration import conf
+            day_start = conf.get("day_start_minutes")
+        except:
+            day_start = 5 * 60 # default day start to 5am
+        return dt.time(day_start / 60, day_start % 60)
+
+    def _cached_facts(self, key, fetch):
+        """returns facts from the cache, fetching them if they are not there.
+        the cache is small and keyed by range and the day start, as that
+        decides which day facts fall in"""
+        facts = self._facts_cache.get(key)
+        if facts is None:
+            facts = fetch()
+            if len(self._facts_cache) >= 20:
+                self._facts_cache.popitem()
+            self._facts_cache[key] = facts
+
+        # callers get copies to do with as they please, the cached facts stay
+        # as fetched. the ongoing fact keeps on going while it sits in the cache
+        now = dt.datetime.now().replace(microsecond = 0)
+        res = []
+        for fact in facts:
+            fact = fact.copy()
+            if fact.end_time is None and (dt.date.today() - fact.start_time.date()) <= dt.timedelta(days = 1):
+                fact.delta = now - fact.start_time
+            res.append(fact)
+        return res
+
     def _on_toggle_called(self):
         self.emit("toggle-called")
 
@@ -127,7 +199,11 @@ class Storage(gobject.GObject):
         """returns facts of the current date, respecting hamster midnight
            hamster midnight is stored in gconf, and presented in minutes
         """
-        return [from_dbus_fact(fact) for fact in self.conn.GetTodaysFacts()]
+        day_start = self._day_start()
+        today = (dt.datetime.now() - dt.timedelta(hours = day_start.hour,
+                                                  minutes = day_start.minute)).date()
+        return self._cached_facts((today, today, "", day_start),
+                                  lambda: [from_dbus_fact(fact) for fact in self.conn.GetTodaysFacts()])
 
     def get_facts(self, date, end_date = None, search_terms = ""):
         """Returns facts for the time span matching the optional filter criteria.
@@ -135,20 +211,78 @@ class Storage(gobject.GObject):
            to boolean AND.
            Filter is applied to tags, categories, activity names and description
         """
+        key = (date, end_date or date, search_terms, self._day_start())
+        key = tuple([d.date() if isinstance(d, dt.datetime) else d for d in key])
+
         date = timegm(date.timetuple())
         end_date = end_date or 0
         if end_date:
             end_date = timegm(end_date.timetuple())
 
-        return [from_dbus_fact(fact) for fact in self.conn.GetFacts(date,
-                                                                    end_date,
-                                                                    search_terms)]
+        return self._cached_facts(key,
+                                  lambda: [from_dbus_fact(fact) for fact in self.conn.GetFacts(date,
+                                                                                                end_date,
+                                                                                                search_terms)])
+
+    def iter_facts(self, date, end_date = None, search_terms = "", chunk_size = 500):
+        """Same as get_facts, but fetches the facts in chunks of chunk_size
+           as they are consumed. Use for long ranges that would otherwise
+           be held in memory and sent over in one go.
+        """
+        date = timegm(date.timetuple())
+        end_date = end_date or 0
+        if end_date:
+            end_date = timegm(end_date.timetuple())
+
+        cursor = self.conn.OpenFactCursor(date, end_date, search_terms)
+        try:
+            while True:
+                facts = self.conn.FetchFacts(cursor, chunk_size)
+                for fact in facts:
+                    yield from_dbus_fact(fact)
+
+                if len(facts) < chunk_size:
+                    break
+        finally:
+            self.conn.CloseCursor(cursor)
+
+    def get_totals(self, date, end_date = None, search_terms = "", group_by = None):
+        """Returns durations of facts in the time span summed up by
+           group_by - category, activity, tag, day, weekday or year. Without
+           grouping there is a single grand total. Each total is a dict
+           of key, delta and the number of facts.
+           Search terms work the same as in get_facts.
+        """
+        date = timegm(date.timetuple())
+        end_date = end_date or 0
+        if end_date:
+            end_date = timegm(end_date.timetuple())
 
-    def get_activities(self, search = ""):
+        res = []
+        for key, duration, facts in self.conn.GetTotals(date, end_date, search_terms, group_by or ""):
+            if group_by == "day":
+                key = dt.datetime.strptime(key, "%Y-%m-%d").date()
+            elif group_by in ("weekday", "year"):
+                key = int(key)
+            res.append({'key': key,
+                        'delta': dt.timedelta(seconds = duration),
+                        'facts': facts})
+        return res
+
+    def get_activities(self, search = "", reply_handler = None, error_handler = None):
         """returns list of activities name matching search criteria.
            results are sorted by most recent usage.
-           search is case insensitive
+           search is case insensitive.
+           with reply_handler the call does not block - the handler gets the
+           list once it is there and error_handler gets the dbus exception
+           should the call fail
         """
+        if reply_handler:
+            self.conn.GetActivities(search,
+                                    reply_handler = lambda res: reply_handler(self._to_dict(('name', 'category'), res)),
+                                    error_handler = error_handler or (lambda e: logging.warn(e)))
+            return
+
         return self._to_dict(('name', 'category'), self.conn.GetActivities(search))
 
     def get_categories(self):
@@ -178,6 +312,33 @@ class Storage(gobject.GObject):
         """returns fact by it's ID"""
         return from_dbus_fact(self.conn.GetFact(id))
 
+    def add_facts(self, facts, temporary_activity = False):
+        """Add a list of facts in one go - a single call and a single
+        transaction in the storage, with change signals sent once at the end.
+        Returns list of new fact ids, with 0 for the ones that were skipped
+        """
+        batch = []
+        for fact in facts:
+            end_timestamp = fact.end_time or 0
+            if end_timestamp:
+                end_timestamp = timegm(end_timestamp.timetuple())
+
+            redmine_issue, redmine_activity = -1, -1
+            if isinstance(fact, RedmineFact):
+                redmine_issue, redmine_activity = fact.redmine_issue_id, fact.redmine_time_activity_id
+
+            batch.append((fact.serialized_name(),
+                          timegm((fact.start_time or dt.datetime.now()).timetuple()),
+                          end_timestamp,
+                          redmine_issue, redmine_activity))
+
+        if not batch:
+            return []
+
+        new_ids = self.conn.AddFacts(batch, temporary_activity)
+        self._forget_facts()
+        return [int(new_id) for new_id in new_ids]
+
     def add_fact(self, fact, temporary_activity = False):
         """Add fact. activity name can use the
         `[-]start_time[-end_time] activity@category, description #tag1 #tag2`
@@ -207,6 +368,8 @@ class Storage(gobject.GObject):
                                    end_timestamp,
                                    temporary_activity, -1, -1)
 
+        self._forget_facts()
+
         # TODO - the parsing should happen just once and preferably here
         # we should feed (serialized_activity, start_time, end_time) into AddFact and others
         if new_id:
@@ -217,10 +380,51 @@ class Storage(gobject.GObject):
         """Stop tracking current activity. end_time can be passed in if the
         activity should have other end time than the current moment"""
         end_time = timegm((end_time or dt.datetime.now()).timetuple())
+        self._forget_facts()
         return self.conn.StopTracking(end_time)
 
+    def queue_time_entry(self, fact_id, issue_id, activity_id, hours, comments, spent_on):
+        """queues time entry of the fact for redmine. it is sent in the
+        background and retried until redmine takes it. returns status of
+        the entry - pending, sent or rejected"""
+        return str(self.conn.QueueTimeEntry(fact_id, issue_id, activity_id, hours, comments,
+                                            timegm(spent_on.timetuple())))
+
+    def get_time_entry_status(self, fact_id):
+        """status of the fact's time entry, None if there is none"""
+        return str(self.conn.GetTimeEntryStatus(fact_id)) or None
+
+    def sync_time_entries(self, start_date, end_date):
+        """brings the redmine time entries in line with the redmine facts
+        started between the dates, both included. returns how many entries
+        have been created, updated, linked, left unchanged, rejected and
+        failed. empty while redmine integration is off"""
+        counts = self.conn.SyncTimeEntries(timegm(start_date.timetuple()), timegm(end_date.timetuple()),
+                                           timeout = 10 * 60)
+        return dict((str(key), int(value)) for key, value in counts.items())
+
+    def update_redmine_issues(self, issues):
+        """hands the issues as fetched from redmine over to the storage, for
+        the issue search. returns how many have changed"""
+        return self.conn.UpdateRedmineIssues([(issue["id"], issue["subject"],
+                                               issue.get("project", {}).get("name", ""),
+                                               issue.get("updated_on", ""))
+                                              for issue in issues])
+
+    def search_redmine_issues(self, search = "", limit = 50):
+        """(id, subject, project) of the issues matching the search, most
+        recently updated first"""
+        return [(issue_id, unicode(subject), unicode(project))
+                for issue_id, subject, project in self.conn.SearchRedmineIssues(search, limit)]
+
+    def get_redmine_issue_id(self, subject):
+        """id of the issue with the subject, None if there is none"""
+        issue_id = self.conn.GetRedmineIssueId(subject)
+        return issue_id if issue_id != -1 else None
+
     def remove_fact(self, fact_id):
         "delete fact from database"
+        self._forget_facts()
         self.conn.RemoveFact(fact_id)
 
     def update_fact(self, fact_id, fact, temporary_activity = False):
@@ -241,6 +445,7 @@ class Storage(gobject.GObject):
                                        start_time,
                                        end_time,
                                        temporary_activity)
+        self._forget_facts()
 
         trophies.checker.check_update_based(fact_id, new_id, fact)
         return new_id
@@ -266,21 +471,26 @@ class Storage(gobject.GObject):
 
     # category and activity manipulations (normally just via preferences)
     def remove_activity(self, id):
+        self._forget_facts()
         self.conn.RemoveActivity(id)
 
     def remove_category(self, id):
+        self._forget_facts()
         self.conn.RemoveCategory(id)
 
     def change_category(self, id, category_id):
+        self._forget_facts()
         return self.conn.ChangeCategory(id, category_id)
 
     def update_activity(self, id, name, category_id):
+        self._forget_facts()
         return self.conn.UpdateActivity(id, name, category_id)
 
     def add_activity(self, name, category_id = -1):
         return self.conn.AddActivity(name, category_id)
 
     def update_category(self, id, name):
+        self._forget_facts()
         return self.conn.UpdateCategory(id, name)
 
     def add_category(self, name):
@@ -33,12 +33,13 @@ except ImportError:
         logging.error("Neither sqlite3 nor pysqlite2 found")
         raise
 
-import os, time
+import os, time, re
 import datetime
 import storage
 from shutil import copy as copyfile
 import itertools
 import datetime as dt
+from calendar import timegm
 try:
     import gio
 except ImportError:
@@ -64,8 +65,14 @@ class Storage(storage.Storage):
 
         self.__con = None
         self.__cur = None
-        self.__last_etag = None
-
+        self.__cursor = None
+        self.__data_version = None
+        self.__inode = None
+        self.__fts_module = None
+        self.__issue_fts_module = None
+        self.__interval_index = False
+        self.__catalog_cache = None
+        self.__catalog_version = None
 
         self.db_path = self.__init_db_file(database_dir)
 
@@ -73,26 +80,25 @@ class Storage(storage.Storage):
             # add file monitoring so the app does not have to be restarted
             # when db file is rewritten
             def on_db_file_change(monitor, gio_file, event_uri, event):
-                if event == gio.FILE_MONITOR_EVENT_CHANGES_DONE_HINT:
-                    if gio_file.query_info(gio.FILE_ATTRIBUTE_ETAG_VALUE).get_etag() == self.__last_etag:
-                        # ours
-                        return
-                elif event == gio.FILE_MONITOR_EVENT_CREATED:
-                    # treat case when instead of a move, a remove and create has been performed
-                    self.con = None
-
-                if event in (gio.FILE_MONITOR_EVENT_CHANGES_DONE_HINT, gio.FILE_MONITOR_EVENT_CREATED):
+                if event not in (gio.FILE_MONITOR_EVENT_CHANGES_DONE_HINT, gio.FILE_MONITOR_EVENT_CREATED):
+                    return
+
+                if self.__modified_externally():
                     print "DB file has been modified externally. Calling all stations"
+                    self.__forget_catalog()
                     self.dispatch_overwrite()
 
                     # plan "b" – synchronize the time tracker's database from external source while the tracker is running
                     if trophies:
                         trophies.unlock("plan_b")
 
-
-            self.__database_file = gio.File(self.db_path)
-            self.__db_monitor = self.__database_file.monitor_file()
-            self.__db_monitor.connect("changed", on_db_file_change)
+            # in wal mode commits land in the -wal file and get to the
+            # database file only on checkpoints, so keep an eye on both
+            self.__db_monitors = []
+            for path in (self.db_path, self.db_path + "-wal"):
+                monitor = gio.File(path).monitor_file()
+                monitor.connect("changed", on_db_file_change)
+                self.__db_monitors.append(monitor)
 
         self.run_fixtures()
 
@@ -145,11 +151,28 @@ class Storage(storage.Storage):
         return db_path
 
 
-    def register_modification(self):
-        if gio:
-            # db.execute calls this so we know that we were the ones
-            # that modified the DB and no extra refesh is not needed
-            self.__last_etag = self.__database_file.query_info(gio.FILE_ATTRIBUTE_ETAG_VALUE).get_etag()
+    def __modified_externally(self):
+        """tells if somebody else has written to the database since the last
+        time we looked. sqlite's data_version moves only on commits done by
+        other connections, so our own writes and checkpoints do not count"""
+        if self.con is None:
+            return True
+
+        try:
+            inode = os.stat(self.db_path).st_ino
+        except OSError:
+            inode = None
+        if inode != self.__inode:
+            # the file has been replaced (a remove and create instead of a
+            # move), the connection we have looks at the old one
+            self.con = None
+            return True
+
+        data_version = self.__get_data_version()
+        if data_version is not None and data_version == self.__data_version:
+            return False
+        self.__data_version = data_version
+        return True
 
     #tags, here we come!
     def __get_tags(self, only_autocomplete = False):
@@ -160,30 +183,33 @@ class Storage(storage.Storage):
 
     def __get_tag_ids(self, tags):
         """look up tags by their name. create if not found"""
-
-        db_tags = self.fetchall("select * from tags where name in (%s)"
-                                            % ",".join(["?"] * len(tags)), tags) # bit of magic here - using sqlites bind variables
+        known = self.__catalog()["tags"]
+        names = []
+        for tag in tags:
+            if tag not in names:
+                names.append(tag)
 
         changes = False
 
         # check if any of tags needs resurrection
-        set_complete = [str(tag["id"]) for tag in db_tags if tag["autocomplete"] == "false"]
+        set_complete = [known[name] for name in names if name in known and known[name]["autocomplete"] == "false"]
         if set_complete:
             changes = True
-            self.execute("update tags set autocomplete='true' where id in (%s)" % ", ".join(set_complete))
+            self.execute("update tags set autocomplete='true' where id in (%s)" % ", ".join([str(tag["id"]) for tag in set_complete]))
+            for tag in set_complete:
+                tag["autocomplete"] = "true"
 
-
-        found_tags = [tag["name"] for tag in db_tags]
-
-        add = set(tags) - set(found_tags)
+        add = [name for name in names if name not in known]
         if add:
+            changes = True
             statement = "insert into tags(name) values(?)"
-
             self.execute([statement] * len(add), [(tag,) for tag in add])
 
-            return self.__get_tag_ids(tags)[0], True # all done, recurse
-        else:
-            return db_tags, changes
+            for tag in self.fetchall("select id, name, autocomplete from tags where name in (%s)"
+                                     % ",".join(["?"] * len(add)), add): # bit of magic here - using sqlites bind variables
+                known[tag["name"]] = dict(tag)
+
+        return [dict(known[name]) for name in names], changes
 
     def __update_autocomplete_tags(self, tags):
         tags = [tag.strip() for tag in tags.split(",") if tag.strip()]  # split by comma
@@ -212,6 +238,9 @@ class Storage(storage.Storage):
         if to_uncomplete:
             self.execute("update tags set autocomplete='false' where id in (%s)" % ", ".join(to_uncomplete))
 
+        if to_delete or to_uncomplete:
+            self.__forget_catalog()
+
         return changes or len(to_delete + to_uncomplete) > 0
 
     def __get_categories(self):
@@ -226,9 +255,7 @@ class Storage(storage.Storage):
                      WHERE id = ?
         """
         self.execute(query, (name, name.lower(), category_id, id))
-
-        affected_ids = [res[0] for res in self.fetchall("select id from facts where activity_id = ?", (id,))]
-        self.__remove_index(affected_ids)
+        self.__forget_catalog()
 
 
     def __change_category(self, id, category_id):
@@ -261,11 +288,7 @@ class Storage(storage.Storage):
 
             self.execute(statement, (category_id, id))
 
-        affected_ids = [res[0] for res in self.fetchall("select id from facts where activity_id = ?", (id,))]
-        if existing_activity:
-            affected_ids.extend([res[0] for res in self.fetchall("select id from facts where activity_id = ?", (existing_activity['id'],))])
-        self.__remove_index(affected_ids)
-
+        self.__forget_catalog()
         return True
 
     def __add_category(self, name):
@@ -274,7 +297,12 @@ class Storage(storage.Storage):
                         VALUES (?, ?)
         """
         self.execute(query, (name, name.lower()))
-        return self.__last_insert_rowid()
+        category_id = self.__last_insert_rowid()
+
+        if self.__catalog_cache is not None:
+            self.__catalog_cache["categories"][name.lower()] = category_id
+            self.__catalog_cache["category_names"][category_id] = name
+        return category_id
 
     def __update_category(self, id,  name):
         if id > -1: # Update, and ignore unsorted, if that was somehow triggered
@@ -284,77 +312,83 @@ class Storage(storage.Storage):
                          WHERE id = ?
             """
             self.execute(update, (name, name.lower(), id))
-
-        affected_query = """
-            SELECT id
-              FROM facts
-             WHERE activity_id in (SELECT id FROM activities where category_id=?)
-        """
-        affected_ids = [res[0] for res in self.fetchall(affected_query, (id,))]
-        self.__remove_index(affected_ids)
+            self.__forget_catalog()
 
 
     def __get_activity_by_name(self, name, category_id = None, resurrect = True):
         """get most recent, preferably not deleted activity by it's name"""
+        catalog = self.__catalog()
 
-        if category_id:
-            query = """
-                       SELECT a.id, a.name, a.deleted, coalesce(b.name, ?) as category
-                         FROM activities a
-                    LEFT JOIN categories b ON category_id = b.id
-                        WHERE lower(a.name) = lower(?)
-                          AND category_id = ?
-                     ORDER BY a.deleted, a.id desc
-                        LIMIT 1
-            """
+        activities = [activity for activity in catalog["activities"].get(name.lower(), [])
+                                    if not category_id or activity["category_id"] == category_id]
+        if not activities:
+            return None
 
-            res = self.fetchone(query, (self._unsorted_localized, name, category_id))
-        else:
-            query = """
-                       SELECT a.id, a.name, a.deleted, coalesce(b.name, ?) as category
-                         FROM activities a
-                    LEFT JOIN categories b ON category_id = b.id
-                        WHERE lower(a.name) = lower(?)
-                     ORDER BY a.deleted, a.id desc
-                        LIMIT 1
-            """
-            res = self.fetchone(query, (self._unsorted_localized, name, ))
+        # same order as sqlite would give - not deleted (null) first
+        activity = min(activities, key = lambda activity: (activity["deleted"] is not None,
+                                                           activity["deleted"],
+                                                           -activity["id"]))
 
-        if res:
-            keys = ('id', 'name', 'deleted', 'category')
-            res = dict([(key, res[key]) for key in keys])
-            res['deleted'] = res['deleted'] or False
-
-            # if the activity was marked as deleted, resurrect on first call
-            # and put in the unsorted category
-            if res['deleted'] and resurrect:
-                update = """
-                            UPDATE activities
-                               SET deleted = null, category_id = -1
-                             WHERE id = ?
-                        """
-                self.execute(update, (res['id'], ))
-
-            return res
+        res = {'id': activity["id"],
+               'name': activity["name"],
+               'deleted': activity["deleted"] or False,
+               'category': catalog["category_names"].get(activity["category_id"], self._unsorted_localized)}
 
-        return None
+        # if the activity was marked as deleted, resurrect on first call
+        # and put in the unsorted category
+        if res['deleted'] and resurrect:
+            update = """
+                        UPDATE activities
+                           SET deleted = null, category_id = -1
+                         WHERE id = ?
+                    """
+            self.execute(update, (res['id'], ))
+            activity["deleted"], activity["category_id"] = None, -1
+
+        return res
 
     def __get_category_id(self, name):
         """returns category by it's name"""
-
-        query = """
-                   SELECT id from categories
-                    WHERE lower(name) = lower(?)
-                 ORDER BY id desc
-                    LIMIT 1
-        """
-
-        res = self.fetchone(query, (name, ))
-
-        if res:
-            return res['id']
-
-        return None
+        return self.__catalog()["categories"].get(name.lower())
+
+    def __catalog(self):
+        """categories, activities and tags, kept around as there are not
+        many of them and every added fact needs them. categories and
+        activities go by their lowercased name, tags by the name as it is.
+        our own changes are written through or forget the lot, changes made
+        by others are told by sqlite's data_version"""
+        data_version = self.__get_data_version()
+        if self.__catalog_cache is not None and data_version == self.__catalog_version:
+            return self.__catalog_cache
+
+        catalog = {"categories": {}, "category_names": {}, "activities": {}, "tags": {}}
+        for category in self.fetchall("SELECT id, name FROM categories ORDER BY id"):
+            # the most recent one wins
+            catalog["categories"][(category["name"] or "").lower()] = category["id"]
+            catalog["category_names"][category["id"]] = category["name"]
+
+        for activity in self.fetchall("SELECT id, name, deleted, category_id FROM activities"):
+            catalog["activities"].setdefault((activity["name"] or "").lower(), []).append(dict(activity))
+
+        for tag in self.fetchall("SELECT id, name, autocomplete FROM tags"):
+            catalog["tags"][tag["name"]] = dict(tag)
+
+        self.__catalog_cache, self.__catalog_version = catalog, data_version
+        return catalog
+
+    def __forget_catalog(self):
+        self.__catalog_cache = None
+
+    def __get_data_version(self):
+        """changes whenever another connection commits. asked through a
+        select, as the module commits any ongoing transaction before running
+        a pragma statement"""
+        try:
+            return self.connection.execute("SELECT data_version FROM pragma_data_version()").fetchone()[0]
+        except sqlite.OperationalError:
+            # pragma functions came with sqlite 3.16, the file monitor
+            # will have to do
+            return None
 
     def __get_fact(self, id):
         query = """
@@ -423,20 +457,21 @@ class Storage(storage.Storage):
         # we are checking if our start time is in the middle of anything
         # or maybe there is something after us - so we know to adjust end time
         # in the latter case go only few hours ahead. everything else is madness, heh
+        facts, params = self.__facts_around(start_time - dt.timedelta(hours = 12),
+                                            start_time + dt.timedelta(hours = 12))
         query = """
-                   SELECT a.*, b.name
-                     FROM facts a
-                LEFT JOIN activities b on b.id = a.activity_id
-                    WHERE ((start_time < ? and end_time > ?)
-                           OR (start_time > ? and start_time < ? and end_time is null)
-                           OR (start_time > ? and start_time < ?))
-                 ORDER BY start_time
+                   SELECT a.*
+                     FROM %s
+                    WHERE ((a.start_time < ? and a.end_time > ?)
+                           OR (a.start_time > ? and a.start_time < ? and a.end_time is null)
+                           OR (a.start_time > ? and a.start_time < ?))
+                 ORDER BY a.start_time
                     LIMIT 1
-                """
-        fact = self.fetchone(query, (start_time, start_time,
-                                     start_time - dt.timedelta(hours = 12),
-                                     start_time, start_time,
-                                     start_time + dt.timedelta(hours = 12)))
+                """ % facts
+        fact = self.fetchone(query, params + [start_time, start_time,
+                                              start_time - dt.timedelta(hours = 12),
+                                              start_time, start_time,
+                                              start_time + dt.timedelta(hours = 12)])
         end_time = None
         if fact:
             if start_time > fact["start_time"]:
@@ -461,20 +496,21 @@ class Storage(storage.Storage):
         #             |----------------- NEW -----------------|
         #      |--- old --- 1|   |2 --- old --- 1|   |2 --- old ---|
         # |3 -----------------------  big old   ------------------------ 3|
+        facts, params = self.__facts_around(start_time, end_time)
         query = """
-                   SELECT a.*, b.name, c.name as category
-                     FROM facts a
-                LEFT JOIN activities b on b.id = a.activity_id
-                LEFT JOIN categories c on b.category_id = c.id
-                    WHERE (end_time > ? and end_time < ?)
-                       OR (start_time > ? and start_time < ?)
-                       OR (start_time < ? and end_time > ?)
-                 ORDER BY start_time
-                """
-        conflicts = self.fetchall(query, (start_time, end_time,
-                                          start_time, end_time,
-                                          start_time, end_time))
-
+                   SELECT a.*
+                     FROM %s
+                    WHERE ((a.end_time > ? and a.end_time < ?)
+                           OR (a.start_time > ? and a.start_time < ?)
+                           OR (a.start_time < ? and a.end_time > ?))
+                 ORDER BY a.start_time
+                """ % facts
+        conflicts = self.fetchall(query, params + [start_time, end_time,
+                                                   start_time, end_time,
+                                                   start_time, end_time])
+
+        # the new start and end times of the facts, written in one go
+        moves = []
         for fact in conflicts:
             # won't eliminate as it is better to have overlapping entries than loosing data
             if start_time < fact["start_time"] and end_time > fact["end_time"]:
@@ -484,18 +520,17 @@ class Storage(storage.Storage):
             if fact["start_time"] < start_time < fact["end_time"] and \
                fact["start_time"] < end_time < fact["end_time"]:
 
-                logging.info("splitting %s" % fact["name"])
+                logging.info("splitting fact %s", fact["id"])
                 # truncate until beginning of the new entry
-                self.execute("""UPDATE facts
-                                   SET end_time = ?
-                                 WHERE id = ?""", (start_time, fact["id"]))
-                fact_name = fact["name"]
+                moves.append((fact["start_time"], start_time, fact["id"]))
 
-                # create new fact for the end
-                new_fact = Fact(fact["name"],
-                                category = fact["category"],
-                                description = fact["description"])
-                new_fact_id = self.__add_fact(new_fact.serialized_name(), end_time, fact["end_time"])
+                # the end becomes a fact of its own - same activity,
+                # description and tags
+                self.execute("""INSERT INTO facts (activity_id, start_time, end_time, description)
+                                     VALUES (?, ?, ?, ?)""",
+                             (fact["activity_id"], end_time, fact["end_time"], fact["description"]))
+                new_fact_id = self.__last_insert_rowid()
+                self.execute("INSERT INTO redmine_facts VALUES(?, -1, -1)", (new_fact_id,))
 
                 # copy tags
                 tag_update = """INSERT INTO fact_tags(fact_id, tag_id)
@@ -509,18 +544,33 @@ class Storage(storage.Storage):
 
             # overlap start
             elif start_time < fact["start_time"] < end_time:
-                logging.info("Overlapping start of %s" % fact["name"])
-                self.execute("UPDATE facts SET start_time=? WHERE id=?",
-                             (end_time, fact["id"]))
+                logging.info("Overlapping start of fact %s", fact["id"])
+                moves.append((end_time, fact["end_time"], fact["id"]))
 
             # overlap end
             elif start_time < fact["end_time"] < end_time:
-                logging.info("Overlapping end of %s" % fact["name"])
-                self.execute("UPDATE facts SET end_time=? WHERE id=?",
-                             (start_time, fact["id"]))
+                logging.info("Overlapping end of fact %s", fact["id"])
+                moves.append((fact["start_time"], start_time, fact["id"]))
+
+        if moves:
+            self.executemany("UPDATE facts SET start_time = ?, end_time = ? WHERE id = ?", moves)
+
+    def __facts_around(self, start_time, end_time):
+        """from clause and its parameters for facts aliased as `a` that
+        could touch the given interval. with the interval index that is a
+        quick r*tree lookup that returns a few too many (the boundaries are
+        stored as floats and rounded outwards), so the exact conditions are
+        still up to the caller"""
+        if not self.__interval_index:
+            return "facts a", []
 
+        query = """fact_intervals i
+                      JOIN facts a ON a.id = i.id
+                                  AND i.start_time <= ? AND i.end_time >= ?"""
+        return query, [timegm(end_time.timetuple()), timegm(start_time.timetuple())]
 
-    def __add_fact(self, serialized_fact, start_time, end_time = None, temporary = False, redmine_issue = -1, redmine_activity = -1):
+
+    def __add_fact(self, serialized_fact, start_time, end_time = None, temporary = False, redmine_issue = -1, redmine_activity = -1, lookups = None):
         fact = None
         if redmine_issue == -1:
             fact = Fact(serialized_fact,
@@ -529,35 +579,25 @@ class Storage(storage.Storage):
         else:
             fact = RedmineFact(serialized_fact, redmine_issue_id = redmine_issue, redmine_time_activity_id = redmine_activity, start_time = start_time, end_time = end_time)
 
+        return self.__insert_fact(fact, start_time, end_time, temporary, lookups)
+
+    def __insert_fact(self, fact, start_time, end_time, temporary, lookups = None):
+        """stores the parsed fact and returns its id. tags, categories and
+        activities that have been looked up are kept in lookups, so pass the
+        same dict when adding many facts"""
         start_time = start_time or fact.start_time
         end_time = end_time or fact.end_time
 
         if not fact.activity or start_time is None:  # sanity check
             return 0
 
+        if lookups is None:
+            lookups = {}
 
         # get tags from database - this will create any missing tags too
-        tags = [(tag['id'], tag['name'], tag['autocomplete']) for tag in self.get_tag_ids(fact.tags)]
-
-        # now check if maybe there is also a category
-        category_id = None
-        if fact.category:
-            category_id = self.__get_category_id(fact.category)
-            if not category_id:
-                category_id = self.__add_category(fact.category)
+        tags = self.__lookup_tags(fact.tags, lookups)
 
-                if trophies:
-                    trophies.unlock("no_hands")
-
-        # try to find activity, resurrect if not temporary
-        activity_id = self.__get_activity_by_name(fact.activity,
-                                                  category_id,
-                                                  resurrect = not temporary)
-        if not activity_id:
-            activity_id = self.__add_activity(fact.activity,
-                                              category_id, temporary)
-        else:
-            activity_id = activity_id['id']
+        activity_id = self.__lookup_activity(fact.activity, fact.category, temporary, lookups)
 
         # if we are working on +/- current day - check the last_activity
         if (dt.timedelta(days=-1) <= dt.datetime.now() - start_time <= dt.timedelta(days=1)):
@@ -637,9 +677,76 @@ class Storage(storage.Storage):
         params = [(fact_id, tag[0]) for tag in tags]
         self.execute(insert, params)
 
-        self.__remove_index([fact_id])
         return fact_id
 
+    def __lookup_tags(self, names, lookups):
+        """(id, name, autocomplete) of the tags, creating the missing ones.
+        notes down in lookups if any got created"""
+        known = lookups.setdefault("tags", {})
+        missing = [name for name in names if name not in known]
+        if missing:
+            tags, new_added = self.__get_tag_ids(missing)
+            for tag in tags:
+                known[tag['name']] = (tag['id'], tag['name'], tag['autocomplete'])
+            if new_added:
+                lookups["tags_added"] = True
+        return [known[name] for name in names]
+
+    def __lookup_activity(self, activity, category, temporary, lookups):
+        """id of the activity in the category, adding both if missing"""
+        key = (activity, category, temporary)
+        if key in lookups:
+            return lookups[key]
+
+        # now check if maybe there is also a category
+        category_id = None
+        if category:
+            category_id = self.__get_category_id(category)
+            if not category_id:
+                category_id = self.__add_category(category)
+
+                if trophies:
+                    trophies.unlock("no_hands")
+
+        # try to find activity, resurrect if not temporary
+        activity_id = self.__get_activity_by_name(activity,
+                                                  category_id,
+                                                  resurrect = not temporary)
+        if not activity_id:
+            activity_id = self.__add_activity(activity,
+                                              category_id, temporary)
+        else:
+            activity_id = activity_id['id']
+
+        lookups[key] = activity_id
+        return activity_id
+
+    def __add_facts(self, facts, temporary = False, lookups = None):
+        """adds (fact, start_time, end_time, redmine_issue, redmine_activity)
+        tuples in the given order and returns their ids. the tags of the whole
+        batch are fetched and created in one go"""
+        if lookups is None:
+            lookups = {}
+
+        now = dt.datetime.now().replace(second = 0, microsecond = 0)
+        parsed = []
+        for serialized_fact, start_time, end_time, redmine_issue, redmine_activity in facts:
+            if redmine_issue == -1:
+                fact = Fact(serialized_fact, start_time = start_time, end_time = end_time)
+            else:
+                fact = RedmineFact(serialized_fact, redmine_issue_id = redmine_issue, redmine_time_activity_id = redmine_activity,
+                                   start_time = start_time, end_time = end_time)
+            # same as in add_fact, start defaults to now
+            parsed.append((fact, start_time or fact.start_time or now, end_time))
+
+        tags = set()
+        for fact, start_time, end_time in parsed:
+            tags.update(fact.tags)
+        self.__lookup_tags(list(tags), lookups)
+
+        return [self.__insert_fact(fact, start_time, end_time, temporary, lookups)
+                                                    for fact, start_time, end_time in parsed]
+
     def __last_insert_rowid(self):
         return self.fetchone("SELECT last_insert_rowid();")[0]
 
@@ -656,7 +763,9 @@ class Storage(storage.Storage):
         return self.__get_facts(today)
 
 
-    def __get_facts(self, date, end_date = None, search_terms = ""):
+    def __facts_query(self, date, end_date = None, search_terms = ""):
+        """returns query and parameters that select facts of the given range
+        with their hamster day and effective end time"""
         try:
             from configuration import conf
             day_start = conf.get("day_start_minutes")
@@ -670,84 +779,173 @@ class Storage(storage.Storage):
         end_date = end_date or date
         datetime_to = dt.datetime.combine(end_date, split_time) + dt.timedelta(days = 1)
 
+        # the day assignment is done by the query. facts without end time
+        # last until now if they started in the last 24 hours. a fact
+        # belongs to the hamster day it started in, unless it spans over the
+        # split into the next day and most of it happened on the other side
         query = """
-                   SELECT a.id AS id,
-                          a.start_time AS start_time,
-                          a.end_time AS end_time,
-                          a.description as description,
-                          b.name AS name, b.id as activity_id,
-                          coalesce(c.name, ?) as category,
-                          e.name as tag, f.redmine_issue as redmine_issue, f.redmine_activity as redmine_activity
-                     FROM facts a
-                LEFT JOIN activities b ON a.activity_id = b.id
-                LEFT JOIN categories c ON b.category_id = c.id
-                LEFT JOIN fact_tags d ON d.fact_id = a.id
-                LEFT JOIN tags e ON e.id = d.tag_id
-                LEFT JOIN redmine_facts f ON f.id = a.id
-                    WHERE (a.end_time >= ? OR a.end_time IS NULL) AND a.start_time <= ?
+                   SELECT *
+                     FROM (SELECT *,
+                                  CASE WHEN julianday(end_date) - julianday(start_date) = 1
+                                        AND 2 * strftime('%%s', datetime(end_date, :day_start)) <=
+                                            strftime('%%s', start_time) + strftime('%%s', fact_end)
+                                       THEN end_date
+                                       ELSE start_date
+                                  END AS date
+                             FROM (SELECT *,
+                                          date(start_time, :split) AS start_date,
+                                          date(fact_end, :split) AS end_date
+                                     FROM (SELECT a.id AS id,
+                                                  a.start_time AS start_time,
+                                                  a.end_time AS end_time,
+                                                  a.description as description,
+                                                  b.name AS name, b.id as activity_id,
+                                                  coalesce(c.name, :unsorted) as category,
+                                                  (SELECT group_concat(e.name, char(31))
+                                                     FROM fact_tags d
+                                                     JOIN tags e ON e.id = d.tag_id
+                                                    WHERE d.fact_id = a.id) AS tags,
+                                                  f.redmine_issue as redmine_issue,
+                                                  f.redmine_activity as redmine_activity,
+                                                  CASE WHEN a.end_time IS NOT NULL THEN a.end_time
+                                                       WHEN julianday(:today) - julianday(date(a.start_time)) <= 1 THEN :now
+                                                       ELSE a.start_time
+                                                  END AS fact_end
+                                             FROM facts a
+                                        LEFT JOIN activities b ON a.activity_id = b.id
+                                        LEFT JOIN categories c ON b.category_id = c.id
+                                        LEFT JOIN redmine_facts f ON f.id = a.id
+                                            WHERE a.id in (SELECT id
+                                                             FROM facts
+                                                            WHERE end_time >= :from AND start_time <= :to
+                                                        UNION ALL
+                                                           SELECT id
+                                                             FROM facts
+                                                            WHERE end_time IS NULL AND start_time <= :to)
+                                                  %s)))
+                    WHERE date BETWEEN :date AND :end_date
         """
 
-        if search_terms:
-            # check if we need changes to the index
-            self.__check_index(datetime_from, datetime_to)
+        day_start_minutes = day_start.hour * 60 + day_start.minute
+        params = {"unsorted": self._unsorted_localized,
+                  "from": datetime_from,
+                  "to": datetime_to,
+                  "date": date,
+                  "end_date": end_date,
+                  "day_start": "+%d minutes" % day_start_minutes,
+                  "split": "-%d minutes" % day_start_minutes,
+                  "today": dt.date.today(),
+                  "now": dt.datetime.now().replace(microsecond = 0)}
+
+        search_filter, search_params = self.__search_filter(search_terms)
+        params.update(search_params)
+        return query % search_filter, params
+
+    def __search_filter(self, search_terms):
+        """condition on facts a with categories c for the search terms. the
+        index holds facts without a category with an empty one, as the
+        triggers can't know the localized unsorted - words that it starts
+        with find those facts by their missing category instead"""
+        unsorted = self._unsorted_localized.lower()
+        match = "a.id IN (SELECT rowid FROM fact_index WHERE fact_index MATCH :%s)"
+
+        groups, params = [], {}
+        for i, group in enumerate((search_terms or "").split(",")):
+            words = group.split()
+            conditions = []
+            expressions = self.__match_expressions(" ".join(words))
+            if expressions:
+                conditions.append(match % ("match%d" % i))
+                params["match%d" % i] = expressions[0]
+
+            rest = [word for word in words if not unsorted.startswith(word.lower())]
+            if len(rest) < len(words):
+                rest_expressions = self.__match_expressions(" ".join(rest))
+                if rest_expressions:
+                    conditions.append("(c.id IS NULL AND %s)" % (match % ("rest%d" % i)))
+                    params["rest%d" % i] = rest_expressions[0]
+                else:
+                    conditions.append("c.id IS NULL")
 
-            search_terms = search_terms.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_').replace("'", "''")
-            query += """ AND a.id in (SELECT id
-                                        FROM fact_index
-                                       WHERE fact_index MATCH '%s')""" % search_terms
+            if conditions:
+                groups.append(" OR ".join(conditions))
 
+        if not groups:
+            return "", {}
+        return " AND (%s)" % " OR ".join(["(%s)" % group for group in groups]), params
 
+    def __get_facts(self, date, end_date = None, search_terms = ""):
+        facts_query, params = self.__facts_query(date, end_date, search_terms)
+        query = """
+                   SELECT id,
+                          CAST(strftime('%%s', start_time) AS integer) AS start_time,
+                          CAST(strftime('%%s', end_time) AS integer) AS end_time,
+                          description, name, activity_id, category, tags,
+                          redmine_issue, redmine_activity,
+                          CAST(strftime('%%s', date) AS integer) / 86400 AS date,
+                          strftime('%%s', fact_end) - strftime('%%s', start_time) AS delta
+                     FROM (%s)
+                 ORDER BY start_time
+        """ % facts_query
+
+        # times come as seconds since epoch and dates as days since epoch,
+        # turning those into python objects is way cheaper than parsing text
+        from_timestamp = dt.datetime.utcfromtimestamp
+        epoch_ordinal = dt.date(1970, 1, 1).toordinal()
+        keys = ["id", "start_time", "end_time", "description", "name", "activity_id",
+                "category", "tags", "redmine_issue", "redmine_activity", "date", "delta"]
+        res = []
+        for row in self.fetchall(query, params):
+            fact = dict(zip(keys, row))
+            fact["start_time"] = from_timestamp(fact["start_time"])
+            if fact["end_time"] is not None:
+                fact["end_time"] = from_timestamp(fact["end_time"])
+            # group_concat keeps no order, the tags are sorted here
+            fact["tags"] = sorted(fact["tags"].split(u"\x1f")) if fact["tags"] else []
+            fact["tag"] = fact["tags"][0] if fact["tags"] else None
+            fact["date"] = dt.date.fromordinal(epoch_ordinal + fact["date"])
+            fact["delta"] = dt.timedelta(seconds = fact["delta"])
+            res.append(fact)
 
-        query += " ORDER BY a.start_time, e.name"
+        return res
 
-        facts = self.fetchall(query, (self._unsorted_localized,
-                                      datetime_from,
-                                      datetime_to))
+    def __get_totals(self, date, end_date = None, search_terms = "", group_by = None):
+        """sums up durations of the facts in the range. group_by can be
+        category, activity, tag, day, weekday (monday is 0) or year. without
+        grouping a single total is returned. facts with several tags count
+        towards each of them"""
+        groups = {
+            None: "''",
+            "category": "category",
+            "activity": "name",
+            "tag": "e.name",
+            "day": "date",
+            "weekday": "(CAST(strftime('%w', date) AS integer) + 6) % 7",
+            "year": "CAST(strftime('%Y', date) AS integer)",
+        }
+        if group_by not in groups:
+            raise ValueError("can't group totals by %s" % group_by)
+
+        facts_query, params = self.__facts_query(date, end_date, search_terms)
+        tables = "(%s) facts" % facts_query
+        if group_by == "tag":
+            tables += """ JOIN fact_tags d ON d.fact_id = facts.id
+                          JOIN tags e ON e.id = d.tag_id"""
 
-        #first let's put all tags in an array
-        facts = self.__group_tags(facts)
+        query = """
+                   SELECT %(key)s AS key,
+                          sum(strftime('%%s', fact_end) - strftime('%%s', start_time)) AS duration,
+                          count(*) AS facts
+                     FROM %(tables)s
+                 GROUP BY key
+                 ORDER BY key
+        """ % {"key": groups[group_by], "tables": tables}
 
         res = []
-        for fact in facts:
-            # heuristics to assign tasks to proper days
-
-            # if fact has no end time, set the last minute of the day,
-            # or current time if fact has happened in last 24 hours
-            if fact["end_time"]:
-                fact_end_time = fact["end_time"]
-            elif (dt.date.today() - fact["start_time"].date()) <= dt.timedelta(days=1):
-                fact_end_time = dt.datetime.now().replace(microsecond = 0)
-            else:
-                fact_end_time = fact["start_time"]
-
-            fact_start_date = fact["start_time"].date() \
-                - dt.timedelta(1 if fact["start_time"].time() < split_time else 0)
-            fact_end_date = fact_end_time.date() \
-                - dt.timedelta(1 if fact_end_time.time() < split_time else 0)
-            fact_date_span = fact_end_date - fact_start_date
-
-            # check if the task spans across two dates
-            if fact_date_span.days == 1:
-                datetime_split = dt.datetime.combine(fact_end_date, split_time)
-                start_date_duration = datetime_split - fact["start_time"]
-                end_date_duration = fact_end_time - datetime_split
-                if start_date_duration > end_date_duration:
-                    # most of the task was done during the previous day
-                    fact_date = fact_start_date
-                else:
-                    fact_date = fact_end_date
-            else:
-                # either doesn't span or more than 24 hrs tracked
-                # (in which case we give up)
-                fact_date = fact_start_date
-
-            if fact_date < date or fact_date > end_date:
-                # due to spanning we've jumped outside of given period
-                continue
-
-            fact["date"] = fact_date
-            fact["delta"] = fact_end_time - fact["start_time"]
-            res.append(fact)
+        for key, duration, facts in self.fetchall(query, params):
+            if group_by == "day":
+                key = dt.datetime.strptime(key, "%Y-%m-%d").date()
+            res.append({"key": key, "delta": dt.timedelta(seconds = duration), "facts": facts})
 
         return res
 
@@ -756,8 +954,6 @@ class Storage(storage.Storage):
                       "DELETE FROM facts where id = ?", "DELETE FROM redmine_facts where id = ?"]
         self.execute(statements, [(fact_id,)] * 2)
 
-        self.__remove_index([fact_id])
-
     def __get_category_activities(self, category_id):
         """returns list of activities, if category is specified, order by name
            otherwise - by activity_order"""
@@ -775,22 +971,25 @@ class Storage(storage.Storage):
 
     def __get_activities(self, search):
         """returns list of activities for autocomplete,
-           activity names converted to lowercase"""
+           activity names converted to lowercase.
+           activities starting with the search come first, followed by those
+           that have it elsewhere in the name. within each, the most recently
+           used go first"""
 
         query = """
                    SELECT a.name AS name, b.name AS category
                      FROM activities a
                 LEFT JOIN categories b ON coalesce(b.id, -1) = a.category_id
-                LEFT JOIN facts f ON a.id = f.activity_id
+                LEFT JOIN activity_stats s ON s.activity_id = a.id
                     WHERE deleted IS NULL
                       AND a.search_name LIKE ? ESCAPE '\\'
-                 GROUP BY a.id
-                 ORDER BY max(f.start_time) DESC, lower(a.name)
+                 ORDER BY a.search_name LIKE ? ESCAPE '\\' DESC,
+                          s.last_used DESC, s.facts DESC, lower(a.name)
                     LIMIT 50
         """
         search = search.lower()
         search = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
-        activities = self.fetchall(query, (u'%s%%' % search, ))
+        activities = self.fetchall(query, (u'%%%s%%' % search, u'%s%%' % search))
 
         return activities
 
@@ -806,6 +1005,7 @@ class Storage(storage.Storage):
             self.execute("UPDATE activities SET deleted = 1 WHERE id = ?", (id,))
         else:
             self.execute("delete from activities where id = ?", (id,))
+        self.__forget_catalog()
 
         # Finished! - deleted an activity with more than 50 facts on it
         if trophies and bound_facts >= 50:
@@ -813,20 +1013,11 @@ class Storage(storage.Storage):
 
     def __remove_category(self, id):
         """move all activities to unsorted and remove category"""
-
-        affected_query = """
-            SELECT id
-              FROM facts
-             WHERE activity_id in (SELECT id FROM activities where category_id=?)
-        """
-        affected_ids = [res[0] for res in self.fetchall(affected_query, (id,))]
-
         update = "update activities set category_id = -1 where category_id = ?"
         self.execute(update, (id, ))
 
         self.execute("delete from categories where id = ?", (id, ))
-
-        self.__remove_index(affected_ids)
+        self.__forget_catalog()
 
 
     def __add_activity(self, name, category_id = None, temporary = False):
@@ -848,80 +1039,434 @@ class Storage(storage.Storage):
                         VALUES (?, ?, ?, ?)
         """
         self.execute(query, (name, name.lower(), category_id, deleted))
-        return self.__last_insert_rowid()
+        activity_id = self.__last_insert_rowid()
+
+        if self.__catalog_cache is not None:
+            self.__catalog_cache["activities"].setdefault(name.lower(), []).append(
+                {"id": activity_id, "name": name, "deleted": deleted, "category_id": category_id})
+        return activity_id
+
+    def __queue_time_entry(self, fact_id, issue_id, activity_id, hours, comments, spent_on):
+        """puts time entry of the fact in the outbox. there is one entry per
+        fact - queueing again updates the entry as long as it has not been
+        sent. returns status of the entry"""
+        self.execute(["""INSERT OR IGNORE INTO redmine_outbox (fact_id, status)
+                                           VALUES (?, 'pending')""",
+                      """UPDATE redmine_outbox
+                            SET issue_id = ?, activity_id = ?, hours = ?, comments = ?, spent_on = ?
+                          WHERE fact_id = ? AND status = 'pending'"""],
+                     [(fact_id,),
+                      (issue_id, activity_id, hours, comments, spent_on, fact_id)])
+        return self.__get_time_entry_status(fact_id)["status"]
+
+    def __get_due_time_entries(self, now, limit):
+        query = """
+                   SELECT fact_id, issue_id, activity_id, hours, comments, spent_on, attempts
+                     FROM redmine_outbox
+                    WHERE status = 'pending'
+                      AND (next_attempt IS NULL OR next_attempt <= ?)
+                 ORDER BY next_attempt, fact_id
+                    LIMIT ?
+        """
+        return self.fetchall(query, (now, limit))
 
-    def __remove_index(self, ids):
-        """remove affected ids from the index"""
-        if not ids:
+    def __get_time_entry_status(self, fact_id):
+        query = """
+                   SELECT fact_id, status, attempts, next_attempt, last_error, sent_at
+                     FROM redmine_outbox
+                    WHERE fact_id = ?
+        """
+        return self.fetchone(query, (fact_id,))
+
+    def __set_time_entry_sent(self, fact_id, sent_at, time_entry_id = None):
+        self.execute("""UPDATE redmine_outbox
+                           SET status = 'sent', sent_at = ?, next_attempt = NULL, last_error = NULL,
+                               time_entry_id = coalesce(?, time_entry_id)
+                         WHERE fact_id = ?""", (sent_at, time_entry_id, fact_id))
+
+    def __set_time_entry_synced(self, fact_id, issue_id, activity_id, hours, comments, spent_on,
+                                time_entry_id, error, sent_at):
+        """notes down the fact's entry as it is in redmine now, or as
+        rejected with the error. the redmine entry belongs to this fact
+        alone from now on"""
+        status = 'rejected' if error else 'sent'
+        self.execute(["""UPDATE redmine_outbox SET time_entry_id = NULL
+                          WHERE time_entry_id = ? AND fact_id != ?""",
+                      """INSERT OR REPLACE INTO redmine_outbox (fact_id, issue_id, activity_id, hours, comments, spent_on,
+                                                                 status, last_error, sent_at, time_entry_id)
+                                                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""],
+                     [(time_entry_id, fact_id),
+                      (fact_id, issue_id, activity_id, hours, comments, spent_on,
+                       status, error, None if error else sent_at, time_entry_id)])
+
+    def __get_redmine_time_entries(self, start_time, end_time):
+        """closed redmine facts started between the times, with the redmine
+        entry they have been sent as, if any. facts still waiting in the
+        outbox are left out"""
+        query = """
+                   SELECT f.id AS fact_id, r.redmine_issue AS issue_id, r.redmine_activity AS activity_id,
+                          a.name AS comments, f.start_time, f.end_time,
+                          o.time_entry_id, o.status
+                     FROM facts f
+                     JOIN redmine_facts r ON r.id = f.id
+                     JOIN activities a ON a.id = f.activity_id
+                LEFT JOIN redmine_outbox o ON o.fact_id = f.id
+                    WHERE f.start_time >= ? AND f.start_time < ?
+                      AND f.end_time IS NOT NULL
+                      AND r.redmine_issue > 0
+                      AND coalesce(o.status, '') != 'pending'
+                 ORDER BY f.start_time
+        """
+        return self.fetchall(query, (start_time, end_time))
+
+    def __set_time_entry_failed(self, fact_id, error, next_attempt):
+        """without next attempt the entry is given up on as rejected"""
+        status = 'pending' if next_attempt else 'rejected'
+        self.execute("""UPDATE redmine_outbox
+                           SET status = ?, attempts = attempts + 1, next_attempt = ?, last_error = ?
+                         WHERE fact_id = ?""", (status, next_attempt, error, fact_id))
+
+    def __update_redmine_issues(self, issues):
+        """brings the local copy of the user's redmine issues in line with
+        the list of (id, subject, project, updated_on). only what has
+        changed is written, so that the search index is left alone
+        otherwise"""
+        known = dict((row[0], tuple(row)) for row in
+                     self.fetchall("SELECT id, subject, project, updated_on FROM redmine_issues"))
+        issues = dict((issue[0], tuple(issue)) for issue in issues)
+
+        statements, params = [], []
+        for issue_id, issue in issues.iteritems():
+            if issue_id not in known:
+                statements.append("INSERT INTO redmine_issues (id, subject, project, updated_on) VALUES (?, ?, ?, ?)")
+                params.append(issue)
+            elif known[issue_id] != issue:
+                statements.append("UPDATE redmine_issues SET subject = ?, project = ?, updated_on = ? WHERE id = ?")
+                params.append(issue[1:] + (issue_id,))
+        for issue_id in set(known) - set(issues):
+            statements.append("DELETE FROM redmine_issues WHERE id = ?")
+            params.append((issue_id,))
+
+        if statements:
+            self.execute(statements, params)
+        return len(statements)
+
+    def __search_redmine_issues(self, search, limit):
+        """issues with words starting with the search terms in subject or
+        project, or with the number, most recently updated first"""
+        query = """
+                   SELECT id, subject, project
+                     FROM redmine_issues
+                    %s
+                 ORDER BY updated_on DESC, id DESC
+                    LIMIT ?
+        """
+        search = search.strip().lstrip("#")
+        if not search:
+            return self.fetchall(query % "", (limit,))
+
+        clauses, params = [], []
+        if search.isdigit():
+            clauses.append("id = ?")
+            params.append(int(search))
+
+        if self.__issue_fts_module:
+            expressions = self.__match_expressions(search, self.__issue_fts_module)
+            if expressions:
+                clauses.append("id IN (%s)" % " UNION ".join(
+                    ["SELECT rowid FROM redmine_issue_index WHERE redmine_issue_index MATCH ?"] * len(expressions)))
+                params.extend(expressions)
+        else:
+            search = search.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            clauses.append("(lower(subject) LIKE ? ESCAPE '\\' OR lower(project) LIKE ? ESCAPE '\\')")
+            params.extend([u'%%%s%%' % search] * 2)
+
+        if not clauses:
+            return []
+        return self.fetchall(query % ("WHERE " + " OR ".join(clauses)), params + [limit])
+
+    def __get_redmine_issue_id(self, subject):
+        res = self.fetchone("SELECT id FROM redmine_issues WHERE subject = ? ORDER BY id LIMIT 1", (subject,))
+        return res[0] if res else None
+
+    def __match_expressions(self, search_terms, module = None):
+        """turns the search string into full text queries - one per comma
+        separated group, as comma means OR and space means AND. every word is
+        matched as a prefix so that the partial words can be served from the
+        prefix index"""
+        if not search_terms:
+            return []
+
+        if (module or self.__fts_module) == "fts5":
+            term_format = '"%s"*'
+        else:
+            term_format = '"%s*"'
+
+        expressions = []
+        for group in search_terms.split(","):
+            terms = [term.replace('"', '') for term in group.split()]
+            terms = [term_format % term for term in terms if re.search("\w", term, re.UNICODE)]
+            if terms:
+                expressions.append(" ".join(terms))
+        return expressions
+
+    def __create_index(self):
+        """full text index on facts, kept current by triggers. picks the
+        best module the sqlite library has"""
+        for module, options in (("fts5", "prefix='2 3'"), ("fts4", 'prefix="2,3"'), ("fts3", None)):
+            statement = "CREATE VIRTUAL TABLE fact_index USING %s(name, category, description, tag%s)" \
+                                                     % (module, ", %s" % options if options else "")
+            try:
+                self.execute(statement)
+                break
+            except sqlite.OperationalError:
+                logging.info("%s not available for the fact index" % module)
+
+        # the indexed document of a fact (or of all facts matching the clause)
+        reindex = """
+            INSERT INTO fact_index(rowid, name, category, description, tag)
+                 SELECT f.id, a.name, coalesce(c.name, ''), f.description,
+                        (SELECT group_concat(t.name, ' ')
+                           FROM fact_tags ft
+                           JOIN tags t ON t.id = ft.tag_id
+                          WHERE ft.fact_id = f.id)
+                   FROM facts f
+              LEFT JOIN activities a ON a.id = f.activity_id
+              LEFT JOIN categories c ON c.id = a.category_id
+                  WHERE %s;"""
+
+        for_facts = "f.id IN (SELECT id FROM facts WHERE activity_id IN (%s))"
+        triggers = [
+            ("facts_ai", "AFTER INSERT ON facts",
+             reindex % "f.id = new.id"),
+            ("facts_au", "AFTER UPDATE OF activity_id, description ON facts",
+             "DELETE FROM fact_index WHERE rowid = old.id;" + reindex % "f.id = new.id"),
+            ("facts_ad", "AFTER DELETE ON facts",
+             "DELETE FROM fact_index WHERE rowid = old.id;"),
+            ("fact_tags_ai", "AFTER INSERT ON fact_tags",
+             "DELETE FROM fact_index WHERE rowid = new.fact_id;" + reindex % "f.id = new.fact_id"),
+            ("fact_tags_ad", "AFTER DELETE ON fact_tags",
+             "DELETE FROM fact_index WHERE rowid = old.fact_id;" + reindex % "f.id = old.fact_id"),
+            ("activities_au", "AFTER UPDATE OF name, category_id ON activities",
+             "DELETE FROM fact_index WHERE rowid IN (SELECT id FROM facts WHERE activity_id = new.id);" +
+             reindex % (for_facts % "new.id")),
+            ("categories_au", "AFTER UPDATE OF name ON categories",
+             "DELETE FROM fact_index WHERE rowid IN (SELECT id FROM facts WHERE activity_id IN (SELECT id FROM activities WHERE category_id = new.id));" +
+             reindex % (for_facts % "SELECT id FROM activities WHERE category_id = new.id")),
+        ]
+        for name, event, body in triggers:
+            self.execute("CREATE TRIGGER fact_index_%s %s BEGIN %s END" % (name, event, body))
+
+        self.execute(reindex % "1")
+
+    def __create_interval_index(self):
+        """fact_intervals holds start and end of every fact in seconds, open
+        facts are points at their start. triggers keep it in line with
+        the facts. without the rtree module the overlap checks go to the
+        facts table directly"""
+        try:
+            self.execute("CREATE VIRTUAL TABLE fact_intervals USING rtree(id, start_time, end_time)")
+        except sqlite.OperationalError:
+            logging.info("rtree not available for the interval index")
             return
 
-        ids = ",".join((str(id) for id in ids))
-        self.execute("DELETE FROM fact_index where id in (%s)" % ids)
+        bounds = "strftime('%%s', %(row)s.start_time), strftime('%%s', coalesce(%(row)s.end_time, %(row)s.start_time))"
+        triggers = [
+            ("facts_ai", "AFTER INSERT ON facts",
+             "INSERT INTO fact_intervals VALUES (new.id, %s);" % (bounds % {"row": "new"})),
+            ("facts_au", "AFTER UPDATE OF start_time, end_time ON facts",
+             "DELETE FROM fact_intervals WHERE id = old.id; INSERT INTO fact_intervals VALUES (new.id, %s);" % (bounds % {"row": "new"})),
+            ("facts_ad", "AFTER DELETE ON facts",
+             "DELETE FROM fact_intervals WHERE id = old.id;"),
+        ]
+        for name, event, body in triggers:
+            self.execute("CREATE TRIGGER fact_intervals_%s %s BEGIN %s END" % (name, event, body))
+
+        self.execute("INSERT INTO fact_intervals SELECT id, %s FROM facts" % (bounds % {"row": "facts"}))
+
+    def __create_activity_stats(self):
+        """activity_stats keeps when each activity was last used and on how
+        many facts, so that autocomplete can rank the activities without
+        going through the facts. triggers keep it in line with the facts"""
+        self.execute("""CREATE TABLE activity_stats(activity_id INTEGER PRIMARY KEY,
+                                                    last_used timestamp,
+                                                    facts INTEGER NOT NULL DEFAULT 0)""")
+
+        # last used is looked up again from the facts as removing or moving
+        # back the latest fact of an activity leaves no other way to tell
+        touched = """INSERT OR IGNORE INTO activity_stats (activity_id)
+                          SELECT %(row)s.activity_id WHERE %(row)s.activity_id IS NOT NULL;
+                     UPDATE activity_stats
+                        SET facts = facts %(sign)s 1,
+                            last_used = (SELECT max(start_time) FROM facts WHERE activity_id = %(row)s.activity_id)
+                      WHERE activity_id = %(row)s.activity_id;"""
+        triggers = [
+            ("facts_ai", "AFTER INSERT ON facts",
+             touched % {"row": "new", "sign": "+"}),
+            ("facts_au", "AFTER UPDATE OF activity_id, start_time ON facts",
+             touched % {"row": "old", "sign": "-"} + touched % {"row": "new", "sign": "+"}),
+            ("facts_ad", "AFTER DELETE ON facts",
+             touched % {"row": "old", "sign": "-"}),
+            ("activities_ad", "AFTER DELETE ON activities",
+             "DELETE FROM activity_stats WHERE activity_id = old.id;"),
+        ]
+        for name, event, body in triggers:
+            self.execute("CREATE TRIGGER activity_stats_%s %s BEGIN %s END" % (name, event, body))
+
+        self.execute("""INSERT INTO activity_stats
+                             SELECT activity_id, max(start_time), count(*)
+                               FROM facts
+                              WHERE activity_id IS NOT NULL
+                           GROUP BY activity_id""")
+
+    def __create_redmine_issues(self):
+        """local copy of the redmine issues assigned to the user, for the
+        issue search to go to instead of the server. redmine_issue_index has
+        their subjects and projects for full text search, kept current by
+        triggers"""
+        self.execute("""CREATE TABLE redmine_issues(id INTEGER PRIMARY KEY,
+                                                    subject TEXT NOT NULL,
+                                                    project TEXT,
+                                                    updated_on TEXT)""")
+        self.execute("CREATE INDEX idx_redmine_issues_subject ON redmine_issues(subject)")
+
+        for module, options in (("fts5", "prefix='2 3'"), ("fts4", 'prefix="2,3"'), ("fts3", None)):
+            statement = "CREATE VIRTUAL TABLE redmine_issue_index USING %s(subject, project%s)" \
+                                                     % (module, ", %s" % options if options else "")
+            try:
+                self.execute(statement)
+                break
+            except sqlite.OperationalError:
+                logging.info("%s not available for the issue index" % module)
+        else:
+            return
 
+        index = "INSERT INTO redmine_issue_index(rowid, subject, project) VALUES (new.id, new.subject, coalesce(new.project, ''));"
+        triggers = [
+            ("ai", "AFTER INSERT ON redmine_issues", index),
+            ("au", "AFTER UPDATE OF subject, project ON redmine_issues",
+             "DELETE FROM redmine_issue_index WHERE rowid = old.id;" + index),
+            ("ad", "AFTER DELETE ON redmine_issues",
+             "DELETE FROM redmine_issue_index WHERE rowid = old.id;"),
+        ]
+        for name, event, body in triggers:
+            self.execute("CREATE TRIGGER redmine_issue_index_%s %s BEGIN %s END" % (name, event, body))
+
+    def __get_fts_module(self, table = "fact_index"):
+        res = self.fetchone("SELECT sql FROM sqlite_master WHERE name = ?", (table,))
+        for module in ("fts5", "fts4", "fts3"):
+            if res and module in res[0].lower():
+                return module
+        return None
 
-    def __check_index(self, start_date, end_date):
-        """check if maybe index needs rebuilding in the time span"""
-        index_query = """SELECT id
-                           FROM facts
-                          WHERE (end_time >= ? OR end_time IS NULL)
-                            AND start_time <= ?
-                            AND id not in(select id from fact_index)"""
 
-        rebuild_ids = ",".join([str(res[0]) for res in self.fetchall(index_query, (start_date, end_date))])
+    def __track_changes(self, con):
+        """temporary triggers that note down what has been touched over this
+        connection, so that the change signals can tell what has changed.
+        tables that are not there yet are left for after the upgrade"""
+        tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        script = ["CREATE TEMP TABLE IF NOT EXISTS changes(kind varchar2, id integer, start_time timestamp, end_time timestamp);"]
+
+        touched_fact = """INSERT INTO changes
+                               SELECT 'fact', id, start_time, end_time
+                                 FROM main.facts WHERE id = %s;"""
+        watched = [
+            ("facts", "INSERT INTO changes VALUES ('fact', %(row)s.id, %(row)s.start_time, %(row)s.end_time);"),
+            ("fact_tags", touched_fact % "%(row)s.fact_id"),
+            ("redmine_facts", touched_fact % "%(row)s.id"),
+            ("activities", "INSERT INTO changes (kind, id) VALUES ('activity', %(row)s.id);"),
+            ("categories", "INSERT INTO changes (kind, id) VALUES ('category', %(row)s.id);"),
+            ("tags", "INSERT INTO changes (kind, id) VALUES ('tag', %(row)s.id);"),
+        ]
+        for table, statement in watched:
+            if table not in tables:
+                continue
+            for event, rows in (("INSERT", ["new"]), ("UPDATE", ["old", "new"]), ("DELETE", ["old"])):
+                body = "".join([statement % {"row": row} for row in rows])
+                script.append("CREATE TEMP TRIGGER IF NOT EXISTS changes_%s_%s AFTER %s ON main.%s BEGIN %s END;" \
+                                                                 % (table, event.lower(), event, table, body))
+        con.executescript("\n".join(script))
+
+    def __pop_changes(self, kind):
+        """ids of things of the kind that have changed since the last time"""
+        ids = [row[0] for row in self.fetchall("SELECT DISTINCT id FROM changes WHERE kind = ? ORDER BY id", (kind,))]
+        self.execute("DELETE FROM changes WHERE kind = ?", (kind,))
+        return ids
+
+    def __pop_fact_changes(self):
+        """ids of changed facts and the span of days they were and are in"""
+        try:
+            from configuration import conf
+            day_start = conf.get("day_start_minutes")
+        except:
+            day_start = 5 * 60 # default day start to 5am
 
-        if rebuild_ids:
-            query = """
-                       SELECT a.id AS id,
-                              a.start_time AS start_time,
-                              a.end_time AS end_time,
-                              a.description as description,
-                              b.name AS name, b.id as activity_id,
-                              coalesce(c.name, ?) as category,
-                              e.name as tag, f.redmine_issue as redmine_issue, f.redmine_activity as redmine_activity
-                         FROM facts a
-                    LEFT JOIN activities b ON a.activity_id = b.id
-                    LEFT JOIN categories c ON b.category_id = c.id
-                    LEFT JOIN fact_tags d ON d.fact_id = a.id
-                    LEFT JOIN tags e ON e.id = d.tag_id
-                    LEFT JOIN redmine_facts f ON f.id = a.id
-                        WHERE a.id in (%s)
-                     ORDER BY a.id
-            """ % rebuild_ids
-
-            facts = self.__group_tags(self.fetchall(query, (self._unsorted_localized, )))
-
-            insert = """INSERT INTO fact_index (id, name, category, description, tag)
-                             VALUES (?, ?, ?, ?, ?)"""
-            params = [(fact['id'], fact['name'], fact['category'], fact['description'], " ".join(fact['tags'])) for fact in facts]
-
-            self.executemany(insert, params)
+        # open facts go on till now
+        span = self.fetchone("""SELECT date(min(start_time), :split) AS start_date,
+                                       date(max(coalesce(end_time, :now)), :split) AS end_date
+                                  FROM changes
+                                 WHERE kind = 'fact'""",
+                             {"split": "-%d minutes" % day_start,
+                              "now": dt.datetime.now().replace(microsecond = 0)})
+
+        start_date, end_date = None, None
+        if span["start_date"]:
+            start_date = dt.datetime.strptime(span["start_date"], "%Y-%m-%d").date()
+            end_date = dt.datetime.strptime(span["end_date"], "%Y-%m-%d").date()
+        return self.__pop_changes("fact"), start_date, end_date
 
 
     """ Here be dragons (lame connection/cursor wrappers) """
     def get_connection(self):
         if self.con is None:
-            self.con = sqlite.connect(self.db_path, detect_types=sqlite.PARSE_DECLTYPES|sqlite.PARSE_COLNAMES)
+            # the module keeps compiled statements around by their sql, make
+            # room for all the queries we have
+            self.con = sqlite.connect(self.db_path, detect_types=sqlite.PARSE_DECLTYPES|sqlite.PARSE_COLNAMES,
+                                      cached_statements = 200)
             self.con.row_factory = sqlite.Row
+            self.__tune_connection(self.con)
+            self.__track_changes(self.con)
+
+            self.__cursor = self.con.cursor()
+            self.__data_version = self.__get_data_version()
+            try:
+                self.__inode = os.stat(self.db_path).st_ino
+            except OSError:
+                self.__inode = None
 
         return self.con
 
     connection = property(get_connection, None)
 
+    def __tune_connection(self, con):
+        """write ahead log lets readers (say an export running in the
+        command line) go on while the service writes, and the other way
+        round. normal sync is safe with wal - a power cut can lose the last
+        commits but will not corrupt the database"""
+        try:
+            con.execute("PRAGMA journal_mode = WAL")
+        except sqlite.OperationalError, e:
+            # read-only directory and such - stay with the rollback journal
+            logging.warn("could not switch to write ahead log: %s", e)
+
+        con.execute("PRAGMA synchronous = NORMAL")
+        con.execute("PRAGMA cache_size = -16000") # in KiB
+        con.execute("PRAGMA mmap_size = 268435456")
+        con.execute("PRAGMA temp_store = MEMORY")
+        con.execute("PRAGMA journal_size_limit = 4194304")
+
     def fetchall(self, query, params = None):
         con = self.connection
-        cur = con.cursor()
+        cur = self.__cur or self.__cursor
 
-        logging.debug("%s %s" % (query, params))
+        logging.debug("%s %s", query, params)
 
         if params:
             cur.execute(query, params)
         else:
             cur.execute(query)
 
-        res = cur.fetchall()
-        cur.close()
-
-        return res
+        return cur.fetchall()
 
     def fetchone(self, query, params = None):
         res = self.fetchall(query, params)
@@ -936,52 +1481,51 @@ class Storage(storage.Storage):
         to save on cursor creation and closure
         """
         con = self.__con or self.connection
-        cur = self.__cur or con.cursor()
+        cur = self.__cur or self.__cursor
 
         if isinstance(statement, list) == False: # we expect to receive instructions in list
             statement = [statement]
             params = [params]
 
         for state, param in zip(statement, params):
-            logging.debug("%s %s" % (state, param))
+            logging.debug("%s %s", state, param)
             cur.execute(state, param)
 
         if not self.__con:
             con.commit()
-            cur.close()
-            self.register_modification()
 
     def executemany(self, statement, params = []):
         con = self.__con or self.connection
-        cur = self.__cur or con.cursor()
+        cur = self.__cur or self.__cursor
 
-        logging.debug("%s %s" % (statement, params))
+        logging.debug("%s %s", statement, params)
         cur.executemany(statement, params)
 
         if not self.__con:
             con.commit()
-            cur.close()
-            self.register_modification()
 
 
 
     def start_transaction(self):
-        # will give some hints to execute not to close or commit anything
+        # will give some hints to execute not to commit anything
         self.__con = self.connection
-        self.__cur = self.__con.cursor()
+        self.__cur = self.__cursor
 
     def end_transaction(self):
         self.__con.commit()
-        self.__cur.close()
         self.__con, self.__cur = None, None
-        self.register_modification()
+
+    def rollback_transaction(self):
+        self.__con.rollback()
+        self.__con, self.__cur = None, None
+        self.__forget_catalog()
 
     def run_fixtures(self):
         self.start_transaction()
 
         """upgrade DB to hamster version"""
         version = self.fetchone("SELECT version FROM version")["version"]
-        current_version = 10
+        current_version = 17
 
         if version < 8:
             # working around sqlite's utf-f case sensitivity (bug 624438)
@@ -1012,7 +1556,59 @@ class Storage(storage.Storage):
             query = "insert into redmine_facts values(?, -1, -1)"
             for cid in ids:
               self.execute(query, (cid['id'],))
-            
+
+        if version < 11:
+            # indexes for the date range lookups. the range predicate is split
+            # in closed and open facts so that both halves can use an index
+            self.execute("CREATE INDEX idx_facts_end_start ON facts(end_time, start_time)")
+            self.execute("CREATE INDEX idx_facts_start ON facts(start_time)")
+            self.execute("CREATE INDEX idx_facts_activity ON facts(activity_id)")
+            self.execute("CREATE INDEX idx_facts_open ON facts(start_time) WHERE end_time IS NULL")
+            self.execute("CREATE INDEX idx_redmine_facts_id ON redmine_facts(id)")
+
+        if version < 12:
+            # the index used to be filled lazily on search. now it is kept
+            # up to date by triggers and has a prefix index
+            self.execute("DROP TABLE fact_index")
+            self.__create_index()
+
+        if version < 13:
+            # r*tree over fact start and end times for the overlap checks
+            self.__create_interval_index()
+
+        if version < 14:
+            # last use and fact count of activities for the autocomplete.
+            # the activity index gets start time along so that last use can
+            # be looked up without going through the facts of the activity
+            self.execute("DROP INDEX IF EXISTS idx_facts_activity")
+            self.execute("CREATE INDEX idx_facts_activity_start ON facts(activity_id, start_time)")
+            self.__create_activity_stats()
+
+        if version < 15:
+            # time entries waiting to go out to redmine, one per fact
+            self.execute("""CREATE TABLE redmine_outbox(fact_id INTEGER PRIMARY KEY,
+                                                        issue_id INTEGER,
+                                                        activity_id INTEGER,
+                                                        hours REAL,
+                                                        comments TEXT,
+                                                        spent_on date,
+                                                        status varchar2 NOT NULL DEFAULT 'pending',
+                                                        attempts INTEGER NOT NULL DEFAULT 0,
+                                                        next_attempt timestamp,
+                                                        last_error TEXT,
+                                                        sent_at timestamp)""")
+            self.execute("CREATE INDEX idx_redmine_outbox_due ON redmine_outbox(status, next_attempt)")
+
+        if version < 16:
+            # redmine issues kept locally with a full text index, the issue
+            # search no longer goes to the server
+            self.__create_redmine_issues()
+
+        if version < 17:
+            # id of the redmine time entry a fact has been sent as, for the
+            # sync to tell what is in redmine already
+            self.execute("ALTER TABLE redmine_outbox ADD COLUMN time_entry_id INTEGER")
+            self.execute("CREATE INDEX idx_redmine_outbox_entry ON redmine_outbox(time_entry_id)")
 
 
         # at the happy end, update version number
@@ -1026,3 +1622,9 @@ class Storage(storage.Storage):
                 trophies.unlock("oldtimer")
 
         self.end_transaction()
+
+        self.__fts_module = self.__get_fts_module()
+        self.__issue_fts_module = self.__get_fts_module("redmine_issue_index")
+        self.__interval_index = self.fetchone("SELECT count(*) FROM sqlite_master WHERE name = 'fact_intervals'")[0] > 0
+        self.__track_changes(self.connection)
+        self.execute("DELETE FROM changes") # the upgrades do not count
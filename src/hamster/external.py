@@ -19,6 +19,9 @@
 # along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import time
+import bisect
+import threading
 from configuration import conf
 import gobject
 import dbus, dbus.mainloop.glib
@@ -29,82 +32,176 @@ try:
 except:
     evolution = None
 
+
+REFRESH_INTERVAL = 5 * 60 # seconds tasks are served from cache before being fetched again
+
+
 class ActivitiesSource(gobject.GObject):
     def __init__(self):
         gobject.GObject.__init__(self)
         self.source = conf.get("activities_source")
-        self.__gtg_connection = None
 
         if self.source == "evo" and not evolution:
-            self.source == "" # on failure pretend that there is no evolution
-        elif self.source == "gtg":
-            gobject.GObject.__init__(self)
-            dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+            self.source = "" # on failure pretend that there is no evolution
+
+        self.tasks = get_task_cache(self.source)
 
     def get_activities(self, query = None):
-        if not self.source:
+        """activities starting with query. answered from the cache, so this
+        costs next to nothing however long the task list"""
+        if not self.tasks:
             return []
+        return self.tasks.find(query)
 
-        if self.source == "evo":
-            return [activity for activity in get_eds_tasks()
-                         if query is None or activity['name'].startswith(query)]
 
-        elif self.source == "gtg":
-            conn = self.__get_gtg_connection()
-            if not conn:
-                return []
+_task_caches = {}
 
-            activities = []
+def get_task_cache(source):
+    """task caches are shared by all the activity sources in the process"""
+    if source not in _task_caches:
+        if source == "evo":
+            _task_caches[source] = EDSTasks()
+        elif source == "gtg":
+            _task_caches[source] = GTGTasks()
+        else:
+            return None
+    return _task_caches[source]
 
-            tasks = []
-            try:
-                tasks = conn.GetTasks()
-            except dbus.exceptions.DBusException:  #TODO too lame to figure out how to connect to the disconnect signal
-                self.__gtg_connection = None
-                return self.get_activities(query) # reconnect
 
+class TaskCache(object):
+    """tasks of an external source, kept sorted by lowercase name so that a
+    prefix lookup is a bisect and a short walk. lookups are answered right
+    away from what is there, and when it has gone stale a refresh is started
+    in the background that replaces it once done"""
+    def __init__(self):
+        self.keys, self.tasks = [], []
+        self.fetched = None
+        self.refreshing = False
+
+    def find(self, query = None):
+        if not self.refreshing and (self.fetched is None or time.time() - self.fetched > REFRESH_INTERVAL):
+            self.refreshing = True
+            self._fetch()
+
+        if not query:
+            return list(self.tasks)
+
+        query = query.lower()
+        res = []
+        for i in range(bisect.bisect_left(self.keys, query), len(self.keys)):
+            if not self.keys[i].startswith(query):
+                break
+            res.append(self.tasks[i])
+        return res
+
+    def expire(self):
+        """next lookup will ask the source again"""
+        self.fetched = None
+
+    def _fetch(self):
+        """gets the tasks without blocking and hands them to _store"""
+        raise NotImplementedError
+
+    def _store(self, tasks):
+        """tasks are (key, activity) pairs"""
+        tasks = sorted(tasks, key = lambda task: task[0])
+        self.keys = [key for key, activity in tasks]
+        self.tasks = [activity for key, activity in tasks]
+        self.fetched = time.time()
+        self.refreshing = False
+
+    def _failed(self, error):
+        # keep serving what we had, try again after the interval
+        logging.warn(error)
+        self.fetched = time.time()
+        self.refreshing = False
+
+
+class EDSTasks(TaskCache):
+    def __init__(self):
+        TaskCache.__init__(self)
+        # evolution is read in a thread, a big task list would hold up
+        # the typing otherwise
+        gobject.threads_init()
+
+    def _fetch(self):
+        thread = threading.Thread(target = self._scan)
+        thread.daemon = True
+        thread.start()
+
+    def _scan(self):
+        try:
+            sources = list(ecal.list_task_sources())
+        except Exception, e:
+            gobject.idle_add(self._failed, e)
+            return
 
-            for task in tasks:
-                if query is None or task['title'].lower().startswith(query):
-                    name = task['title']
-                    if len(task['tags']):
-                        name = "%s, %s" % (name, " ".join([tag.replace("@", "#") for tag in task['tags']]))
+        if not sources:
+            # BUG - http://bugzilla.gnome.org/show_bug.cgi?id=546825
+            sources = [('default', 'default')]
 
-                    activities.append({"name": name,
-                                       "category": ""})
+        tasks = []
+        for category, uri in sources:
+            tasks.extend(get_eds_source_tasks(category, uri))
+        gobject.idle_add(self._store, [((task['name'] or "").lower(), task) for task in tasks])
 
-            return activities
 
-    def __get_gtg_connection(self):
-        bus = dbus.SessionBus()
-        if self.__gtg_connection and bus.name_has_owner("org.gnome.GTG"):
-            return self.__gtg_connection
+class GTGTasks(TaskCache):
+    def __init__(self):
+        TaskCache.__init__(self)
+        self.__connection = None
 
-        if bus.name_has_owner("org.gnome.GTG"):
-            self.__gtg_connection = dbus.Interface(bus.get_object('org.gnome.GTG', '/org/gnome/GTG'),
-                                                   dbus_interface='org.gnome.GTG')
-            return self.__gtg_connection
-        else:
-            return None
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        self.bus = dbus.SessionBus()
+        # gtg coming and going is all the notification we get
+        self.bus.add_signal_receiver(self._on_owner_changed, 'NameOwnerChanged',
+                                     'org.freedesktop.DBus', arg0='org.gnome.GTG')
 
+    def _on_owner_changed(self, name, old, new):
+        self.__connection = None
+        self.expire()
 
+    def _fetch(self):
+        conn = self.__get_connection()
+        if not conn:
+            self._store([])
+            return
 
-def get_eds_tasks():
-    try:
-        sources = ecal.list_task_sources()
-        tasks = []
-        if not sources:
-            # BUG - http://bugzilla.gnome.org/show_bug.cgi?id=546825
-            sources = [('default', 'default')]
+        conn.GetTasks(reply_handler = self._on_tasks, error_handler = self._on_error)
+
+    def _on_tasks(self, tasks):
+        res = []
+        for task in tasks:
+            name = task['title']
+            if len(task['tags']):
+                name = "%s, %s" % (name, " ".join([tag.replace("@", "#") for tag in task['tags']]))
 
-        for source in sources:
-            category = source[0]
+            res.append((task['title'].lower(), {"name": name, "category": ""}))
+        self._store(res)
 
-            data = ecal.open_calendar_source(source[1], ecal.CAL_SOURCE_TYPE_TODO)
-            if data:
-                for task in data.get_all_objects():
-                    if task.get_status() in [ecal.ICAL_STATUS_NONE, ecal.ICAL_STATUS_INPROCESS]:
-                        tasks.append({'name': task.get_summary(), 'category' : category})
+    def _on_error(self, error):
+        self.__connection = None
+        self._failed(error)
+
+    def __get_connection(self):
+        if self.__connection:
+            return self.__connection
+
+        if self.bus.name_has_owner("org.gnome.GTG"):
+            self.__connection = dbus.Interface(self.bus.get_object('org.gnome.GTG', '/org/gnome/GTG'),
+                                               dbus_interface='org.gnome.GTG')
+        return self.__connection
+
+
+
+def get_eds_source_tasks(category, uri):
+    try:
+        tasks = []
+        data = ecal.open_calendar_source(uri, ecal.CAL_SOURCE_TYPE_TODO)
+        if data:
+            for task in data.get_all_objects():
+                if task.get_status() in [ecal.ICAL_STATUS_NONE, ecal.ICAL_STATUS_INPROCESS]:
+                    tasks.append({'name': task.get_summary(), 'category' : category})
         return tasks
     except Exception, e:
         logging.warn(e)
@@ -0,0 +1,169 @@
+# - coding: utf-8 -
+
+# This file is part of Project Hamster.
+
+# Project Hamster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Project Hamster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
+
+"""reads back the tsv, xml and ical files that reports write out.
+the files are read as a stream, facts come out one by one so that exports
+of any size can be fed to the storage in batches"""
+
+import csv
+import datetime as dt
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+from lib import Fact, RedmineFact
+
+FORMATS = ("tsv", "xml", "ical")
+
+
+def read(path, format, unsorted = "Unsorted"):
+    """returns an iterator over facts in the file. category named `unsorted`
+    is what reports write for facts without one"""
+    if format == "tsv":
+        reader = TSVReader(unsorted)
+    elif format == "xml":
+        reader = XMLReader(unsorted)
+    elif format == "ical":
+        reader = ICalReader(unsorted)
+    else:
+        raise ValueError("don't know how to import %s" % format)
+
+    return reader.read(path)
+
+
+class FactReader(object):
+    # where the year, month, day, hour, minute and second are in the
+    # datetime strings. strptime is way too slow for a few hundred thousand
+    # of them, it is left for anything that does not fit
+    datetime_slices = ((0, 4), (5, 7), (8, 10), (11, 13), (14, 16), (17, 19))
+
+    def __init__(self, unsorted = "Unsorted", datetime_format = "%Y-%m-%d %H:%M:%S"):
+        self.unsorted = unsorted
+        self.datetime_format = datetime_format
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            for fact in self._read(f):
+                if fact:
+                    yield fact
+
+    def _read(self, f):
+        raise NotImplementedError
+
+    def _fact(self, activity, start_time, end_time = None, category = None,
+              description = None, tags = None, redmine_issue = None, redmine_activity = None):
+        """builds fact out of the strings found in the file. returns None for
+        what does not look like a fact"""
+        activity = self._decode(activity)
+        start_time = self._datetime(start_time)
+        if not activity or not start_time:
+            return None
+
+        category = self._decode(category)
+        if not category or category == self.unsorted:
+            category = None
+
+        tags = [tag.strip() for tag in self._decode(tags).split(",") if tag.strip()]
+
+        fields = dict(category = category,
+                      description = self._decode(description),
+                      tags = tags,
+                      start_time = start_time,
+                      end_time = self._datetime(end_time))
+
+        redmine_issue, redmine_activity = self._int(redmine_issue), self._int(redmine_activity)
+        if redmine_issue != -1:
+            return RedmineFact.from_row(activity, redmine_issue, redmine_activity, **fields)
+        return Fact.from_row(activity, **fields)
+
+    def _decode(self, value):
+        if not value:
+            return u""
+        if isinstance(value, unicode):
+            return value.strip()
+        return value.decode("utf-8").strip()
+
+    def _datetime(self, value):
+        try:
+            value = value.strip()
+            if len(value) == self.datetime_slices[-1][1]:
+                try:
+                    return dt.datetime(*[int(value[start:end]) for start, end in self.datetime_slices])
+                except ValueError:
+                    pass
+            return dt.datetime.strptime(value, self.datetime_format)
+        except (ValueError, AttributeError):
+            return None
+
+    def _int(self, value):
+        try:
+            return int(value)
+        except (ValueError, TypeError):
+            return -1
+
+
+class TSVReader(FactReader):
+    def _read(self, f):
+        rows = csv.reader(f, dialect = 'excel-tab')
+        rows.next() # headers
+        for row in rows:
+            if len(row) < 7:
+                continue
+
+            # exports of before redmine end with tags
+            row = row + [None] * (9 - len(row))
+            activity, start_time, end_time, duration, category, description, tags, redmine_issue, redmine_activity = row[:9]
+            yield self._fact(activity, start_time, end_time, category, description, tags, redmine_issue, redmine_activity)
+
+
+class XMLReader(FactReader):
+    def _read(self, f):
+        # iterparse with clearing keeps just the current element in memory
+        for event, element in ElementTree.iterparse(f):
+            if element.tag != "activity":
+                continue
+
+            get = element.get
+            yield self._fact(get("name"), get("start_time"), get("end_time"), get("category"),
+                             get("description"), get("tags"), get("redmine_issue"), get("redmine_activity"))
+            element.clear()
+
+
+class ICalReader(FactReader):
+    datetime_slices = ((0, 4), (4, 6), (6, 8), (9, 11), (11, 13), (13, 15))
+
+    def __init__(self, unsorted = "Unsorted"):
+        FactReader.__init__(self, unsorted, datetime_format = "%Y%m%dT%H%M%S")
+
+    def _read(self, f):
+        event = None
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line == "BEGIN:VEVENT":
+                event = {}
+            elif line == "END:VEVENT" and event is not None:
+                category = event.get("CATEGORIES")
+                if category == "None":
+                    category = None # what exports of before wrote for unsorted facts
+                yield self._fact(event.get("SUMMARY"), event.get("DTSTART"), event.get("DTEND"),
+                                 category, event.get("DESCRIPTION"), None,
+                                 event.get("REDMINEISSUE"), event.get("REDMINEACTIVITY"))
+                event = None
+            elif event is not None and ":" in line:
+                key, value = line.split(":", 1)
+                event[key] = value
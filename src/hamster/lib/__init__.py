@@ -29,6 +29,12 @@ def figure_time(str_time):
 
 
 class Fact(object):
+    # there can be many thousands of facts loaded at once, slots save
+    # the per-instance dict
+    __slots__ = ("original_activity", "activity", "category", "description",
+                 "tags", "start_time", "end_time", "id", "ponies", "delta",
+                 "date", "activity_id")
+
     def __init__(self, activity, category = "", description = "", tags = "",
                  start_time = None, end_time = None, id = None, delta = None,
                  date = None, activity_id = None):
@@ -104,6 +110,38 @@ class Fact(object):
         self.end_time = end_time or self.end_time or None
 
 
+    @classmethod
+    def from_row(cls, activity, category = None, description = None, tags = None,
+                 start_time = None, end_time = None, id = None, delta = None,
+                 date = None, activity_id = None):
+        """builds the fact from fields that are already separated, as they
+        come from the storage. skips the parsing that __init__ does, which is
+        needed only for what the user has typed in"""
+        fact = cls.__new__(cls)
+        fact.original_activity = activity
+        fact.activity = activity
+        fact.category = category or None
+        fact.description = description or None
+        fact.tags = list(tags or [])
+        fact.start_time = start_time
+        fact.end_time = end_time
+        fact.id = id
+        fact.ponies = False
+        fact.delta = delta
+        fact.date = date
+        fact.activity_id = activity_id
+        return fact
+
+    def copy(self):
+        """fact of its own with the same fields, changing one leaves the
+        other be"""
+        fact = self.__class__.__new__(self.__class__)
+        for cls in self.__class__.__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                setattr(fact, name, getattr(self, name))
+        fact.tags = list(self.tags)
+        return fact
+
     def __iter__(self):
         keys = {
             'id': int(self.id) if self.id else "",
@@ -140,10 +178,19 @@ class Fact(object):
 
 # A fact extended with Redmine additional information
 class RedmineFact(Fact):
+     __slots__ = ("redmine_issue_id", "redmine_time_activity_id")
+
      def __init__(self, activity,  redmine_issue_id, redmine_time_activity_id, category = "", description = "", tags = "", start_time = None, end_time = None, id = None, delta = None, date = None, activity_id = None):
             Fact.__init__(self, activity, category, description, tags, start_time, end_time, id, delta, date, activity_id)
             self.redmine_issue_id = redmine_issue_id
             self.redmine_time_activity_id = redmine_time_activity_id
+
+     @classmethod
+     def from_row(cls, activity, redmine_issue_id, redmine_time_activity_id, **kwargs):
+            fact = super(RedmineFact, cls).from_row(activity, **kwargs)
+            fact.redmine_issue_id = redmine_issue_id
+            fact.redmine_time_activity_id = redmine_time_activity_id
+            return fact
   
      def __iter__(self):
            keys = {
@@ -25,7 +25,8 @@ import gobject
 
 from hamster import idle
 from hamster.configuration import conf
-from hamster.lib import trophies
+from hamster.lib import trophies, stuff
+from hamster.lib.scheduler import Scheduler, next_step, next_day_start
 import dbus
 
 
@@ -45,47 +46,72 @@ class DesktopIntegrations(object):
         self.idle_listener = idle.DbusIdleListener()
         self.idle_listener.connect('idle-changed', self.on_idle_changed)
 
-        gobject.timeout_add_seconds(60, self.check_hamster)
+        # today's facts are kept here and asked for again only when they
+        # change. the notifications and trophies get a timer for when they
+        # are due next
+        self.todays_facts = []
+        self.scheduler = Scheduler()
+        self.load_facts()
 
 
-    def check_hamster(self):
-        """refresh hamster every x secs - load today, check last activity etc."""
+    def load_facts(self):
         try:
             # can't use the client because then we end up in a dbus loop
             # as this is initiated in storage
-            todays_facts = self.storage._Storage__get_todays_facts()
-            self.check_user(todays_facts)
-            trophies.check_ongoing(todays_facts)
+            self.todays_facts = self.storage._Storage__get_todays_facts()
         except Exception, e:
             logging.error("Error while refreshing: %s" % e)
-        finally:  # we want to go on no matter what, so in case of any error we find out about it sooner
-            return True
+        self.schedule()
 
+    def on_facts_changed(self):
+        self.load_facts()
 
-    def check_user(self, todays_facts):
-        """check if we need to notify user perhaps"""
-        interval = self.conf_notify_interval
-        if interval <= 0 or interval >= 121:
-            return
-
-        now = dt.datetime.now()
-        message = None
-
-        last_activity = todays_facts[-1] if todays_facts else None
 
-        # update duration of current task
+    def running_fact(self):
+        last_activity = self.todays_facts[-1] if self.todays_facts else None
         if last_activity and not last_activity['end_time']:
-            delta = now - last_activity['start_time']
-            duration = delta.seconds /  60
+            return last_activity
+        return None
 
-            if duration and duration % interval == 0:
-                message = _(u"Working on %s") % last_activity['name']
-                self.notify_user(message)
+    def schedule(self):
+        now = dt.datetime.now()
+        running = self.running_fact()
+
+        # a new day brings new facts
+        self.scheduler.at("day", next_day_start(now, conf.get("day_start_minutes")), self.load_facts)
 
+        notify_at = None
+        interval = self.conf_notify_interval
+        if 0 < interval < 121:
+            if running:
+                # every interval minutes into the current task
+                notify_at = next_step(running['start_time'], dt.timedelta(minutes = interval), now)
+            elif self.conf_notify_on_idle:
+                # if we have no last activity, let's just calculate duration from 00:00
+                midnight = dt.datetime.combine(now.date(), dt.time())
+                notify_at = next_step(midnight, dt.timedelta(minutes = interval), now)
+        self.scheduler.at("notify", notify_at, self.check_user)
+
+        trophies_at = None
+        if trophies.storage and running:
+            total = stuff.duration_minutes([now - fact['start_time'] if fact is running else fact['delta']
+                                            for fact in self.todays_facts])
+            trophies_at = trophies.next_ongoing(running['start_time'], total, now)
+        self.scheduler.at("trophies", trophies_at, self.check_trophies)
+
+
+    def check_user(self):
+        """notify user, now that it is time to"""
+        running = self.running_fact()
+        if running:
+            self.notify_user(_(u"Working on %s") % running['name'])
         elif self.conf_notify_on_idle:
-            #if we have no last activity, let's just calculate duration from 00:00
-            if (now.minute + now.hour * 60) % interval == 0:
-                self.notify_user(_(u"No activity"))
+            self.notify_user(_(u"No activity"))
+        self.schedule()
+
+    def check_trophies(self):
+        trophies.check_ongoing(self.todays_facts)
+        self.schedule()
 
 
     def notify_user(self, summary="", details=""):
@@ -117,3 +143,6 @@ class DesktopIntegrations(object):
     def on_conf_changed(self, event, key, value):
         if hasattr(self, "conf_%s" % key):
             setattr(self, "conf_%s" % key, value)
+            self.schedule()
+        elif key == "day_start_minutes":
+            self.load_facts()
@@ -0,0 +1,102 @@
+# - coding: utf-8 -
+
+# This file is part of Project Hamster.
+
+# Project Hamster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Project Hamster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
+
+"""one shot timers for the moment something is due next, in place of
+waking up every minute to see whether it is"""
+
+import datetime as dt
+import logging
+
+try:
+    import gobject
+except ImportError:
+    gobject = None # only the timers need it
+
+
+def next_step(start, step, now):
+    """first moment after now that is a whole number of steps past start"""
+    if now < start:
+        return start
+    steps = int((now - start).total_seconds() // step.total_seconds()) + 1
+    return start + steps * step
+
+
+def next_day_start(now, day_start_minutes):
+    """when the next hamster day begins"""
+    day_start = dt.time(day_start_minutes / 60, day_start_minutes % 60)
+    today = (now - dt.timedelta(hours = day_start.hour, minutes = day_start.minute)).date()
+    return dt.datetime.combine(today + dt.timedelta(days = 1), day_start)
+
+
+class Scheduler(object):
+    """calls back at the given times, keeping one timeout for the earliest
+    of them. timeouts go by the monotonic clock, so a long one is cut into
+    max_sleep bits to stay on time with the wall clock across a suspend"""
+    max_sleep = 15 * 60
+
+    def __init__(self):
+        self._due = {} # key -> (time, callback, args)
+        self._timeout = None
+        self._wakeup = None
+
+    def at(self, key, when, callback, *args):
+        """calls callback(*args) at when, in place of whatever was due under
+        the key. no when just cancels"""
+        if when:
+            self._due[key] = (when, callback, args)
+        else:
+            self._due.pop(key, None)
+        self._schedule()
+
+    def cancel(self, key):
+        self.at(key, None, None)
+
+    def clear(self):
+        self._due = {}
+        self._schedule()
+
+    def _schedule(self, now = None):
+        wakeup = min([when for when, callback, args in self._due.values()] or [None])
+        if wakeup == self._wakeup and self._timeout:
+            return
+
+        if self._timeout:
+            gobject.source_remove(self._timeout)
+            self._timeout = None
+
+        self._wakeup = wakeup
+        if wakeup:
+            now = now or dt.datetime.now()
+            # rounded up, whole seconds let glib group the wakeups
+            seconds = int(min(max((wakeup - now).total_seconds(), 0), self.max_sleep) + 0.999)
+            self._timeout = gobject.timeout_add_seconds(seconds, self._on_timeout)
+
+    def _on_timeout(self):
+        self._timeout = None
+        now = dt.datetime.now()
+        due = sorted([(when, key) for key, (when, callback, args) in self._due.items() if when <= now])
+        for when, key in due:
+            # the callback might have set something new under the key already
+            if key in self._due and self._due[key][0] == when:
+                when, callback, args = self._due.pop(key)
+                try:
+                    callback(*args)
+                except Exception, e:
+                    logging.error("Error in %s: %s" % (key, e))
+
+        self._schedule(now)
+        return False
@@ -0,0 +1,69 @@
+# - coding: utf-8 -
+
+# This file is part of Project Hamster.
+
+# Project Hamster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Project Hamster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
+
+"""bookkeeping of the activity suggestions, so that typing on narrows down
+what has been fetched already instead of asking the storage every time"""
+
+
+def narrow(activities, key):
+    """activities that have the key in their name, the ones starting
+    with it go first. otherwise the order is kept"""
+    starting, containing = [], []
+    for activity in activities:
+        name = activity['name'].lower()
+        if name.startswith(key):
+            starting.append(activity)
+        elif key in name:
+            containing.append(activity)
+    return starting + containing
+
+
+class Candidates(object):
+    """activities fetched for the search in key. replies to anything but
+    the latest request are dropped"""
+    def __init__(self, limit = 50):
+        self.limit = limit # storage does not return more than that
+        self.activities = None
+        self.key = None
+        self.serial = 0
+
+    def reset(self):
+        self.activities, self.key = None, None
+
+    def covers(self, key):
+        """whether the fetched activities can be narrowed down to the key"""
+        return self.activities is not None and key.startswith(self.key)
+
+    def complete(self, key):
+        """whether the fetched activities hold all there is for the key"""
+        return self.covers(key) and len(self.activities) < self.limit
+
+    def request(self):
+        """serial of a new request, any earlier one is not wanted anymore"""
+        self.serial += 1
+        return self.serial
+
+    def cancel(self):
+        self.serial += 1
+
+    def receive(self, serial, key, activities):
+        """takes the reply of a request. returns False if it has been
+        outdated meanwhile"""
+        if serial != self.serial:
+            return False
+        self.activities, self.key = activities, key
+        return True
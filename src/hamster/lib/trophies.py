@@ -31,7 +31,6 @@ except:
     storage = None
 
 from ..lib import Fact
-import stuff
 import datetime as dt
 
 def unlock(achievement_id):
@@ -49,32 +48,45 @@ def increment(counter_id, context = ""):
 
 
 def check_ongoing(todays_facts):
+    """todays_facts are the rows of the storage, as the service has them"""
     if not storage or not todays_facts: return
 
     last_activity = None
-    if todays_facts[-1].end_time is None:
+    if todays_facts[-1]['end_time'] is None:
         last_activity = todays_facts[-1]
-        last_activity.delta = dt.datetime.now() - last_activity.start_time
+        last_activity['delta'] = dt.datetime.now() - last_activity['start_time']
 
     # overwhelmed: tracking for more than 16 hours during one day
-    total = stuff.duration_minutes([fact.delta for fact in todays_facts])
-    if total > 16 * 60:
+    total = sum([fact['delta'] for fact in todays_facts], dt.timedelta())
+    if total > dt.timedelta(hours = 16):
         unlock("overwhelmed")
 
     if last_activity:
         # Welcome! – track an activity for 10 minutes
-        if last_activity.delta >= dt.timedelta(minutes = 10):
+        if last_activity['delta'] >= dt.timedelta(minutes = 10):
             unlock("welcome")
 
         # in_the_zone - spend 6 hours non-stop on an activity
-        if last_activity.delta >= dt.timedelta(hours = 6):
+        if last_activity['delta'] >= dt.timedelta(hours = 6):
             unlock("in_the_zone")
 
         # insomnia - meet the new day while tracking an activity
-        if last_activity.start_time.date() != dt.date.today():
+        if last_activity['start_time'].date() != dt.date.today():
             unlock("insomnia")
 
 
+def next_ongoing(start_time, total_minutes, now):
+    """when check_ongoing will have something new to go by, for the activity
+    going on since start_time and total minutes tracked today. None if it
+    will not"""
+    deadlines = [start_time + dt.timedelta(minutes = 10), # welcome
+                 start_time + dt.timedelta(hours = 6), # in_the_zone
+                 dt.datetime.combine(start_time.date() + dt.timedelta(days = 1), dt.time()), # insomnia
+                 now + dt.timedelta(minutes = 16 * 60 + 1 - total_minutes)] # overwhelmed
+    deadlines = [deadline for deadline in deadlines if deadline > now]
+    return min(deadlines) if deadlines else None
+
+
 class Checker(object):
     def __init__(self):
         # use runtime flags where practical
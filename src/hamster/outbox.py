@@ -0,0 +1,142 @@
+# - coding: utf-8 -
+
+# This file is part of Project Hamster.
+
+# Project Hamster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Project Hamster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
+
+"""time entries for redmine go through an outbox in the database, so that
+stopping an activity never waits for the network and nothing gets lost while
+redmine is away. the outbox is emptied in the background"""
+
+import logging
+import threading
+import datetime as dt
+
+try:
+    import gobject
+except ImportError:
+    gobject = None # only the background rounds need it
+
+import redmine
+
+
+class TimeEntryOutbox(object):
+    batch = 20 # entries sent per round, over the one connection
+    interval = 60 # seconds between the rounds
+
+    # seconds to wait before trying again, after the first, second, ... failure
+    backoff = (60, 5 * 60, 15 * 60, 60 * 60, 6 * 60 * 60)
+
+    def __init__(self, storage, get_connector):
+        """get_connector returns the redmine connector to send with, or None
+        while redmine integration is off"""
+        self.storage = storage
+        self.get_connector = get_connector
+        self._sending = False
+        self._timeout = None
+
+    def flush(self, now = None):
+        """sends the entries that are due right away. returns how many
+        made it"""
+        connector = self.get_connector()
+        if not connector:
+            return 0
+
+        entries = [dict(entry) for entry in self.storage.get_due_time_entries(now, self.batch)]
+        return self._record(self._send(connector, entries), now)
+
+    def start(self):
+        """starts sending in the background every interval"""
+        if not self._timeout:
+            self._timeout = gobject.timeout_add_seconds(self.interval, self._on_timeout)
+
+    def stop(self):
+        if self._timeout:
+            gobject.source_remove(self._timeout)
+            self._timeout = None
+
+    def wake(self):
+        """sends what is due now rather than on the next round"""
+        gobject.idle_add(self._round)
+
+    def _on_timeout(self):
+        self._round()
+        return True
+
+    def _round(self):
+        if self._sending:
+            return False # the next round will pick up whatever is left
+
+        connector = self.get_connector()
+        if not connector:
+            return False
+
+        entries = [dict(entry) for entry in self.storage.get_due_time_entries(None, self.batch)]
+        if not entries:
+            return False
+
+        # the network bit goes to a thread, the storage stays with the main loop
+        def send():
+            try:
+                results = self._send(connector, entries)
+            except Exception, e:
+                logging.warn(e)
+                results = [(entry, str(e), True) for entry in entries]
+            gobject.idle_add(self._on_sent, results)
+
+        self._sending = True
+        thread = threading.Thread(target = send)
+        thread.daemon = True
+        thread.start()
+        return False
+
+    def _on_sent(self, results):
+        self._sending = False
+        sent = self._record(results)
+        if sent == self.batch:
+            self.wake() # there might be more waiting
+        return False
+
+    def _send(self, connector, entries):
+        """posts the entries. returns (entry, error, retry) for each one
+        that has been tried"""
+        results = []
+        for i, entry in enumerate(entries):
+            try:
+                entry["time_entry_id"] = connector.add_time_entry(entry["issue_id"], entry["hours"], entry["activity_id"],
+                                                                  entry["comments"], entry["spent_on"])
+                results.append((entry, None, False))
+            except redmine.RedmineActionException, e:
+                # redmine does not take it, no point in asking again
+                results.append((entry, str(e), False))
+            except redmine.RedmineConnectionException, e:
+                # redmine is away, the rest of the batch waits along
+                results.extend([(waiting, str(e), True) for waiting in entries[i:]])
+                break
+        return results
+
+    def _record(self, results, now = None):
+        now = now or dt.datetime.now()
+        sent = 0
+        for entry, error, retry in results:
+            if not error:
+                self.storage.time_entry_sent(entry["fact_id"], entry.get("time_entry_id"))
+                sent += 1
+            elif retry:
+                delay = self.backoff[min(entry["attempts"], len(self.backoff) - 1)]
+                self.storage.time_entry_failed(entry["fact_id"], error, now + dt.timedelta(seconds = delay))
+            else:
+                logging.warn("time entry of fact %d rejected: %s", entry["fact_id"], error)
+                self.storage.time_entry_failed(entry["fact_id"], error)
+        return sent
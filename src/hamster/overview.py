@@ -76,7 +76,7 @@ class Overview(gtk.Object):
 
         self.external_listeners = [
             (runtime.storage, runtime.storage.connect('activities-changed',self.after_activity_update)),
-            (runtime.storage, runtime.storage.connect('facts-changed',self.after_activity_update)),
+            (runtime.storage, runtime.storage.connect('facts-changed-detailed',self.after_fact_update)),
             (conf, conf.connect('conf-changed', self.on_conf_change))
         ]
         self.show()
@@ -203,6 +203,11 @@ class Overview(gtk.Object):
     def after_activity_update(self, widget):
         self.search()
 
+    def after_fact_update(self, widget, ids, start_date, end_date):
+        # only if the change touches the days we are looking at
+        if not start_date or (start_date <= self.end_date and end_date >= self.start_date):
+            self.search()
+
 
     def on_search_icon_press(self, widget, position, data):
         if position == gtk.ENTRY_ICON_SECONDARY:
@@ -17,9 +17,16 @@
 # You should have received a copy of the GNU General Public License
 # along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import sys
 import httplib
+import socket
 import json
+import time
+import hashlib
+import logging
 import datetime
+import threading
 import urlparse
 
 class RedmineConnectionException(Exception):
@@ -34,9 +41,30 @@ class RedmineActionException(Exception):
   def __str__(self):
     return repr(self.value)
 
+_connectors = {}
+
+def get_connector(url, key, cache_dir = None):
+  """connector shared by everyone talking to the same server with the same
+  key, so that they share its connection and cached responses. with
+  cache_dir the responses are kept on disk between the runs too"""
+  if (url, key) not in _connectors:
+    cache_path = None
+    if cache_dir:
+      cache_path = os.path.join(cache_dir, "redmine-%s.json" % hashlib.md5(url + key).hexdigest())
+    _connectors[(url, key)] = RedmineConnector(url, key, cache_path)
+  return _connectors[(url, key)]
+
 class RedmineConnector:
+  # seconds for which the responses are used without asking the server.
+  # past that they are revalidated with the etag / last modified they came with
+  user_ttl = 60 * 60
+  issues_ttl = 60
+  activities_ttl = 60 * 60
+
+  page_size = 100 # the most redmine gives out at once
+  page_workers = 4 # pages fetched side by side after the first one
   
-  def __init__(self, url, key):
+  def __init__(self, url, key, cache_path = None):
     parsed = urlparse.urlparse(url)
     self.server = parsed.hostname
     self.path = parsed.path
@@ -50,116 +78,290 @@ class RedmineConnector:
       else:
         self.port = 80
     self.apikey = key
-  
-  def get_current_user_id(self):
+
+    self.__connection = None # kept alive between the requests
+    self.__responses = {} # path -> cached response, see _get_json
+    self.__ids = {} # (collection, field) -> name to id lookup, rebuilt when the response changes
+    # the connector can be shared between threads, one request at a time
+    self.__lock = threading.RLock()
+
+    self.cache_path = cache_path
+    if cache_path:
+      self._load()
+
+  def _load(self):
+    try:
+      with open(self.cache_path) as f:
+        self.__responses = json.load(f)
+    except (IOError, ValueError) as e:
+      self.__responses = {}
+
+  def _save(self):
+    # written aside and moved over, so that a crash does not leave half a file
+    try:
+      if not os.path.isdir(os.path.dirname(self.cache_path)):
+        os.makedirs(os.path.dirname(self.cache_path))
+      with open(self.cache_path + ".tmp", "w") as f:
+        json.dump(self.__responses, f)
+      os.rename(self.cache_path + ".tmp", self.cache_path)
+    except (IOError, OSError) as e:
+      logging.warn(e)
+
+  def _connect(self):
     if self.scheme == "https":
-      conn = httplib.HTTPSConnection(self.server, self.port, timeout=10)
-    else:
-      conn = httplib.HTTPConnection(self.server, self.port, timeout=10)
-    conn.putrequest("GET", self.path + "users/current.json")
-    conn.putheader("X-Redmine-API-Key", self.apikey)
-    conn.endheaders()
-    conn.send("")
-    resp = conn.getresponse()
-    if resp.status == 200:
-      userdata = json.load(resp)
-      conn.close()
-      return userdata['user']['id']
+      return httplib.HTTPSConnection(self.server, self.port, timeout=10)
     else:
-      raise RedmineConnectionException("HTTP replied: " + str(resp.status) + " " + resp.reason)
+      return httplib.HTTPConnection(self.server, self.port, timeout=10)
+
+  def close(self):
+    if self.__connection:
+      self.__connection.close()
+      self.__connection = None
+
+  def forget(self):
+    """drops the cached responses"""
+    with self.__lock:
+      self.__responses, self.__ids = {}, {}
+
+  def _send(self, connection, method, path, body = None, headers = None):
+    headers = dict(headers or {})
+    headers["X-Redmine-API-Key"] = self.apikey
+    if body is not None:
+      headers["Content-Type"] = "application/json"
+
+    connection.request(method, self.path + path, body, headers)
+    resp = connection.getresponse()
+    return resp, resp.read()
+
+  def _request(self, method, path, body = None, headers = None):
+    """sends the request over the kept alive connection and returns the
+    response with its body read. a connection that the server has closed in
+    the meantime is replaced once"""
+    with self.__lock:
+      for attempt in range(2):
+        reused = self.__connection is not None
+        if not reused:
+          self.__connection = self._connect()
+        try:
+          resp, data = self._send(self.__connection, method, path, body, headers)
+        except (httplib.HTTPException, socket.error) as e:
+          self.close()
+          if reused and attempt == 0:
+            continue
+          raise RedmineConnectionException("Connection failed: " + str(e))
+
+        if resp.getheader("connection", "").lower() == "close":
+          self.close()
+        return resp, data
+
+  def _call(self, method, path, body = None, headers = None, connection = None):
+    """request over the given connection, or over the kept alive one
+    without. a connection that fails is closed, to be opened again by the
+    next request"""
+    if not connection:
+      return self._request(method, path, body, headers)
+    try:
+      return self._send(connection, method, path, body, headers)
+    except (httplib.HTTPException, socket.error) as e:
+      connection.close()
+      raise RedmineConnectionException("Connection failed: " + str(e))
+
+  def _get_json(self, path, ttl, connection = None, save = True):
+    """decoded response for the path. served from cache for ttl seconds,
+    after that revalidated with the server. given a connection of its own
+    the request goes over that one and does not wait for the others"""
+    with self.__lock:
+      cached = self.__responses.get(path)
+      if cached and time.time() - cached["fetched"] < ttl:
+        return cached["data"]
+
+    headers = {}
+    if cached and cached["etag"]:
+      headers["If-None-Match"] = cached["etag"]
+    if cached and cached["last_modified"]:
+      headers["If-Modified-Since"] = cached["last_modified"]
+
+    resp, data = self._call("GET", path, headers = headers, connection = connection)
+
+    with self.__lock:
+      if resp.status == 304 and cached:
+        cached["fetched"] = time.time()
+        return cached["data"]
+      elif resp.status == 200:
+        self._store(path, json.loads(data), resp.getheader("etag"), resp.getheader("last-modified"), save)
+        return self.__responses[path]["data"]
+      else:
+        raise RedmineConnectionException("HTTP replied: " + str(resp.status) + " " + resp.reason)
+
+  def _store(self, path, data, etag = None, last_modified = None, save = True):
+    with self.__lock:
+      self.__responses[path] = {"data": data,
+                                "etag": etag,
+                                "last_modified": last_modified,
+                                "fetched": time.time()}
+      if self.cache_path and save:
+        self._save()
+
+  def in_parallel(self, items, call, workers = None):
+    """calls call(item, connection) for each of the items, workers (or
+    page_workers) at a time, each worker over a connection of its own.
+    returns the results in the order of the items. the first exception
+    stops the workers and is raised as it was"""
+    results, errors = {}, []
+    pending = list(enumerate(items))
+    lock = threading.Lock()
+
+    def work():
+      connection = None
+      try:
+        connection = self._connect()
+        while True:
+          with lock:
+            if not pending or errors:
+              return
+            i, item = pending.pop(0)
+          results[i] = call(item, connection)
+      except Exception:
+        errors.append(sys.exc_info())
+      finally:
+        if connection:
+          connection.close()
+
+    threads = [threading.Thread(target = work) for i in range(min(workers or self.page_workers, len(pending)))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    if errors:
+      raise errors[0][0], errors[0][1], errors[0][2]
+    return [results[i] for i in range(len(items))]
+
+  def _page_path(self, path, offset):
+    return "%s%slimit=%d&offset=%d" % (path, "&" if "?" in path else "?", self.page_size, offset)
+
+  def _get_all(self, path, ttl, collection):
+    """all of the collection at the path. redmine hands it out a page at a
+    time - the first page tells how many there are in total and the rest
+    are fetched side by side. each page is revalidated on its own.
+    returns the items and the total count"""
+    first = self._get_json(self._page_path(path, 0), ttl, save = False)
+    total = first.get("total_count", len(first[collection]))
+    offsets = range(self.page_size, total, self.page_size)
+    pages = [first] + self.in_parallel(offsets,
+                                       lambda offset, connection: self._get_json(self._page_path(path, offset),
+                                                                                 ttl, connection, save = False))
+    return [item for page in pages for item in page[collection]], total
+
+  def _get_id(self, data, collection, field, name):
+    """looks up id of the item in the response that has the name in the field"""
+    with self.__lock:
+      ids = self.__ids.get((collection, field))
+      if not ids or ids[0] is not data:
+        # first one wins, as it did with the lists
+        lookup = {}
+        for item in reversed(data[collection]):
+          lookup[item[field]] = item['id']
+        ids = self.__ids[(collection, field)] = (data, lookup)
+      return ids[1].get(name)
+  
+  def get_current_user_id(self, ttl = None):
+    userdata = self._get_json("users/current.json", self.user_ttl if ttl is None else ttl)
+    return userdata['user']['id']
       
   def check_connection(self):
     try:
-      self.get_current_user_id()
+      self.get_current_user_id(ttl = 0)
       return True
     except RedmineConnectionException as e:
       return False
+
+  def _issues_path(self, user_id = None):
+    return "issues.json?assigned_to_id=" + str(user_id or self.get_current_user_id())
+
+  def _get_cached(self, path):
+    with self.__lock:
+      cached = self.__responses.get(path)
+      return cached["data"] if cached else None
+
+  def get_cached_issues(self):
+    """issues as they were last fetched, however long ago, without asking
+    the server. None if they have not been fetched yet"""
+    userdata = self._get_cached("users/current.json")
+    if not userdata:
+      return None
+    return self._get_cached(self._issues_path(userdata['user']['id']))
+
+  def get_cached_activities(self):
+    """same as get_cached_issues, for the time entry activities"""
+    return self._get_cached("enumerations/time_entry_activities.json")
       
   def get_issues(self):
-    userid = self.get_current_user_id()
-    if self.scheme == "https":
-      conn = httplib.HTTPSConnection(self.server, self.port, timeout=10)
-    else:
-      conn = httplib.HTTPConnection(self.server, self.port, timeout=10)
-    conn.putrequest("GET", self.path + "issues.json?assigned_to_id=" + str(userid))
-    conn.putheader("X-Redmine-API-Key", self.apikey)
-    conn.endheaders()
-    conn.send("")
-    resp = conn.getresponse()
-    if resp.status == 200:
-      issuelist = json.load(resp)
-      conn.close()
-      return issuelist
-    else:
-      raise RedmineConnectionException("HTTP replied: " + str(resp.status) + " " + resp.reason)
+    """all issues assigned to the user, fetched in pages"""
+    path = self._issues_path()
+    with self.__lock:
+      cached = self.__responses.get(path)
+      if cached and time.time() - cached["fetched"] < self.issues_ttl:
+        return cached["data"]
+
+    issues, total = self._get_all(path, self.issues_ttl, "issues")
+    with self.__lock:
+      if cached and cached["data"]["issues"] == issues:
+        # same as before, keeps the name lookup too
+        cached["fetched"] = time.time()
+        return cached["data"]
+    self._store(path, {"issues": issues, "total_count": total})
+    return self.__responses[path]["data"]
       
+  def get_time_entries(self, start_date, end_date):
+    """the user's time entries spent on between the dates, both included.
+    always asked from the server, unchanged pages come back as not modified"""
+    path = "time_entries.json?user_id=%s&from=%s&to=%s" % (self.get_current_user_id(),
+                                                           start_date.strftime('%Y-%m-%d'),
+                                                           end_date.strftime('%Y-%m-%d'))
+    return self._get_all(path, 0, "time_entries")[0]
+
   def get_arbitrary_issue_data(self, issue):
-    if self.scheme == "https":
-      conn = httplib.HTTPSConnection(self.server, self.port, timeout=10)
-    else:
-      conn = httplib.HTTPConnection(self.server, self.port, timeout=10)
-    conn.putrequest("GET", self.path + "issues/" + str(issue) + ".json")
-    conn.putheader("X-Redmine-API-Key", self.apikey)
-    conn.endheaders()
-    conn.send("")
-    resp = conn.getresponse()
+    resp, data = self._request("GET", "issues/" + str(issue) + ".json")
     if resp.status == 200:
-      issuedata = json.load(resp)
-      conn.close()
-      return issuedata
+      return json.loads(data)
     else:
       raise RedmineConnectionException("HTTP replied: " + str(resp.status) + " " + resp.reason)
 
-  def add_time_entry(self, issue, hours, activity, comments):
-    timeentryhash = {'time_entry' : {'issue_id' : issue, 'hours' : hours, 'activity_id' : activity, 'comments' : comments, 'spent_on' : datetime.date.today().strftime('%Y-%m-%d')}}
-    timeentryjson = json.dumps(timeentryhash)
-    if self.scheme == "https":
-      conn = httplib.HTTPSConnection(self.server, self.port, timeout=10)
-    else:
-      conn = httplib.HTTPConnection(self.server, self.port, timeout=10)
-    conn.putrequest("POST", self.path + "time_entries.json")
-    conn.putheader("X-Redmine-API-Key", self.apikey)
-    conn.putheader("Content-Type", "application/json")
-    conn.putheader("Content-Length", len(timeentryjson))
-    conn.endheaders()
-    conn.send(timeentryjson)
-    resp = conn.getresponse()
+  def _time_entry_json(self, issue, hours, activity, comments, spent_on):
+    spent_on = spent_on or datetime.date.today()
+    timeentryhash = {'time_entry' : {'issue_id' : issue, 'hours' : hours, 'activity_id' : activity, 'comments' : comments, 'spent_on' : spent_on.strftime('%Y-%m-%d')}}
+    return json.dumps(timeentryhash)
+
+  def add_time_entry(self, issue, hours, activity, comments, spent_on = None, connection = None):
+    """creates the time entry, returns its id"""
+    timeentryjson = self._time_entry_json(issue, hours, activity, comments, spent_on)
+    resp, data = self._call("POST", "time_entries.json", timeentryjson, connection = connection)
     if resp.status == 201:
-      conn.close()
-      return True
+      try:
+        return json.loads(data)['time_entry']['id']
+      except (ValueError, KeyError, TypeError):
+        return None
     elif resp.status == 422:
-      raise RedmineActionException("Error while adding the time entry: Unprocessable Entity: " + resp.read())
+      raise RedmineActionException("Error while adding the time entry: Unprocessable Entity: " + data)
     else:
       raise RedmineConnectionException("HTTP replied: " + str(resp.status) + " " + resp.reason)
-       
-  def get_activities(self):
-    userid = self.get_current_user_id()
-    if self.scheme == "https":
-      conn = httplib.HTTPSConnection(self.server, self.port, timeout=10)
-    else:
-      conn = httplib.HTTPConnection(self.server, self.port, timeout=10)
-    conn.putrequest("GET", self.path + "enumerations/time_entry_activities.json")
-    conn.putheader("X-Redmine-API-Key", self.apikey)
-    conn.endheaders()
-    conn.send("")
-    resp = conn.getresponse()
-    if resp.status == 200:
-      activitylist = json.load(resp)
-      conn.close()
-      return activitylist
+
+  def update_time_entry(self, entry_id, issue, hours, activity, comments, spent_on = None, connection = None):
+    timeentryjson = self._time_entry_json(issue, hours, activity, comments, spent_on)
+    resp, data = self._call("PUT", "time_entries/" + str(entry_id) + ".json", timeentryjson, connection = connection)
+    if resp.status in (200, 204):
+      return True
+    elif resp.status in (404, 422):
+      raise RedmineActionException("Error while updating the time entry: " + str(resp.status) + " " + resp.reason + ": " + data)
     else:
       raise RedmineConnectionException("HTTP replied: " + str(resp.status) + " " + resp.reason)
+       
+  def get_activities(self):
+    return self._get_json("enumerations/time_entry_activities.json", self.activities_ttl)
       
   def get_redmine_activity_id(self, name):
-    activities = self.get_activities()
-    for activity in activities['time_entry_activities']:
-      if activity['name'] == name:
-        return activity['id']
-    return None
+    return self._get_id(self.get_activities(), 'time_entry_activities', 'name', name)
     
   def get_redmine_issue_id(self, subject):
-    issues = self.get_issues()
-    for issue in issues['issues']:
-      if issue['subject'] == subject:
-        return issue['id']
-    return None
+    return self._get_id(self.get_issues(), 'issues', 'subject', subject)
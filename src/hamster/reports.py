@@ -22,7 +22,7 @@
 # along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
 import os, sys
 import datetime as dt
-from xml.dom.minidom import Document
+from xml.sax.saxutils import escape
 import csv
 import copy
 import itertools
@@ -45,7 +45,10 @@ from calendar import timegm
 from StringIO import StringIO
 
 def simple(facts, start_date, end_date, format, path = None):
-    facts = copy.deepcopy(facts) # dont want to do anything bad to the input
+    """facts can be a list or an iterator, tsv, xml and ical reports are
+    written out as the facts come in"""
+    if isinstance(facts, list):
+        facts = copy.deepcopy(facts) # dont want to do anything bad to the input
     report_path = stuff.locale_from_utf8(path)
 
     if format == "tsv":
@@ -72,6 +75,12 @@ def simple(facts, start_date, end_date, format, path = None):
     return writer
 
 
+def redmine_fields(fact):
+    """redmine issue and activity of the fact, -1 for plain facts"""
+    return {"redmine_issue_id": getattr(fact, "redmine_issue_id", -1),
+            "redmine_time_activity_id": getattr(fact, "redmine_time_activity_id", -1)}
+
+
 class ReportWriter(object):
     #a tiny bit better than repeating the code all the time
     def __init__(self, path = None, datetime_format = "%Y-%m-%d %H:%M:%S"):
@@ -96,7 +105,7 @@ class ReportWriter(object):
                     else:
                         fact.end_time = ""
 
-                fact.tags = ", ".join(fact.tags)
+                fact.tags = ", ".join(fact.tags).encode("utf-8")
 
                 self._write_fact(fact)
 
@@ -126,8 +135,7 @@ class ICalWriter(ReportWriter):
         if not fact.end_time: return
 
         if fact.category == _("Unsorted"):
-            fact.category = None
-            
+            fact.category = ""
 
         self.file.write("""BEGIN:VEVENT
 CATEGORIES:%(category)s
@@ -138,7 +146,7 @@ DESCRIPTION:%(description)s
 REDMINEISSUE:%(redmine_issue_id)s
 REDMINEACTIVITY:%(redmine_time_activity_id)s
 END:VEVENT
-""" % dict(fact))
+""" % dict(dict(fact), **redmine_fields(fact)))
 
     def _finish(self, facts):
         self.file.write("END:VCALENDAR\n")
@@ -175,33 +183,35 @@ class TSVWriter(ReportWriter):
                                   fact.delta,
                                   fact.category,
                                   fact.description,
-                                  fact.tags, fact.redmine_issue_id, fact.redmine_time_activity_id
+                                  fact.tags,
+                                  redmine_fields(fact)["redmine_issue_id"],
+                                  redmine_fields(fact)["redmine_time_activity_id"]
             ])
     def _finish(self, facts):
         pass
 
 class XMLWriter(ReportWriter):
+    """writes the activities out one by one as they come, in what
+    minidom would have made of them"""
     def __init__(self, path):
         ReportWriter.__init__(self, path)
-        self.doc = Document()
-        self.activity_list = self.doc.createElement("activities")
+        self.file.write('<?xml version="1.0" ?><activities>')
 
     def _write_fact(self, fact):
-        activity = self.doc.createElement("activity")
-        activity.setAttribute("name", fact.activity)
-        activity.setAttribute("start_time", fact.start_time)
-        activity.setAttribute("end_time", fact.end_time)
-        activity.setAttribute("duration_minutes", str(stuff.duration_minutes(fact.delta)))
-        activity.setAttribute("category", fact.category)
-        activity.setAttribute("description", fact.description)
-        activity.setAttribute("tags", fact.tags)
-        activity.setAttribute("redmine_issue", fact.redmine_issue_id)
-        activity.setAttribute("redmine_activity", fact.redmine_time_activity_id)
-        self.activity_list.appendChild(activity)
+        attributes = {"name": fact.activity,
+                      "start_time": fact.start_time,
+                      "end_time": fact.end_time,
+                      "duration_minutes": str(stuff.duration_minutes(fact.delta)),
+                      "category": fact.category,
+                      "description": fact.description,
+                      "tags": fact.tags,
+                      "redmine_issue": str(redmine_fields(fact)["redmine_issue_id"]),
+                      "redmine_activity": str(redmine_fields(fact)["redmine_time_activity_id"])}
+        self.file.write("<activity%s/>" % "".join([' %s="%s"' % (name, escape(value, {'"': "&quot;"}))
+                                                   for name, value in sorted(attributes.items())]))
 
     def _finish(self, facts):
-        self.doc.appendChild(self.activity_list)
-        self.file.write(self.doc.toxml())
+        self.file.write("</activities>")
 
 
 
@@ -255,6 +265,10 @@ class HTMLWriter(ReportWriter):
         return ""
 
 
+    def write_report(self, facts):
+        # the summary at the end needs all the facts at hand
+        ReportWriter.write_report(self, list(facts))
+
     def _write_fact(self, fact):
         # no having end time is fine
         end_time_str, end_time_iso_str = "", ""
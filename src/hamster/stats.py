@@ -38,6 +38,97 @@ from configuration import runtime, conf, load_ui_file
 
 from lib.i18n import C_
 
+
+class FactStats(object):
+    """what the statistics need to know of the facts, gathered in a single
+    go over them, so they can come straight off the cursor"""
+    split_minutes = 5 * 60 + 30 #the mystical hamster midnight
+
+    early_start, early_end = dt.time(5,0), dt.time(9,0)
+    late_start, late_end = dt.time(20,0), dt.time(5,0)
+
+    def __init__(self, facts):
+        self.count = 0
+        self.first, self.last, self.longest = None, None, None
+        self.early, self.late, self.short = 0, 0, 0
+        self.by_weekday, self.by_category = {}, {} # key -> [(start, end) of each day]
+
+        # facts come sorted by start, so holding on to a day at a time does
+        for date, date_facts in groupby(facts, lambda fact: fact.start_time.date()):
+            date_facts = list(date_facts)
+            for fact in date_facts:
+                self._add(fact)
+
+            weekday = (date_facts[0].start_time.weekday(),
+                       date_facts[0].start_time.strftime("%a"))
+            self._add_span(self.by_weekday, weekday, date_facts)
+
+            date_facts.sort(key = lambda fact: fact.category)
+            for category, category_facts in groupby(date_facts, lambda fact: fact.category):
+                self._add_span(self.by_category, category, category_facts)
+
+    def _add(self, fact):
+        self.count += 1
+        self.first = self.first or fact
+        self.last = fact
+        if not self.longest or fact.delta > self.longest.delta:
+            self.longest = fact
+
+        start_time = fact.start_time.time()
+        if self.early_start < start_time < self.early_end:
+            self.early += 1
+        if start_time > self.late_start or start_time < self.late_end:
+            self.late += 1
+        if fact.delta <= dt.timedelta(seconds = 60 * 15):
+            self.short += 1
+
+    def _add_span(self, spans, key, facts):
+        """earliest start and latest end of the facts in minutes, ends past
+        the hamster midnight go on over 24 hours"""
+        start_times, end_times = [], []
+        for fact in facts:
+            if not fact.end_time:
+                continue
+
+            start_time = fact.start_time.hour * 60 + fact.start_time.minute
+            end_time = fact.end_time.hour * 60 + fact.end_time.minute
+            if start_time < self.split_minutes:
+                start_time += 24 * 60
+            if end_time < start_time:
+                end_time += 24 * 60
+
+            start_times.append(start_time)
+            end_times.append(end_time)
+
+        if start_times:
+            spans.setdefault(key, []).append((min(start_times), max(end_times)))
+
+    def percent(self, count):
+        return round(count / float(self.count) * 100)
+
+    @staticmethod
+    def usual_spans(spans):
+        """(start, end) that fits most of the days for each key"""
+        res = {}
+        for key, key_spans in spans.iteritems():
+            n = len(key_spans)
+            # calculate mean and variance for starts and ends
+            means = (sum([span[0] for span in key_spans]) / n,
+                     sum([span[1] for span in key_spans]) / n)
+            variances = (sum([(span[0] - means[0]) ** 2 for span in key_spans]) / n,
+                         sum([(span[1] - means[1]) ** 2 for span in key_spans]) / n)
+
+            # In the normal distribution, the range from
+            # (mean - standard deviation) to infinit, or from
+            # -infinit to (mean + standard deviation),  has an accumulated
+            # probability of 84.1%. Meaning we are using the place where if we
+            # picked a random start(or end), 84.1% of the times it will be
+            # inside the range.
+            res[key] = (int(means[0] - math.sqrt(variances[0])),
+                        int(means[1] + math.sqrt(variances[1])))
+        return res
+
+
 class Stats(gtk.Object):
     __gsignals__ = {
         "on-close": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
@@ -116,7 +207,6 @@ class Stats(gtk.Object):
 
     def show(self):
         self.window.show_all()
-        self.stat_facts = None
         day_start = conf.get("day_start_minutes")
         day_start = dt.time(day_start / 60, day_start % 60)
         self.timechart.day_start = day_start
@@ -127,15 +217,12 @@ class Stats(gtk.Object):
 
 
     def init_stats(self):
-        self.stat_facts = runtime.storage.get_facts(dt.date(1970, 1, 2), dt.date.today())
+        by_year = runtime.storage.get_totals(dt.date(1970, 1, 2), dt.date.today(),
+                                             group_by = "year")
 
-        if not self.stat_facts:
+        if not by_year:
             self.get_widget("explore_controls").hide()
         else:
-            by_year = stuff.totals(self.stat_facts,
-                                   lambda fact: fact.start_time.year,
-                                   lambda fact: 1)
-
             year_box = self.get_widget("year_box")
             if len(year_box.get_children()) == 0:
                 class YearButton(gtk.ToggleButton):
@@ -152,28 +239,29 @@ class Stats(gtk.Object):
                 all_button.set_active(True)
                 self.bubbling = False # TODO figure out how to properly work with togglebuttons as radiobuttons
 
-                years = sorted(by_year.keys())
+                years = [total['key'] for total in by_year]
                 for year in years:
                     year_box.pack_start(YearButton(str(year), year, self.on_year_changed))
 
-            if self.stat_facts[-1].start_time.year == self.stat_facts[0].start_time.year:
+            if len(by_year) == 1:
                 self.get_widget("explore_controls").hide_all()
             else:
                 year_box.show_all()
 
 
     def stats(self, year = None):
-        facts = self.stat_facts
+        start_date, end_date = dt.date(1970, 1, 2), dt.date.today()
         if year:
-            facts = filter(lambda fact: fact.start_time.year == year,
-                           facts)
+            start_date, end_date = dt.date(year, 1, 1), dt.date(year, 12, 31)
+
+        facts = FactStats(runtime.storage.iter_facts(start_date, end_date))
 
-        if not facts or (facts[-1].start_time - facts[0].start_time) < dt.timedelta(days=6):
+        if not facts.count or (facts.last.start_time - facts.first.start_time) < dt.timedelta(days=6):
             self.get_widget("statistics_box").hide()
             #self.get_widget("explore_controls").hide()
             label = self.get_widget("not_enough_records_label")
 
-            if not facts:
+            if not facts.count:
                 label.set_text(_("""There is no data to generate statistics yet.
 A week of usage would be nice!"""))
             else:
@@ -187,124 +275,36 @@ A week of usage would be nice!"""))
             self.get_widget("not_enough_records_label").hide()
 
         # All dates in the scope
-        durations = [(fact.start_time, fact.delta) for fact in facts]
-        self.timechart.draw(durations, facts[0].date, facts[-1].date)
+        days = runtime.storage.get_totals(start_date, end_date, group_by = "day")
+        durations = [(total['key'], stuff.duration_minutes(total['delta'])) for total in days]
+        self.timechart.draw(durations, facts.first.date, facts.last.date)
 
 
-        # Totals by category
-        categories = stuff.totals(facts,
-                                  lambda fact: fact.category,
-                                  lambda fact: fact.delta.seconds / 60 / 60.0)
-        category_keys = sorted(categories.keys())
-        categories = [categories[key] for key in category_keys]
+        # Totals by category (come sorted by key)
+        categories = runtime.storage.get_totals(start_date, end_date, group_by = "category")
+        category_keys = [total['key'] for total in categories]
+        categories = [stuff.duration_minutes(total['delta']) / 60.0 for total in categories]
         self.chart_category_totals.plot(category_keys, categories)
 
         # Totals by weekday
-        weekdays = stuff.totals(facts,
-                                lambda fact: (fact.start_time.weekday(),
-                                              fact.start_time.strftime("%a")),
-                                lambda fact: fact.delta.seconds / 60 / 60.0)
-
-        weekday_keys = sorted(weekdays.keys(), key = lambda x: x[0]) #sort
-        weekdays = [weekdays[key] for key in weekday_keys] #get values in the order
-        weekday_keys = [key[1] for key in weekday_keys] #now remove the weekday and keep just the abbreviated one
+        weekdays = runtime.storage.get_totals(start_date, end_date, group_by = "weekday")
+        weekday_keys = [calendar.day_abbr[total['key']] for total in weekdays] # abbreviated weekday names
+        weekdays = [stuff.duration_minutes(total['delta']) / 60.0 for total in weekdays]
         self.chart_weekday_totals.plot(weekday_keys, weekdays)
 
 
-        split_minutes = 5 * 60 + 30 #the mystical hamster midnight
-
         # starts and ends by weekday
-        by_weekday = {}
-        for date, date_facts in groupby(facts, lambda fact: fact.start_time.date()):
-            date_facts = list(date_facts)
-            weekday = (date_facts[0].start_time.weekday(),
-                       date_facts[0].start_time.strftime("%a"))
-            by_weekday.setdefault(weekday, [])
-
-            start_times, end_times = [], []
-            for fact in date_facts:
-                start_time = fact.start_time.time()
-                start_time = start_time.hour * 60 + start_time.minute
-                if fact.end_time:
-                    end_time = fact.end_time.time()
-                    end_time = end_time.hour * 60 + end_time.minute
-
-                    if start_time < split_minutes:
-                        start_time += 24 * 60
-                    if end_time < start_time:
-                        end_time += 24 * 60
-
-                    start_times.append(start_time)
-                    end_times.append(end_time)
-            if start_times and end_times:
-                by_weekday[weekday].append((min(start_times), max(end_times)))
-
-
-        for day in by_weekday:
-            n = len(by_weekday[day])
-            # calculate mean and variance for starts and ends
-            means = (sum([fact[0] for fact in by_weekday[day]]) / n,
-                     sum([fact[1] for fact in by_weekday[day]]) / n)
-            variances = (sum([(fact[0] - means[0]) ** 2 for fact in by_weekday[day]]) / n,
-                         sum([(fact[1] - means[1]) ** 2 for fact in by_weekday[day]]) / n)
-
-            # In the normal distribution, the range from
-            # (mean - standard deviation) to infinit, or from
-            # -infinit to (mean + standard deviation),  has an accumulated
-            # probability of 84.1%. Meaning we are using the place where if we
-            # picked a random start(or end), 84.1% of the times it will be
-            # inside the range.
-            by_weekday[day] = (int(means[0] - math.sqrt(variances[0])),
-                               int(means[1] + math.sqrt(variances[1])))
-
+        by_weekday = FactStats.usual_spans(facts.by_weekday)
         min_weekday = min([by_weekday[day][0] for day in by_weekday])
         max_weekday = max([by_weekday[day][1] for day in by_weekday])
 
-
         weekday_keys = sorted(by_weekday.keys(), key = lambda x: x[0])
         weekdays = [by_weekday[key] for key in weekday_keys]
         weekday_keys = [key[1] for key in weekday_keys] # get rid of the weekday number as int
 
 
         # starts and ends by category
-        by_category = {}
-        for date, date_facts in groupby(facts, lambda fact: fact.start_time.date()):
-            date_facts = sorted(list(date_facts), key = lambda x: x.category)
-
-            for category, category_facts in groupby(date_facts, lambda x: x.category):
-                category_facts = list(category_facts)
-                by_category.setdefault(category, [])
-
-                start_times, end_times = [], []
-                for fact in category_facts:
-                    start_time = fact.start_time
-                    start_time = start_time.hour * 60 + start_time.minute
-                    if fact.end_time:
-                        end_time = fact.end_time.time()
-                        end_time = end_time.hour * 60 + end_time.minute
-
-                        if start_time < split_minutes:
-                            start_time += 24 * 60
-                        if end_time < start_time:
-                            end_time += 24 * 60
-
-                        start_times.append(start_time)
-                        end_times.append(end_time)
-
-                if start_times and end_times:
-                    by_category[category].append((min(start_times), max(end_times)))
-
-        for cat in by_category:
-            # For explanation see the comments in the starts and ends by day
-            n = len(by_category[cat])
-            means = (sum([fact[0] for fact in by_category[cat]]) / n,
-                     sum([fact[1] for fact in by_category[cat]]) / n)
-            variances = (sum([(fact[0] - means[0]) ** 2 for fact in by_category[cat]]) / n,
-                         sum([(fact[1] - means[1]) ** 2 for fact in by_category[cat]]) / n)
-
-            by_category[cat] = (int(means[0] - math.sqrt(variances[0])),
-                                int(means[1] + math.sqrt(variances[1])))
-
+        by_category = FactStats.usual_spans(facts.by_category)
         min_category = min([by_category[day][0] for day in by_category])
         max_category = max([by_category[day][1] for day in by_category])
 
@@ -328,20 +328,19 @@ A week of usage would be nice!"""))
             # date format for the first record if the year has not been selected
             # Using python datetime formatting syntax. See:
             # http://docs.python.org/library/time.html#time.strftime
-            first_date = facts[0].start_time.strftime(C_("first record", "%b %d, %Y"))
+            first_date = facts.first.start_time.strftime(C_("first record", "%b %d, %Y"))
         else:
             # date of first record when year has been selected
             # Using python datetime formatting syntax. See:
             # http://docs.python.org/library/time.html#time.strftime
-            first_date = facts[0].start_time.strftime(C_("first record", "%b %d"))
+            first_date = facts.first.start_time.strftime(C_("first record", "%b %d"))
 
         summary += _("First activity was recorded on %s.") % \
                                                      ("<b>%s</b>" % first_date)
 
         # total time tracked
-        total_delta = dt.timedelta(days=0)
-        for fact in facts:
-            total_delta += fact.delta
+        total_delta = runtime.storage.get_totals(start_date, end_date)
+        total_delta = total_delta[0]['delta'] if total_delta else dt.timedelta()
 
         if total_delta.days > 1:
             human_years_str = ngettext("%(num)s year",
@@ -362,10 +361,7 @@ A week of usage would be nice!"""))
 
 
         # longest fact
-        max_fact = None
-        for fact in facts:
-            if not max_fact or fact.delta > max_fact.delta:
-                max_fact = fact
+        max_fact = facts.longest
 
         longest_date = max_fact.start_time.strftime(
             # How the date of the longest activity should be displayed in statistics
@@ -386,24 +382,14 @@ A week of usage would be nice!"""))
         # total records (in selected scope)
         summary += " " + ngettext("There is %s record.",
                                   "There are %s records.",
-                                  len(facts)) % ("<b>%d</b>" % len(facts))
-
-
-        early_start, early_end = dt.time(5,0), dt.time(9,0)
-        late_start, late_end = dt.time(20,0), dt.time(5,0)
-
-
-        fact_count = len(facts)
-        def percent(condition):
-            matches = [fact for fact in facts if condition(fact)]
-            return round(len(matches) / float(fact_count) * 100)
+                                  facts.count) % ("<b>%d</b>" % facts.count)
 
 
-        early_percent = percent(lambda fact: early_start < fact.start_time.time() < early_end)
-        late_percent = percent(lambda fact: fact.start_time.time() > late_start or fact.start_time.time() < late_end)
-        short_percent = percent(lambda fact: fact.delta <= dt.timedelta(seconds = 60 * 15))
+        early_percent = facts.percent(facts.early)
+        late_percent = facts.percent(facts.late)
+        short_percent = facts.percent(facts.short)
 
-        if fact_count < 100:
+        if facts.count < 100:
             summary += "\n\n" + _("Hamster would like to observe you some more!")
         elif early_percent >= 20:
             summary += "\n\n" + _("With %s percent of all activities starting before \
@@ -432,7 +418,6 @@ than 15 minutes, you seem to be a busy bee.") % ("<b>%d</b>" % short_percent)
 
 
     def after_fact_update(self, event):
-        self.stat_facts = runtime.storage.get_facts(dt.date(1970, 1, 1), dt.date.today())
         self.stats()
 
     def get_widget(self, name):
@@ -31,9 +31,33 @@ class Storage(object):
     def facts_changed(self): pass
     def activities_changed(self): pass
 
+    # same, but telling what exactly has changed. for facts that includes
+    # the span of days the changed facts were and are in. no ids and no
+    # dates mean that anything could have changed. these go out before
+    # the plain ones
+    def tags_changed_detailed(self, ids): pass
+    def facts_changed_detailed(self, ids, start_date, end_date): pass
+    def activities_changed_detailed(self, activity_ids, category_ids): pass
+
     def dispatch_overwrite(self):
+        self.tags_changed_detailed([])
+        self.facts_changed_detailed([], None, None)
+        self.activities_changed_detailed([], [])
+        self.tags_changed()
+        self.facts_changed()
+        self.activities_changed()
+
+    def __tags_changed(self):
+        self.tags_changed_detailed(self.__pop_changes("tag"))
         self.tags_changed()
+
+    def __facts_changed(self):
+        self.facts_changed_detailed(*self.__pop_fact_changes())
         self.facts_changed()
+
+    def __activities_changed(self):
+        self.activities_changed_detailed(self.__pop_changes("activity"),
+                                         self.__pop_changes("category"))
         self.activities_changed()
 
 
@@ -47,26 +71,53 @@ class Storage(object):
         fact = newfact
         start_time = fact.start_time or dt.datetime.now().replace(second = 0, microsecond = 0)
 
+        lookups = {}
         self.start_transaction()
-        result = self.__add_fact(fact.serialized_name(), start_time, end_time, temporary, redmine_issue, redmine_activity)
+        result = self.__add_fact(fact.serialized_name(), start_time, end_time, temporary, redmine_issue, redmine_activity, lookups)
         self.end_transaction()
 
+        if lookups.get("tags_added"):
+            self.__tags_changed()
         if result:
-            self.facts_changed()
+            self.__facts_changed()
         return result
 
+    def add_facts(self, facts, temporary = False):
+        """adds a batch of facts in one transaction. facts are (fact,
+        start_time, end_time, redmine_issue, redmine_activity) tuples with
+        the same meaning as in add_fact. returns list of the new ids, with 0
+        for facts that did not make it. change signals go out once, at the end"""
+        lookups = {}
+        self.start_transaction()
+        try:
+            result = self.__add_facts(facts, temporary, lookups)
+        except:
+            # all or nothing
+            self.rollback_transaction()
+            raise
+        self.end_transaction()
+
+        if lookups.get("tags_added"):
+            self.__tags_changed()
+        if any(result):
+            self.__facts_changed()
+        return [fact_id or 0 for fact_id in result]
+
     def get_fact(self, fact_id):
         """Get fact by id. For output format see GetFacts"""
         return self.__get_fact(fact_id)
 
 
     def update_fact(self, fact_id, fact, start_time, end_time, temporary = False):
+        lookups = {}
         self.start_transaction()
         self.__remove_fact(fact_id)
-        result = self.__add_fact(fact, start_time, end_time, temporary)
+        result = self.__add_fact(fact, start_time, end_time, temporary, lookups = lookups)
         self.end_transaction()
+        if lookups.get("tags_added"):
+            self.__tags_changed()
         if result:
-            self.facts_changed()
+            self.__facts_changed()
         return result
 
 
@@ -75,7 +126,7 @@ class Storage(object):
         facts = self.__get_todays_facts()
         if facts and not facts[-1]['end_time']:
             self.__touch_fact(facts[-1], end_time)
-            self.facts_changed()
+            self.__facts_changed()
         
 
 
@@ -85,24 +136,93 @@ class Storage(object):
         fact = self.__get_fact(fact_id)
         if fact:
             self.__remove_fact(fact_id)
-            self.facts_changed()
+            self.__facts_changed()
         self.end_transaction()
 
 
     def get_facts(self, start_date, end_date, search_terms):
         return self.__get_facts(start_date, end_date, search_terms)
 
+    def iter_facts(self, start_date, end_date, search_terms, batch = 1000):
+        """goes through facts of the range a stretch of days at a time, so
+        that long ranges do not have to be held in memory at once. the
+        stretch is adjusted so that each holds around batch facts"""
+        end_date = end_date or start_date
+        days = 7
+        while start_date <= end_date:
+            window_end = min(start_date + dt.timedelta(days = days - 1), end_date)
+            facts = self.__get_facts(start_date, window_end, search_terms)
+            for fact in facts:
+                yield fact
+
+            if len(facts) < batch / 2:
+                days = min(days * 2, 1024)
+            elif len(facts) > batch * 2:
+                days = max(days / 2, 1)
+            start_date = window_end + dt.timedelta(days = 1)
+
 
     def get_todays_facts(self):
         """Gets facts of today, respecting hamster midnight. See GetFacts for
         return info"""
         return self.__get_todays_facts()
 
+    def get_totals(self, start_date, end_date, search_terms, group_by):
+        return self.__get_totals(start_date, end_date, search_terms, group_by)
+
+
+    # redmine time entries on their way out
+    def queue_time_entry(self, fact_id, issue_id, activity_id, hours, comments, spent_on):
+        return self.__queue_time_entry(fact_id, issue_id, activity_id, hours, comments, spent_on)
+
+    def get_due_time_entries(self, now = None, limit = 20):
+        """pending time entries that are due to be sent by now"""
+        return self.__get_due_time_entries(now or dt.datetime.now(), limit)
+
+    def get_time_entry_status(self, fact_id):
+        return self.__get_time_entry_status(fact_id)
+
+    def time_entry_sent(self, fact_id, time_entry_id = None):
+        """entry has made it to redmine, as the time entry with the id"""
+        self.__set_time_entry_sent(fact_id, dt.datetime.now(), time_entry_id)
+
+    def time_entry_synced(self, fact_id, issue_id, activity_id, hours, comments, spent_on,
+                          time_entry_id, error = None):
+        """fact's entry is in redmine as the time entry with the id, or
+        redmine has rejected it with the error"""
+        self.__set_time_entry_synced(fact_id, issue_id, activity_id, hours, comments, spent_on,
+                                     time_entry_id, error, dt.datetime.now())
+
+    def get_redmine_time_entries(self, start_date, end_date):
+        """closed redmine facts started between the dates, both included,
+        and the redmine time entries they have been sent as"""
+        return self.__get_redmine_time_entries(dt.datetime.combine(start_date, dt.time()),
+                                               dt.datetime.combine(end_date + dt.timedelta(days = 1), dt.time()))
+
+    def time_entry_failed(self, fact_id, error, retry_at = None):
+        """entry will be sent again at retry_at. without one it is not
+        sent again"""
+        self.__set_time_entry_failed(fact_id, error, retry_at)
+
+
+    # redmine issues, as last fetched
+    def update_redmine_issues(self, issues):
+        """replaces the local copy of the issues with the list of
+        (id, subject, project, updated_on). returns how many have changed"""
+        return self.__update_redmine_issues(issues)
+
+    def search_redmine_issues(self, search = "", limit = 50):
+        return self.__search_redmine_issues(search, limit)
+
+    def get_redmine_issue_id(self, subject):
+        """id of the issue with the subject, None if there is none"""
+        return self.__get_redmine_issue_id(subject)
+
 
     # categories
     def add_category(self, name):
         res = self.__add_category(name)
-        self.activities_changed()
+        self.__activities_changed()
         return res
 
     def get_category_id(self, category):
@@ -110,11 +230,11 @@ class Storage(object):
 
     def update_category(self, id, name):
         self.__update_category(id, name)
-        self.activities_changed()
+        self.__activities_changed()
 
     def remove_category(self, id):
         self.__remove_category(id)
-        self.activities_changed()
+        self.__activities_changed()
 
 
     def get_categories(self):
@@ -124,16 +244,16 @@ class Storage(object):
     # activities
     def add_activity(self, name, category_id = -1):
         new_id = self.__add_activity(name, category_id)
-        self.activities_changed()
+        self.__activities_changed()
         return new_id
 
     def update_activity(self, id, name, category_id):
         self.__update_activity(id, name, category_id)
-        self.activities_changed()
+        self.__activities_changed()
 
     def remove_activity(self, id):
         result = self.__remove_activity(id)
-        self.activities_changed()
+        self.__activities_changed()
         return result
 
     def get_category_activities(self, category_id = -1):
@@ -145,7 +265,7 @@ class Storage(object):
     def change_category(self, id, category_id):
         changed = self.__change_category(id, category_id)
         if changed:
-            self.activities_changed()
+            self.__activities_changed()
         return changed
 
     def get_activity_by_name(self, activity, category_id, resurrect = True):
@@ -162,10 +282,10 @@ class Storage(object):
     def get_tag_ids(self, tags):
         tags, new_added = self.__get_tag_ids(tags)
         if new_added:
-            self.tags_changed()
+            self.__tags_changed()
         return tags
 
     def set_tags_autocomplete(self, tags):
         changes = self.__update_autocomplete_tags(tags)
         if changes:
-            self.tags_changed()
+            self.__tags_changed()
@@ -0,0 +1,196 @@
+# - coding: utf-8 -
+
+# This file is part of Project Hamster.
+
+# Project Hamster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Project Hamster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
+
+"""brings the time entries in redmine in line with the redmine facts of a
+date range - facts started from the command line, edited afterwards or
+tracked while the integration was off get their entries too. the facts are
+the source of truth, entries in redmine are never removed"""
+
+import logging
+import threading
+
+try:
+    import gobject
+except ImportError:
+    gobject = None # only the background sync needs it
+
+import redmine
+
+
+class TimeEntrySync(object):
+    batch = 20 # entries pushed one after another by a worker
+    workers = 4 # batches pushed side by side
+    min_hours = 0.016 # shorter facts are not worth an entry, as on stop
+
+    def __init__(self, storage, get_connector):
+        """get_connector returns the redmine connector to sync with, or None
+        while redmine integration is off"""
+        self.storage = storage
+        self.get_connector = get_connector
+
+    def sync(self, start_date, end_date):
+        """syncs the facts between the dates, both included. returns how
+        many entries went which way, None while redmine integration is off"""
+        connector = self.get_connector()
+        if not connector:
+            return None
+
+        entries = self._local_entries(start_date, end_date)
+        return self._record(self._push(connector, entries, start_date, end_date))
+
+    def start(self, start_date, end_date, callback = None, error_callback = None):
+        """same as sync, in the background. the network bit goes to a thread,
+        the storage stays with the main loop where callback gets the counts"""
+        connector = self.get_connector()
+        if not connector:
+            if callback:
+                callback(None)
+            return
+
+        entries = self._local_entries(start_date, end_date)
+
+        def run():
+            try:
+                results = self._push(connector, entries, start_date, end_date)
+            except Exception, e:
+                logging.warn(e)
+                if error_callback:
+                    gobject.idle_add(error_callback, e)
+                return
+            gobject.idle_add(self._on_pushed, results, callback)
+
+        thread = threading.Thread(target = run)
+        thread.daemon = True
+        thread.start()
+
+    def _on_pushed(self, results, callback):
+        counts = self._record(results)
+        if callback:
+            callback(counts)
+        return False
+
+    def _local_entries(self, start_date, end_date):
+        """time entries as the facts would have them"""
+        entries = []
+        for fact in self.storage.get_redmine_time_entries(start_date, end_date):
+            delta = fact["end_time"] - fact["start_time"]
+            hours = delta.days * 24 + delta.seconds / 3600.0
+            if hours < self.min_hours:
+                continue
+            entries.append({"fact_id": fact["fact_id"],
+                            "issue_id": fact["issue_id"],
+                            "activity_id": fact["activity_id"],
+                            "hours": round(hours, 2),
+                            "comments": fact["comments"],
+                            "spent_on": fact["start_time"].date(),
+                            "time_entry_id": fact["time_entry_id"]})
+        return entries
+
+    def diff(self, entries, remote):
+        """pairs the local entries with the time entries in redmine. returns
+        (entry, time entry id, action) for every local entry, where action is
+        one of create, update, link or none. entries that have not been
+        noted down as sent take over a loose time entry with the same
+        issue, day and comments, so that nothing gets in twice"""
+        remote = dict((time_entry["id"], time_entry) for time_entry in remote)
+        claimed = set([entry["time_entry_id"] for entry in entries if entry["time_entry_id"] in remote])
+
+        loose = {}
+        for time_entry in sorted(remote.values(), key = lambda time_entry: time_entry["id"]):
+            if time_entry["id"] not in claimed:
+                loose.setdefault(self._about(time_entry), []).append(time_entry)
+
+        pairs = []
+        for entry in entries:
+            time_entry, linked = remote.get(entry["time_entry_id"]), True
+            if not time_entry:
+                key = (entry["issue_id"], entry["spent_on"].strftime("%Y-%m-%d"), entry["comments"])
+                if loose.get(key):
+                    time_entry, linked = loose[key].pop(0), False
+
+            if not time_entry:
+                pairs.append((entry, None, "create"))
+            elif self._differs(entry, time_entry):
+                pairs.append((entry, time_entry["id"], "update"))
+            else:
+                pairs.append((entry, time_entry["id"], "none" if linked else "link"))
+        return pairs
+
+    def _about(self, time_entry):
+        return (time_entry.get("issue", {}).get("id"), time_entry.get("spent_on"), time_entry.get("comments"))
+
+    def _differs(self, entry, time_entry):
+        return (entry["issue_id"] != time_entry.get("issue", {}).get("id") or
+                entry["activity_id"] != time_entry.get("activity", {}).get("id") or
+                abs(entry["hours"] - float(time_entry.get("hours") or 0)) >= 0.005 or
+                entry["comments"] != time_entry.get("comments") or
+                entry["spent_on"].strftime("%Y-%m-%d") != time_entry.get("spent_on"))
+
+    def _push(self, connector, entries, start_date, end_date):
+        """fetches the time entries of the range and pushes what is missing
+        or has changed. returns (entry, time entry id, action, error, retry)
+        for every entry"""
+        pairs = self.diff(entries, connector.get_time_entries(start_date, end_date))
+
+        pushes = [pair for pair in pairs if pair[2] in ("create", "update")]
+        batches = [pushes[i:i + self.batch] for i in range(0, len(pushes), self.batch)]
+        pushed = connector.in_parallel(batches, lambda batch, connection: self._send(connector, batch, connection),
+                                       self.workers)
+
+        results = [(entry, time_entry_id, action, None, False) for entry, time_entry_id, action in pairs
+                                                               if action not in ("create", "update")]
+        for batch in pushed:
+            results.extend(batch)
+        return results
+
+    def _send(self, connector, batch, connection):
+        results = []
+        for i, (entry, time_entry_id, action) in enumerate(batch):
+            fields = (entry["issue_id"], entry["hours"], entry["activity_id"], entry["comments"], entry["spent_on"])
+            try:
+                if action == "create":
+                    time_entry_id = connector.add_time_entry(*fields, connection = connection)
+                else:
+                    connector.update_time_entry(time_entry_id, *fields, connection = connection)
+                results.append((entry, time_entry_id, action, None, False))
+            except redmine.RedmineActionException, e:
+                results.append((entry, time_entry_id, action, str(e), False))
+            except redmine.RedmineConnectionException, e:
+                # redmine is away, the rest of the batch waits for the next sync
+                results.extend([(entry, time_entry_id, action, str(e), True)
+                                for entry, time_entry_id, action in batch[i:]])
+                break
+        return results
+
+    def _record(self, results):
+        counts = {"created": 0, "updated": 0, "linked": 0, "unchanged": 0, "rejected": 0, "failed": 0}
+        for entry, time_entry_id, action, error, retry in results:
+            if retry:
+                counts["failed"] += 1
+                continue
+
+            if error:
+                logging.warn("time entry of fact %d rejected: %s", entry["fact_id"], error)
+                counts["rejected"] += 1
+            else:
+                counts[{"create": "created", "update": "updated", "link": "linked", "none": "unchanged"}[action]] += 1
+
+            if action != "none" or error:
+                self.storage.time_entry_synced(entry["fact_id"], entry["issue_id"], entry["activity_id"],
+                                               entry["hours"], entry["comments"], entry["spent_on"],
+                                               time_entry_id, error)
+        return counts
@@ -22,6 +22,7 @@
 from __future__ import division # BEHOLD PYTHON3 DIVISION! int / int -> float
 import sys
 import logging
+import threading
 import datetime as dt
 
 import gtk, gobject
@@ -34,6 +35,7 @@ import redmine
 from hamster.configuration import runtime, dialogs, conf, load_ui_file
 from hamster import widgets
 from hamster.lib import Fact, RedmineFact, trophies, stuff
+from hamster.lib.scheduler import Scheduler, next_step, next_day_start
 
 try:
     import wnck
@@ -90,6 +92,18 @@ class DailyView(object):
         # initialize the window.  explicitly set it to None first, so that the
         # creator knows it doesn't yet exist.
         self.window = None
+
+        # redmine lists are fetched in threads. activity names map to ids
+        # here, issues go to the storage and are searched for there
+        gobject.threads_init()
+        self.redmine_activities = {}
+        self._issue_search_timeout = None
+
+        # the view is reloaded when the facts change. in between, timers
+        # move the ongoing activity along and bring in the new day
+        self.scheduler = Scheduler()
+        self._totals, self._totals_at = [], None
+
         self.create_hamster_window()
 
         self.new_name.grab_focus()
@@ -104,7 +118,7 @@ class DailyView(object):
         self.todays_facts = None
 
         runtime.storage.connect('activities-changed',self.after_activity_update)
-        runtime.storage.connect('facts-changed',self.after_fact_update)
+        runtime.storage.connect('facts-changed-detailed',self.after_fact_update)
         runtime.storage.connect('toggle-called', self.on_toggle_called)
 
         self.screen = None
@@ -112,9 +126,6 @@ class DailyView(object):
             self.init_workspace_tracking()
 
 
-        # refresh hamster every 60 seconds
-        gobject.timeout_add_seconds(60, self.refresh_hamster)
-
         self.prev_size = None
 
         # bindings
@@ -181,10 +192,16 @@ class DailyView(object):
             # Signal for Redmine arbitrary issue id entry
             self.get_widget("arbitrary_issue_id_entry").connect("changed", self.on_redmine_arbitrary_issue_id_entry_change)
             
-            # Redmine combos additional setup
-            cell = gtk.CellRendererText()
-            self.get_widget("issue_combo").pack_start(cell, True)
-            self.get_widget("issue_combo").add_attribute(cell, 'text',0)
+            # Redmine combos additional setup. the issue combo has an entry
+            # to search the issues by typing, the matches come up as completion
+            self.get_widget("issue_combo").set_model(gtk.ListStore(gobject.TYPE_STRING))
+            self.get_widget("issue_combo").set_text_column(0)
+            self.issue_completion = gtk.EntryCompletion()
+            self.issue_completion.set_model(gtk.ListStore(gobject.TYPE_STRING))
+            self.issue_completion.set_text_column(0)
+            # the storage has done the matching already
+            self.issue_completion.set_match_func(lambda completion, key, iter: True)
+            self.get_widget("issue_combo").child.set_completion(self.issue_completion)
             cell = gtk.CellRendererText()
             self.get_widget("time_activity_combo").pack_start(cell, True)
             self.get_widget("time_activity_combo").add_attribute(cell, 'text',0)
@@ -230,14 +247,12 @@ class DailyView(object):
 
     """UI functions"""
     def refresh_hamster(self):
-        """refresh hamster every x secs - load today, check last activity etc."""
+        """load today, check last activity etc. - while the window is there"""
         try:
             if self.window:
                 self.load_day()
         except Exception, e:
             logging.error("Error while refreshing: %s" % e)
-        finally:  # we want to go on no matter what, so in case of any error we find out about it sooner
-            return True
 
 
     def load_day(self):
@@ -252,38 +267,79 @@ class DailyView(object):
         else:
             self.last_activity = None
 
-        by_category = {}
         for fact in facts:
-            duration = 24 * 60 * fact.delta.days + fact.delta.seconds // 60
-            by_category[fact.category] = \
-                          by_category.setdefault(fact.category, 0) + duration
             self.treeview.add_fact(fact)
 
         self.treeview.attach_model()
 
         if not facts:
+            self._totals = []
             self._gui.get_object("today_box").hide()
             self._gui.get_object("fact_totals").set_text(_("No records today"))
         else:
             self._gui.get_object("today_box").show()
-            total_strings = []
-            for category in by_category:
-                # listing of today's categories and time spent in them
-                duration = locale.format("%.1f", (by_category[category] / 60.0))
-                total_strings.append(_("%(category)s: %(duration)s") % \
-                        ({'category': category,
-                          #duration in main drop-down per category in hours
-                          'duration': _("%sh") % duration
-                          }))
-
-            total_string = ", ".join(total_strings)
-            self._gui.get_object("fact_totals").set_text(total_string)
+            by_category = {}
+            for fact in facts:
+                by_category[fact.category] = by_category.get(fact.category, dt.timedelta()) + fact.delta
+            self._totals = sorted(by_category.items())
+            self._totals_at = dt.datetime.now()
+            self.show_totals()
         
         # Before setting last activity make sure that Redmine stuff is visible only if the integration is enabled (i. e. hide the widgets now and leave the rest to the code in set_last_activity())
         self.get_widget("redmine_frame").hide()
         
 
         self.set_last_activity()
+        self.schedule_updates()
+
+    def show_totals(self):
+        # the ongoing activity keeps adding to its category since the totals were loaded
+        running = self.last_activity
+        elapsed = dt.datetime.now() - self._totals_at
+
+        total_strings = []
+        for key, delta in self._totals:
+            if running and key == running.category:
+                delta = delta + elapsed
+            # listing of today's categories and time spent in them
+            duration = locale.format("%.1f", (stuff.duration_minutes(delta) / 60.0))
+            total_strings.append(_("%(category)s: %(duration)s") % \
+                    ({'category': key,
+                      #duration in main drop-down per category in hours
+                      'duration': _("%sh") % duration
+                      }))
+
+        total_string = ", ".join(total_strings)
+        self._gui.get_object("fact_totals").set_text(total_string)
+
+    def schedule_updates(self):
+        """sets the timers for the next minute of the ongoing activity and
+        for the start of the new day. nothing is due while the window is away"""
+        if not self.window:
+            self.scheduler.clear()
+            return
+
+        now = dt.datetime.now()
+        self.scheduler.at("day", next_day_start(now, conf.get("day_start_minutes")), self.refresh_hamster)
+
+        tick = None
+        if self.last_activity:
+            tick = next_step(self.last_activity.start_time, dt.timedelta(minutes = 1), now)
+        self.scheduler.at("tick", tick, self.on_tick)
+
+    def on_tick(self):
+        """moves the ongoing activity along without going to the storage"""
+        if not self.window or not self.last_activity:
+            return
+
+        delta = dt.datetime.now() - self.last_activity.start_time
+        self.last_activity.delta = delta
+        self.get_widget("last_activity_duration").set_text(stuff.format_duration(delta.seconds // 60) or _("Just started"))
+        self.treeview.update_running(self.last_activity.id, delta)
+        if self._totals:
+            self.show_totals()
+
+        self.schedule_updates()
 
 
     def set_last_activity(self):
@@ -403,10 +459,13 @@ class DailyView(object):
     """signals"""
     def after_activity_update(self, widget):
         self.new_name.refresh_activities()
-        self.load_day()
+        self.refresh_hamster()
 
-    def after_fact_update(self, event):
-        self.load_day()
+    def after_fact_update(self, event, ids, start_date, end_date):
+        # no need to reload when the change happened on some other day
+        today = (dt.datetime.now() - dt.timedelta(minutes = conf.get("day_start_minutes"))).date()
+        if not start_date or start_date <= today <= end_date:
+            self.refresh_hamster()
 
     def on_workspace_changed(self, screen, previous_workspace):
         if not previous_workspace:
@@ -483,7 +542,7 @@ class DailyView(object):
 
     def on_conf_changed(self, event, key, value):
         if key == "day_start_minutes":
-            self.load_day()
+            self.refresh_hamster()
 
         elif key == "workspace_tracking":
             self.workspace_tracking = value
@@ -504,12 +563,12 @@ class DailyView(object):
         fact = None
         if conf.get("redmine_integration_enabled"):
             redmine_issue_subject = self.get_widget("issue_combo").get_active_text()
-            if redmine_issue_subject == None or redmine_issue_subject == "None":
+            if not redmine_issue_subject or redmine_issue_subject == "None":
               arbitrary_issue_id = self.get_widget("arbitrary_issue_id_entry").get_text()
               if arbitrary_issue_id == "" or arbitrary_issue_id == None:
                 fact = Fact(activity, tags = self.new_tags.get_text().decode("utf8", "replace"))
               else:
-                redcon = redmine.RedmineConnector(conf.get("redmine_url"), conf.get("redmine_api_key"))
+                redcon = self.get_redmine_connector()
                 try:
                   redcon.get_arbitrary_issue_data(arbitrary_issue_id)
                   arbitrary_issue_id = int(arbitrary_issue_id)
@@ -522,7 +581,7 @@ class DailyView(object):
                     dialog.run()
                     dialog.destroy()
                     return
-                  redmine_activity_id = redcon.get_redmine_activity_id(redmine_time_activity_name)
+                  redmine_activity_id = self.redmine_activities.get(redmine_time_activity_name)
                   fact = RedmineFact(activity, arbitrary_issue_id, redmine_activity_id, tags = self.new_tags.get_text().decode("utf8", "replace"))
                 except redmine.RedmineConnectionException:
                   dialog = gtk.Dialog("Failed to start tracking", self.window, gtk.DIALOG_MODAL, (gtk.STOCK_OK, gtk.RESPONSE_ACCEPT))
@@ -542,9 +601,17 @@ class DailyView(object):
                     dialog.run()
                     dialog.destroy()
                     return
-                redcon = redmine.RedmineConnector(conf.get("redmine_url"), conf.get("redmine_api_key"))
-                redmine_issue_id = redcon.get_redmine_issue_id(redmine_issue_subject)
-                redmine_activity_id = redcon.get_redmine_activity_id(redmine_time_activity_name)
+                redmine_issue_id = runtime.storage.get_redmine_issue_id(redmine_issue_subject.decode("utf8", "replace"))
+                if redmine_issue_id == None:
+                    dialog = gtk.Dialog("Failed to start tracking", self.window, gtk.DIALOG_MODAL, (gtk.STOCK_OK, gtk.RESPONSE_ACCEPT))
+                    label = gtk.Label("Unknown Redmine issue!")
+                    dialog.vbox.pack_start(label)
+                    label.show()
+                    dialog.run()
+                    dialog.destroy()
+                    return
+                # the activity ids are known from when the combo was filled
+                redmine_activity_id = self.redmine_activities.get(redmine_time_activity_name)
                 fact = RedmineFact(activity, redmine_issue_id, redmine_activity_id, tags = self.new_tags.get_text().decode("utf8", "replace"))
         else:
             fact = Fact(activity, tags = self.new_tags.get_text().decode("utf8", "replace"))
@@ -561,11 +628,11 @@ class DailyView(object):
         fact = facts[-1]
         runtime.storage.stop_tracking()
         self.last_activity = None
-        if fact != None and conf.get("redmine_integration_enabled") and (fact.delta.days * 24 + fact.delta.seconds / 3600) >= 0.016 and not fact.redmine_issue_id == -1:
-            redmine_url = conf.get("redmine_url")
-            redmine_api_key = conf.get("redmine_api_key")
-            redcon = redmine.RedmineConnector(redmine_url, redmine_api_key)
-            redcon.add_time_entry(fact.redmine_issue_id, round((fact.delta.days * 24 + fact.delta.seconds / 3600), 2), fact.redmine_time_activity_id, fact.activity)
+        if fact != None and conf.get("redmine_integration_enabled") and (fact.delta.days * 24 + fact.delta.seconds / 3600.0) >= 0.016 and not fact.redmine_issue_id == -1:
+            # goes out in the background, redmine being slow or away does not hold us up
+            runtime.storage.queue_time_entry(fact.id, fact.redmine_issue_id, fact.redmine_time_activity_id,
+                                             round((fact.delta.days * 24 + fact.delta.seconds / 3600.0), 2),
+                                             fact.activity, fact.start_time.date())
         self.fill_issues_combo()
         self.fill_time_activities_combo()
 
@@ -604,11 +671,13 @@ class DailyView(object):
         self.save_window_position()
         self.window.destroy()
         self.window = None
+        self.scheduler.clear()
 
     def on_delete_window(self, event, data):
         self.save_window_position()
         self.window.destroy()
         self.window = None
+        self.scheduler.clear()
 
     def show_in_tray(self):
         # show the status tray icon
@@ -617,48 +686,123 @@ class DailyView(object):
         self.statusicon.set_visible(True)
         
     # Redmine functions
+    def get_redmine_connector(self):
+      # responses are kept on disk so that the combos can be filled right away on the next start
+      return redmine.get_connector(conf.get("redmine_url"), conf.get("redmine_api_key"), runtime.home_data_dir)
+
+    def fetch_from_redmine(self, fetch, callback):
+      """calls fetch in a thread and hands its result to callback back in the
+      main loop. the window does not wait for redmine"""
+      def run():
+        try:
+          result = fetch()
+        except (redmine.RedmineConnectionException, redmine.RedmineActionException) as e:
+          logging.warn(e)
+          return
+        gobject.idle_add(callback, result)
+
+      thread = threading.Thread(target = run)
+      thread.daemon = True
+      thread.start()
+
     def fill_issues_combo(self):
-      combomodel = self.get_widget("issue_combo").get_model()
-      if combomodel == None:
-        combomodel = gtk.ListStore(gobject.TYPE_STRING)
-      combomodel.clear()
-      self.get_widget("issue_combo").set_model(None) # Optimizes operations
       if conf.get("redmine_integration_enabled"):
-        redmine_url = conf.get("redmine_url")
-        redmine_api_key = conf.get("redmine_api_key")
-        redcon = redmine.RedmineConnector(redmine_url, redmine_api_key)
-        issues = redcon.get_issues()
-        combomodel.append(["None"])
-        for issue in issues['issues']:
-          combomodel.append([issue["subject"]])
+        redcon = self.get_redmine_connector()
+        # what we had the last time is in the storage, fresh list when it arrives
+        self.set_issues()
+        self.fetch_from_redmine(redcon.get_issues, self.set_issues)
       else:
-        combomodel = None
-      self.get_widget("issue_combo").set_model(combomodel)
-      self.get_widget("issue_combo").set_active(0)
-            
+        self.get_widget("issue_combo").get_model().clear()
+        self.get_widget("issue_combo").child.set_text("")
+
+    def set_issues(self, issues = None):
+      if not self.window:
+        return False
+
+      # the storage keeps the issues for the search, the combo lists the
+      # most recently updated ones
+      if issues is not None:
+        runtime.storage.update_redmine_issues(issues['issues'])
+      self.fill_redmine_combo(self.get_widget("issue_combo"),
+                              ["None"] + [subject for issue_id, subject, project in runtime.storage.search_redmine_issues()])
+      return False
+
+    def queue_issue_search(self, search):
+      """searches for the typed in issue once typing stops for a moment"""
+      if self._issue_search_timeout:
+        gobject.source_remove(self._issue_search_timeout)
+      self._issue_search_timeout = gobject.timeout_add(150, self.search_issues, search)
+
+    def search_issues(self, search):
+      self._issue_search_timeout = None
+      if not self.window:
+        return False
+
+      model = self.issue_completion.get_model()
+      model.clear()
+      for issue_id, subject, project in runtime.storage.search_redmine_issues(search.decode("utf8", "replace")):
+        model.append([subject])
+      self.issue_completion.complete()
+      return False
+
     def fill_time_activities_combo(self):
-      combomodel = self.get_widget("time_activity_combo").get_model()
-      if combomodel == None:
-        combomodel = gtk.ListStore(gobject.TYPE_STRING)
-      combomodel.clear()
-      self.get_widget("time_activity_combo").set_model(None) # Optimizes operations
       if conf.get("redmine_integration_enabled"):
-        redmine_url = conf.get("redmine_url")
-        redmine_api_key = conf.get("redmine_api_key")
-        redcon = redmine.RedmineConnector(redmine_url, redmine_api_key)
-        activities = redcon.get_activities()
-        for activity in activities['time_entry_activities']:
-          combomodel.append([activity["name"]])
+        redcon = self.get_redmine_connector()
+        self.set_time_activities(redcon.get_cached_activities() or {'time_entry_activities': []})
+        self.fetch_from_redmine(redcon.get_activities, self.set_time_activities)
       else:
-        combomodel = None
-      self.get_widget("time_activity_combo").set_model(combomodel)
+        self.redmine_activities = {}
+        self.get_widget("time_activity_combo").set_model(None)
+
+    def set_time_activities(self, activities):
+      if not self.window:
+        return False
+
+      self.redmine_activities = {}
+      for activity in reversed(activities['time_entry_activities']):
+        self.redmine_activities[activity["name"]] = activity["id"]
+      self.fill_redmine_combo(self.get_widget("time_activity_combo"),
+                              [activity["name"] for activity in activities['time_entry_activities']],
+                              default = None)
+      return False
+
+    def fill_redmine_combo(self, combo, names, default = 0):
+      """puts names in the combo, keeping the selection if it is still there.
+      the same names again leave the combo be"""
+      combomodel = combo.get_model()
+      active = combo.get_active_text()
+      # text typed in the issue combo stays as it is
+      typed = isinstance(combo, gtk.ComboBoxEntry) and combo.get_active() == -1 and active
+      if combomodel is not None and [row[0] for row in combomodel] == names:
+        if default is not None and combo.get_active() == -1 and not typed:
+          combo.set_active(default)
+        return
+
+      arbitrary_issue_id = self.get_widget("arbitrary_issue_id_entry").get_text()
+
+      combomodel = gtk.ListStore(gobject.TYPE_STRING)
+      for name in names:
+        combomodel.append([name])
+      combo.set_model(combomodel)
+
+      if typed:
+        combo.child.set_text(active)
+      elif active in names:
+        combo.set_active(names.index(active))
+      elif default is not None:
+        combo.set_active(default)
+
+      # selecting in the combo clears the issue id that might have been typed in meanwhile
+      if arbitrary_issue_id:
+        self.get_widget("arbitrary_issue_id_entry").set_text(arbitrary_issue_id)
         
     # Redmine callbacks
     def on_redmine_issue_combo_change(self, combobox):
-      redmine_url = conf.get("redmine_url")
-      redmine_api_key = conf.get("redmine_api_key")
-      redcon = redmine.RedmineConnector(redmine_url, redmine_api_key)
-      if combobox.get_active() == 0:
+      subject = combobox.get_active_text()
+      if combobox.get_active() == -1 and subject:
+        self.queue_issue_search(subject)
+
+      if not subject or subject == "None":
         self.get_widget("time_activity_combo").set_sensitive(False)
         self.get_widget("time_activity_combo").set_active(-1)
         self.get_widget("arbitrary_issue_id_entry").set_sensitive(True)
@@ -18,10 +18,11 @@
 # along with Project Hamster.  If not, see <http://www.gnu.org/licenses/>.
 
 import gtk, gobject, pango
+import logging
 import datetime as dt
 
 from ..configuration import runtime
-from ..lib import Fact, stuff, graphics
+from ..lib import Fact, stuff, graphics, suggestions
 from .. import external
 
 class ActivityEntry(gtk.Entry):
@@ -38,6 +39,14 @@ class ActivityEntry(gtk.Entry):
         self.categories = None
         self.filter = None
         self.max_results = 10 # limit popup size to 10 results
+
+        # activities fetched from the storage. as long as the user keeps
+        # typing on, these are narrowed down locally
+        self.candidates = suggestions.Candidates()
+        self.debounce = 150 # ms to wait for the typing to settle before asking
+        self._fetch_timeout = None
+        self._complete_pending = False
+        self._popup_wanted = False # suggestions that arrive late are shown only while typing
         self.external = external.ActivitiesSource()
 
         self.popup = gtk.Window(type = gtk.WINDOW_POPUP)
@@ -108,6 +117,8 @@ class ActivityEntry(gtk.Entry):
         for obj, handler in self.external_listeners:
             obj.disconnect(handler)
 
+        self._cancel_fetch()
+
         self.popup.destroy()
         self.popup = None
 
@@ -136,7 +147,9 @@ class ActivityEntry(gtk.Entry):
         self.popup.hide()
 
     def show_popup(self):
-        result_count = self.tree.get_model().iter_n_children(None)
+        self._popup_wanted = True
+        model = self.tree.get_model()
+        result_count = model.iter_n_children(None) if model else 0
         if result_count <= 1:
             self.hide_popup()
             return
@@ -192,12 +205,17 @@ class ActivityEntry(gtk.Entry):
         model = self.tree.get_model()
         subject = self.get_text()
 
-        if not subject or model.iter_n_children(None) == 0:
+        if not subject or not model or model.iter_n_children(None) == 0:
             return
 
         prefix_length = 0
 
-        labels = [row[0] for row in model]
+        # suggestions that only have the subject somewhere in the middle
+        # have nothing to complete with
+        labels = [row[0] for row in model if row[0].lower().startswith(subject.lower())]
+        if not labels:
+            return
+
         shortest = min([len(label) for label in labels])
         first = labels[0] #since we are looking for common prefix, we do not care which label we use for comparisons
 
@@ -217,6 +235,7 @@ class ActivityEntry(gtk.Entry):
     def refresh_activities(self):
         # scratch category cache so it gets repopulated on demand
         self.categories = None
+        self.candidates.reset()
 
     def populate_suggestions(self):
         if self.get_selection_bounds():
@@ -224,42 +243,81 @@ class ActivityEntry(gtk.Entry):
         else:
             cursor = self.get_position()
 
-        if self.activities and self.categories and self.filter == self.get_text().decode('utf8', 'replace')[:cursor]:
+        if self.activities is not None and self.categories and self.filter == self.get_text().decode('utf8', 'replace')[:cursor]:
             return #same thing, no need to repopulate
 
         self.filter = self.get_text().decode('utf8', 'replace')[:cursor]
         fact = Fact(self.filter)
 
-        # do not cache as ordering and available options change over time
-        self.activities = runtime.storage.get_activities(fact.activity)
-        self.external_activities = self.external.get_activities(fact.activity)
-        self.activities.extend(self.external_activities)
-
         self.categories = self.categories or runtime.storage.get_categories()
 
+        key = fact.activity.lower()
+        if self.candidates.covers(key):
+            # typing on - what we have already is narrowed down right away
+            self.activities = suggestions.narrow(self.candidates.activities + self.external_activities, key)
+            self.fill_store()
+            if self.candidates.complete(key):
+                # the storage would not come up with anything more, and what
+                # was asked for before backspacing would fit the key worse
+                self._cancel_fetch()
+                return
+
+        self._queue_fetch(key)
+
+    def _cancel_fetch(self):
+        if self._fetch_timeout:
+            gobject.source_remove(self._fetch_timeout)
+            self._fetch_timeout = None
+        self.candidates.cancel()
+
+    def _queue_fetch(self, key):
+        """asks the storage for activities once the typing has settled"""
+        self._cancel_fetch()
+        self._fetch_timeout = gobject.timeout_add(self.debounce, self._fetch_activities, key, self.candidates.request())
+
+    def _fetch_activities(self, key, serial):
+        self._fetch_timeout = None
+
+        def on_activities(activities):
+            if not self.candidates.receive(serial, key, activities):
+                return # the user has typed on since
+
+            self.external_activities = self.external.get_activities(key)
+            self.activities = activities + self.external_activities
+            self.fill_store()
+
+            if self._complete_pending and not self.get_selection_bounds():
+                self.complete_inline()
+            self._complete_pending = False
+            if self._popup_wanted:
+                self.show_popup()
 
+        def on_error(error):
+            logging.warn(error)
+
+        runtime.storage.get_activities(key, reply_handler = on_activities, error_handler = on_error)
+        return False
+
+    def fill_store(self):
+        if self.popup is None:
+            return # destroyed meanwhile
+
+        fact = Fact(self.filter)
         time = ''
         if fact.start_time:
             time = fact.start_time.strftime("%H:%M")
             if fact.end_time:
                 time += "-%s" % fact.end_time.strftime("%H:%M")
 
-
-        store = self.tree.get_model()
-        if not store:
-            store = gtk.ListStore(str, str, str, str)
-            self.tree.set_model(store)
-        store.clear()
-
+        rows = []
         if self.filter.find("@") > 0:
-            key = self.filter[self.filter.find("@")+1:].decode('utf8', 'replace').lower()
+            key = self.filter[self.filter.find("@")+1:].lower()
             for category in self.categories:
-                if key in category['name'].decode('utf8', 'replace').lower():
+                if key in category['name'].lower():
                     fillable = (self.filter[:self.filter.find("@") + 1] + category['name'])
-                    store.append([fillable, category['name'], fillable, time])
+                    rows.append([fillable, category['name'], fillable, time])
         else:
-            key = fact.activity.decode('utf8', 'replace').lower()
-            for activity in self.activities:
+            for activity in self.activities or []:
                 fillable = activity['name'].lower()
                 if activity['category']:
                     fillable += "@%s" % activity['category']
@@ -267,12 +325,39 @@ class ActivityEntry(gtk.Entry):
                 if time: #as we also support deltas, for the time we will grab anything up to first space
                     fillable = "%s %s" % (self.filter.split(" ", 1)[0], fillable)
 
-                store.append([fillable, activity['name'].lower(), activity['category'], time])
+                rows.append([fillable, activity['name'].lower(), activity['category'], time])
+
+        store = self.tree.get_model()
+        if not store:
+            store = gtk.ListStore(str, str, str, str)
+            self.tree.set_model(store)
+
+        # the store gives back utf-8 strings
+        rows = [tuple(value.encode("utf-8") if isinstance(value, unicode) else value for value in row)
+                for row in rows]
+        self._update_store(store, rows)
+
+    def _update_store(self, store, rows):
+        """brings the store in line with rows. rows that stay are left in
+        place so that narrowing down does not rebuild the whole list"""
+        wanted = set(rows)
+        for i in reversed(range(len(store))):
+            if tuple(store[i]) not in wanted:
+                store.remove(store.get_iter(i))
+
+        for i, row in enumerate(rows):
+            if i < len(store) and tuple(store[i]) == row:
+                continue
+            store.insert(i, row)
+
+        while len(store) > len(rows):
+            store.remove(store.get_iter(len(rows)))
 
     def after_activity_update(self, widget):
         self.refresh_activities()
 
     def _on_focus_out_event(self, widget, event):
+        self._popup_wanted = False
         self.hide_popup()
 
     def _on_text_changed(self, widget):
@@ -284,6 +369,7 @@ class ActivityEntry(gtk.Entry):
 
     def _on_key_release_event(self, entry, event):
         if (event.keyval in (gtk.keysyms.Return, gtk.keysyms.KP_Enter)):
+            self._popup_wanted = False
             if self.popup.get_property("visible"):
                 if self.tree.get_cursor()[0]:
                     self.set_text(self.tree.get_model()[self.tree.get_cursor()[0][0]][0])
@@ -293,6 +379,7 @@ class ActivityEntry(gtk.Entry):
                 self._on_selected()
 
         elif (event.keyval == gtk.keysyms.Escape):
+            self._popup_wanted = False
             if self.popup.get_property("visible"):
                 self.hide_popup()
                 return True
@@ -301,10 +388,12 @@ class ActivityEntry(gtk.Entry):
         elif event.keyval in (gtk.keysyms.Up, gtk.keysyms.Down):
             return False
         else:
+            # when the suggestions come in later, they complete then
+            self._complete_pending = event.keyval not in (gtk.keysyms.Delete, gtk.keysyms.BackSpace)
             self.populate_suggestions()
             self.show_popup()
 
-            if event.keyval not in (gtk.keysyms.Delete, gtk.keysyms.BackSpace):
+            if self._complete_pending:
                 self.complete_inline()
 
 
@@ -339,6 +428,7 @@ class ActivityEntry(gtk.Entry):
         model, iter = tree.get_selection().get_selected()
         value = model.get_value(iter, 0)
         self.set_text(value)
+        self._popup_wanted = False
         self.hide_popup()
         self.set_position(len(self.get_text()))
 
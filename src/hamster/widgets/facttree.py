@@ -22,6 +22,7 @@
 
 import gtk, gobject
 import cairo
+import bisect
 import datetime as dt
 
 from ..lib import stuff, graphics, RedmineFact, Fact
@@ -49,23 +50,62 @@ def action_painter(column, cell, model, iter):
 
 
 
-class GroupRow(object):
+def longest_increasing(sequence):
+    """indexes of a longest strictly increasing run in the sequence, picked
+    out patience sorting style in n log n"""
+    tails, tail_values = [], [] # smallest tail of a run of each length
+    links = [None] * len(sequence) # previous element in the run
+
+    for i, value in enumerate(sequence):
+        pos = bisect.bisect_left(tail_values, value)
+        if pos > 0:
+            links[i] = tails[pos - 1]
+        if pos == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[pos], tail_values[pos] = i, value
+
+    run, i = [], tails[-1] if tails else None
+    while i is not None:
+        run.append(i)
+        i = links[i]
+    return run[::-1]
+
+
+class Row(object):
+    """rows are told apart by their key. rows of the same key and version
+    look the same"""
+    key = None
+
+    @property
+    def version(self):
+        return None
+
+    def __eq__(self, other):
+        return type(other) == type(self) and other.key == self.key and other.version == self.version
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+
+class GroupRow(Row):
     def __init__(self, label, date, duration):
         self.label = label
         self.duration = duration
         self.date = date
         self.first = False # will be set by the painter, used
+        self.key = ("group", date)
 
-    def __eq__(self, other):
-        return isinstance(other, GroupRow) \
-           and self.label == other.label \
-           and self.duration == other.duration \
-           and self.date == other.date
+    @property
+    def version(self):
+        return (self.label, self.duration)
 
-    def __hash__(self):
-        return 1
 
-class FactRow(object):
+class FactRow(Row):
     def __init__(self, fact):
         self.fact = fact
         self.id = fact.id
@@ -76,38 +116,23 @@ class FactRow(object):
         self.start_time = fact.start_time
         self.end_time = fact.end_time
         self.delta = fact.delta
+        self.key = ("fact", fact.id)
 
-    def __eq__(self, other):
-        return isinstance(other, FactRow) and other.id == self.id \
-           and other.name == self.name \
-           and other.category == self.category \
-           and other.description == self.description \
-           and other.tags == self.tags \
-           and other.start_time == self.start_time \
-           and other.end_time == self.end_time \
-           and other.delta == self.delta
+    @property
+    def version(self):
+        return (self.name, self.category, self.description, tuple(self.tags),
+                self.start_time, self.end_time, self.delta)
 
 
-    def __hash__(self):
-        return self.id
-
 class RedmineFactRow(FactRow):
     def __init__(self, fact):
         FactRow.__init__(self, fact)
         self.redmine_issue_id = fact.redmine_issue_id
         self.redmine_time_activity_id = fact.redmine_time_activity_id
-    
-    def __eq__(self, other):
-      return isinstance(other, RedmineFactRow) and other.id == self.id \
-           and other.name == self.name \
-           and other.category == self.category \
-           and other.description == self.description \
-           and other.tags == self.tags \
-           and other.start_time == self.start_time \
-           and other.end_time == self.end_time \
-           and other.delta == self.delta \
-           and other.redmine_issue_id == self.redmine_issue_id \
-           and other.redmine_time_activity_id == self.redmine_time_activity_id
+
+    @property
+    def version(self):
+        return FactRow.version.fget(self) + (self.redmine_issue_id, self.redmine_time_activity_id)
 
 class FactTree(gtk.TreeView):
     __gsignals__ = {
@@ -160,7 +185,7 @@ class FactTree(gtk.TreeView):
         self._test_layout = _test_context.create_layout()
         font = pango.FontDescription(gtk.Style().font_desc.to_string())
         self._test_layout.set_font_description(font)
-        self.prev_rows = []
+        self._text_widths = {} # markup -> width, the layout is slow to ask
         self.new_rows = []
 
         self.connect("destroy", self.on_destroy)
@@ -183,22 +208,27 @@ class FactTree(gtk.TreeView):
         self.longest_interval = 0
         self.longest_duration = 0
 
+    def text_width(self, markup):
+        """width of the markup as laid out, measured once per string"""
+        width = self._text_widths.get(markup)
+        if width is None:
+            if len(self._text_widths) > 10000:
+                self._text_widths = {}
+            self._test_layout.set_markup(markup)
+            width = self._text_widths[markup] = self._test_layout.get_pixel_size()[0]
+        return width
+
     def update_longest_dimensions(self, fact):
         interval = "%s -" % fact.start_time.strftime("%H:%M")
         if fact.end_time:
             interval = "%s %s" % (interval, fact.end_time.strftime("%H:%M"))
-        self._test_layout.set_markup(interval)
-        w, h = self._test_layout.get_pixel_size()
-        self.longest_interval = max(self.longest_interval, w + 20)
+        self.longest_interval = max(self.longest_interval, self.text_width(interval) + 20)
 
-
-        self._test_layout.set_markup("%s - <small>%s</small> " % (stuff.escape_pango(fact.name),
-                                                                  stuff.escape_pango(fact.category)))
-        w, h = self._test_layout.get_pixel_size()
+        w = self.text_width("%s - <small>%s</small> " % (stuff.escape_pango(fact.name),
+                                                         stuff.escape_pango(fact.category)))
         self.longest_activity_category = max(self.longest_activity_category, w + 10)
 
-        self._test_layout.set_markup("%s" % stuff.format_duration(fact.delta))
-        w, h = self._test_layout.get_pixel_size()
+        w = self.text_width("%s" % stuff.format_duration(fact.delta))
         self.longest_duration = max(self.longest_duration, w)
 
 
@@ -220,6 +250,16 @@ class FactTree(gtk.TreeView):
             self.add_fact(fact)
 
 
+    def update_running(self, fact_id, delta):
+        """moves duration of the ongoing fact along, without a reload"""
+        for row in self.store_model:
+            if isinstance(row[0], FactRow) and row[0].id == fact_id:
+                row[0].delta = delta
+                self.update_longest_dimensions(row[0])
+                self.store_model.row_changed(row.path, row.iter)
+                return
+
+
     def get_row(self, path):
         """checks if the path is valid and if so, returns the model row"""
         if path is None or path < 0: return None
@@ -242,7 +282,6 @@ class FactTree(gtk.TreeView):
 
 
     def detach_model(self):
-        self.prev_rows = list(self.new_rows)
         self.new_rows = []
         # ooh, somebody is going for refresh!
         # let's save selection too - maybe it will come handy
@@ -257,39 +296,44 @@ class FactTree(gtk.TreeView):
 
 
     def attach_model(self):
-        prev_rows = set(self.prev_rows)
-        new_rows = set(self.new_rows)
-        common = set(prev_rows) & set(new_rows)
-
-        if common: # do full refresh only if we don't recognize any rows
-            gone = prev_rows - new_rows
-            if gone:
-                all_rows = len(self.store_model)
-                rows = list(self.store_model)
-                rows.reverse()
-
-                for i, row in enumerate(rows):
-                    if row[0] in gone:
-                        self.store_model.remove(self.store_model.get_iter(all_rows - i-1))
-
-                self.prev_rows = [row[0] for row in self.store_model]
-
-            new = new_rows - prev_rows
-            if new:
-                for i, row in enumerate(self.new_rows):
-                    if i <= len(self.store_model) - 1:
-                        if row == self.store_model[i][0]:
-                            continue
-
-                        self.store_model.insert_before(self.store_model.get_iter(i), (row,))
-                    else:
-                        self.store_model.append((row, ))
+        """brings the store in line with the new rows. rows are matched by
+        their key - the longest run of them that has kept its order stays
+        put, the rest are taken out and put back where they belong now.
+        rows that have changed are updated in place"""
+        model = self.store_model
+        positions = dict((row.key, i) for i, row in enumerate(self.new_rows))
+
+        # rows that are still there, with where they are going to be
+        gone, staying = [], []
+        iter = model.get_iter_first()
+        while iter:
+            pos = positions.get(model.get_value(iter, 0).key)
+            if pos is None:
+                gone.append(iter)
+            else:
+                staying.append((iter, pos))
+            iter = model.iter_next(iter)
 
+        kept = set([staying[i][1] for i in longest_increasing([pos for iter, pos in staying])])
 
-        else:
-            self.store_model.clear()
+        if not kept:
+            model.clear()
             for row in self.new_rows:
-                self.store_model.append((row, ))
+                model.append((row, ))
+        else:
+            # list store iters live on as long as their row does
+            gone.extend([iter for iter, pos in staying if pos not in kept])
+            for iter in gone:
+                model.remove(iter)
+
+            iter = model.get_iter_first()
+            for i, row in enumerate(self.new_rows):
+                if i in kept:
+                    if model.get_value(iter, 0) != row:
+                        model.set_value(iter, 0, row)
+                    iter = model.iter_next(iter)
+                else:
+                    model.insert_before(iter, (row, ))
 
         if self.stored_selection:
             self.restore_selection()
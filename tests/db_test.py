@@ -0,0 +1,585 @@
+import sys, os.path
+# hamster module lives in src
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import unittest
+import shutil
+import tempfile
+import random
+import datetime as dt
+from hamster import db
+
+
+class RecordingStorage(db.Storage):
+    """storage that remembers every select it has run so we can look at the
+    query plans afterwards"""
+    def __init__(self, *args, **kwargs):
+        self.queries = []
+        db.Storage.__init__(self, *args, **kwargs)
+
+    def fetchall(self, query, params = None):
+        self.queries.append((query, params or ()))
+        return db.Storage.fetchall(self, query, params)
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.storage = RecordingStorage(database_dir = self.db_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+
+    def add(self, activity, start_time, end_time = None):
+        return self.storage.add_fact(activity, start_time, end_time)
+
+
+class TestQueryPlans(StorageTestCase):
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        day = dt.datetime(2013, 5, 6, 9, 0)
+        for i in range(20):
+            start = day + dt.timedelta(days = i)
+            self.add("work@hamster, planning #tag%d" % (i % 3), start, start + dt.timedelta(hours = 2))
+        self.add("ongoing@hamster", dt.datetime.now() - dt.timedelta(minutes = 30))
+
+    def full_scans(self, call, *args):
+        """runs the call and returns query plan lines that read a whole table.
+        going through an already filtered subquery is fine"""
+        self.storage.queries = []
+        call(*args)
+
+        scans = []
+        for query, params in list(self.storage.queries):
+            for row in self.storage.connection.execute("EXPLAIN QUERY PLAN " + query, params):
+                detail = row[-1]
+                if detail.startswith("SCAN") and "VIRTUAL TABLE" not in detail and "subquery" not in detail:
+                    scans.append("%s\n%s" % (detail, query))
+        return scans
+
+    def test_schema_version(self):
+        self.assertEquals(self.storage.fetchone("SELECT version FROM version")[0], 17)
+
+    def test_day_range(self):
+        self.assertEquals(self.full_scans(self.storage.get_facts, dt.date(2013, 5, 10), None, ""), [])
+
+    def test_week_range(self):
+        self.assertEquals(self.full_scans(self.storage.get_facts, dt.date(2013, 5, 6), dt.date(2013, 5, 12), ""), [])
+
+    def test_todays_facts(self):
+        self.assertEquals(self.full_scans(self.storage.get_todays_facts), [])
+
+    def test_get_fact(self):
+        self.assertEquals(self.full_scans(self.storage.get_fact, 3), [])
+
+    def test_search(self):
+        self.assertEquals(self.full_scans(self.storage.get_facts, dt.date(2013, 5, 6), dt.date(2013, 5, 12), "plan, tag1"), [])
+
+    def test_redmine_issues(self):
+        self.storage.update_redmine_issues([(12, u"Fix the bug", u"Hamster", "2013-05-06T09:00:00Z")])
+        self.assertEquals(self.full_scans(self.storage.get_redmine_issue_id, u"Fix the bug"), [])
+        self.assertEquals(self.full_scans(self.storage.search_redmine_issues, u"bug, 12"), [])
+
+
+class TestFacts(StorageTestCase):
+    def test_range_includes_spanning_and_open_facts(self):
+        self.add("before", dt.datetime(2013, 5, 5, 9, 0), dt.datetime(2013, 5, 5, 10, 0))
+        spanning = self.add("spanning", dt.datetime(2013, 5, 6, 4, 0), dt.datetime(2013, 5, 6, 9, 0))
+        inside = self.add("inside", dt.datetime(2013, 5, 6, 12, 0), dt.datetime(2013, 5, 6, 13, 0))
+        self.add("after", dt.datetime(2013, 5, 8, 12, 0), dt.datetime(2013, 5, 8, 13, 0))
+
+        facts = self.storage.get_facts(dt.date(2013, 5, 6), None, "")
+        self.assertEquals([fact["id"] for fact in facts], [spanning, inside])
+
+
+    def test_day_assignment(self):
+        # facts are inserted directly as add_fact would not let them overlap
+        rnd = random.Random(1)
+        today = dt.date.today()
+        first_day = today - dt.timedelta(days = 6)
+        facts = []
+        for i in range(300):
+            start = dt.datetime.combine(first_day, dt.time()) + dt.timedelta(minutes = rnd.randint(0, 8 * 24 * 60))
+            end = start + dt.timedelta(minutes = rnd.choice([1, 30, 240, 600, 1500, 2000]))
+            if rnd.random() < 0.1:
+                end = None
+            facts.append((start, end))
+        self.storage.executemany("INSERT INTO facts (activity_id, start_time, end_time) VALUES (-1, ?, ?)", facts)
+        facts = dict((row["id"], row) for row in self.storage.fetchall("SELECT id, start_time, end_time FROM facts"))
+
+        def hamster_day(fact, split_time = dt.time(5)):
+            """the heuristics as they used to be done in python"""
+            if fact["end_time"]:
+                fact_end_time = fact["end_time"]
+            elif (dt.date.today() - fact["start_time"].date()) <= dt.timedelta(days=1):
+                fact_end_time = dt.datetime.now().replace(microsecond = 0)
+            else:
+                fact_end_time = fact["start_time"]
+
+            fact_start_date = fact["start_time"].date() \
+                - dt.timedelta(1 if fact["start_time"].time() < split_time else 0)
+            fact_end_date = fact_end_time.date() \
+                - dt.timedelta(1 if fact_end_time.time() < split_time else 0)
+
+            fact_date = fact_start_date
+            if (fact_end_date - fact_start_date).days == 1:
+                datetime_split = dt.datetime.combine(fact_end_date, split_time)
+                if datetime_split - fact["start_time"] <= fact_end_time - datetime_split:
+                    fact_date = fact_end_date
+            return fact_date, fact_end_time - fact["start_time"]
+
+        for date, end_date in [(first_day, today), (first_day + dt.timedelta(days = 2), None), (today, None)]:
+            result = self.storage.get_facts(date, end_date, "")
+            expected = []
+            for fact in facts.values():
+                fact_date, delta = hamster_day(fact)
+                if date <= fact_date <= (end_date or date):
+                    expected.append((fact["id"], fact_date, delta))
+            self.assertEquals(sorted((fact["id"], fact["date"], fact["delta"]) for fact in result), sorted(expected))
+
+    def test_iter_facts(self):
+        start = dt.datetime(2013, 1, 1, 9, 0)
+        for i in range(0, 200, 3):
+            self.add("day %d" % i, start + dt.timedelta(days = i), start + dt.timedelta(days = i, hours = 1))
+
+        facts = self.storage.get_facts(dt.date(2012, 12, 1), dt.date(2013, 8, 1), "")
+        self.assertEquals([fact["id"] for fact in self.storage.iter_facts(dt.date(2012, 12, 1), dt.date(2013, 8, 1), "", batch = 4)],
+                          [fact["id"] for fact in facts])
+
+    def test_fact_fields(self):
+        fact_id = self.add("work@hamster, writing #b #a", dt.datetime(2013, 5, 6, 9, 0), dt.datetime(2013, 5, 6, 10, 30))
+        fact = self.storage.get_facts(dt.date(2013, 5, 6), None, "")[0]
+        self.assertEquals(fact["id"], fact_id)
+        self.assertEquals(fact["start_time"], dt.datetime(2013, 5, 6, 9, 0))
+        self.assertEquals(fact["end_time"], dt.datetime(2013, 5, 6, 10, 30))
+        self.assertEquals((fact["name"], fact["category"], fact["description"]), ("work", "hamster", "writing"))
+        self.assertEquals(fact["tags"], ["a", "b"])
+        self.assertEquals(fact["delta"], dt.timedelta(minutes = 90))
+
+
+class TestOverlaps(StorageTestCase):
+    def facts(self):
+        return [(fact["name"], fact["start_time"].time(), fact["end_time"].time(), fact["tags"])
+                for fact in self.storage.get_facts(dt.date(2013, 5, 6), None, "")]
+
+    def at(self, hour, minute = 0):
+        return dt.datetime(2013, 5, 6, hour, minute)
+
+    def test_split(self):
+        self.add("coding@hamster, #bugs", self.at(9), self.at(12))
+        self.add("meeting", self.at(10), self.at(11))
+        self.assertEquals(self.facts(), [("coding", dt.time(9), dt.time(10), ["bugs"]),
+                                         ("meeting", dt.time(10), dt.time(11), []),
+                                         ("coding", dt.time(11), dt.time(12), ["bugs"])])
+
+    def test_shifts(self):
+        self.add("first", self.at(9), self.at(11))
+        # facts that end up inside the new one are kept as they are
+        self.add("second", self.at(11), self.at(13))
+        self.add("enclosed", self.at(14), self.at(15))
+        self.add("middle", self.at(10), self.at(16))
+        self.assertEquals(self.facts(), [("first", dt.time(9), dt.time(10), []),
+                                         ("middle", dt.time(10), dt.time(16), []),
+                                         ("second", dt.time(11), dt.time(13), []),
+                                         ("enclosed", dt.time(14), dt.time(15), [])])
+
+    def test_intervals_follow_facts(self):
+        fact_id = self.add("coding", self.at(9), self.at(12))
+        self.add("meeting", self.at(10), self.at(11))
+        self.storage.remove_fact(fact_id)
+        self.add("open", self.at(13))
+
+        intervals = self.storage.fetchall("SELECT id, start_time, end_time FROM fact_intervals ORDER BY id")
+        expected = self.storage.fetchall("""SELECT id, strftime('%s', start_time), strftime('%s', coalesce(end_time, start_time))
+                                              FROM facts ORDER BY id""")
+        self.assertEquals([row[0] for row in intervals], [row[0] for row in expected])
+        # bounds are kept as 32 bit floats, rounded outwards
+        for interval, fact in zip(intervals, expected):
+            self.assertTrue(0 <= int(fact[1]) - interval[1] < 300 and 0 <= interval[2] - int(fact[2]) < 300)
+
+    def test_uses_intervals(self):
+        self.add("coding", self.at(9), self.at(12))
+        self.storage.queries = []
+        self.add("meeting", self.at(10), self.at(11))
+
+        plans = []
+        for query, params in self.storage.queries:
+            if "fact_intervals" in query:
+                plans.extend(row[-1] for row in self.storage.connection.execute("EXPLAIN QUERY PLAN " + query, params))
+        self.assertTrue(plans)
+        self.assertEquals([plan for plan in plans if plan.startswith("SCAN") and "VIRTUAL TABLE" not in plan], [])
+
+
+class TestTotals(StorageTestCase):
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.add("coding@hamster, #bugs #docs", dt.datetime(2013, 5, 6, 9, 0), dt.datetime(2013, 5, 6, 10, 0))
+        self.add("meeting@office", dt.datetime(2013, 5, 6, 10, 0), dt.datetime(2013, 5, 6, 10, 30))
+        self.add("coding@hamster, #bugs", dt.datetime(2013, 5, 7, 9, 0), dt.datetime(2013, 5, 7, 11, 0))
+        # spans the day split, most of it on the 8th
+        self.add("coding@hamster", dt.datetime(2013, 5, 8, 4, 0), dt.datetime(2013, 5, 8, 7, 0))
+
+    def totals(self, group_by, search_terms = ""):
+        res = self.storage.get_totals(dt.date(2013, 5, 6), dt.date(2013, 5, 12), search_terms, group_by)
+        return [(row["key"], row["delta"], row["facts"]) for row in res]
+
+    def test_matches_facts(self):
+        for group_by, keyfunc in (("category", lambda fact: [fact["category"]]),
+                                  ("activity", lambda fact: [fact["name"]]),
+                                  ("tag", lambda fact: fact["tags"]),
+                                  ("day", lambda fact: [fact["date"]]),
+                                  ("weekday", lambda fact: [fact["date"].weekday()]),
+                                  ("year", lambda fact: [fact["date"].year])):
+            expected = {}
+            for fact in self.storage.get_facts(dt.date(2013, 5, 6), dt.date(2013, 5, 12), ""):
+                for key in keyfunc(fact):
+                    delta, count = expected.get(key, (dt.timedelta(), 0))
+                    expected[key] = (delta + fact["delta"], count + 1)
+            expected = sorted((key, delta, count) for key, (delta, count) in expected.items())
+            self.assertEquals(self.totals(group_by), expected)
+
+    def test_total(self):
+        self.assertEquals(self.totals(None), [("", dt.timedelta(hours = 6, minutes = 30), 4)])
+        self.assertEquals(self.totals(None, "meeting"), [("", dt.timedelta(minutes = 30), 1)])
+        self.assertEquals(self.totals("day", "nothing"), [])
+
+    def test_unknown_group(self):
+        self.assertRaises(ValueError, self.totals, "month")
+
+
+class TestSearch(StorageTestCase):
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.day = dt.date(2013, 5, 6)
+        start = dt.datetime(2013, 5, 6, 9, 0)
+        self.coding = self.add("coding@hamster, fixing things #bugs", start, start + dt.timedelta(hours = 1))
+        start += dt.timedelta(hours = 1)
+        self.meeting = self.add("meeting@office, weekly sync", start, start + dt.timedelta(hours = 1))
+
+    def search(self, terms):
+        return [fact["id"] for fact in self.storage.get_facts(self.day, None, terms)]
+
+    def test_terms(self):
+        self.assertEquals(self.search("coding"), [self.coding])
+        self.assertEquals(self.search("cod"), [self.coding])
+        self.assertEquals(self.search("office sync"), [self.meeting])
+        self.assertEquals(self.search("bugs, weekly"), [self.coding, self.meeting])
+        self.assertEquals(self.search("coding weekly"), [])
+
+    def test_unsorted(self):
+        start = dt.datetime(2013, 5, 6, 11, 0)
+        lunch = self.add("lunch, with the team", start, start + dt.timedelta(hours = 1))
+        self.assertEquals(self.search("unsorted"), [lunch])
+        self.assertEquals(self.search("Unso team"), [lunch])
+        self.assertEquals(self.search("unsorted sync"), [])
+        self.assertEquals(self.search("unsorted, bugs"), [self.coding, lunch])
+
+    def test_odd_input(self):
+        self.assertEquals(self.search('"'), [self.coding, self.meeting])
+        self.assertEquals(self.search("it's"), [])
+        self.assertEquals(self.search("100%_ AND"), [])
+
+    def test_updates_follow(self):
+        category_id = self.storage.get_category_id("office")
+        self.storage.update_category(category_id, "boardroom")
+        self.assertEquals(self.search("boardroom"), [self.meeting])
+        self.assertEquals(self.search("office"), [])
+
+        activity = self.storage.get_activity_by_name("coding", self.storage.get_category_id("hamster"))
+        self.storage.update_activity(activity["id"], "hacking", self.storage.get_category_id("hamster"))
+        self.assertEquals(self.search("hacking"), [self.coding])
+
+        fact_id = self.storage.update_fact(self.coding, "coding@hamster, fixing #features",
+                                           dt.datetime(2013, 5, 6, 9, 0), dt.datetime(2013, 5, 6, 10, 0))
+        self.assertEquals(self.search("features"), [fact_id])
+        self.assertEquals(self.search("bugs"), [])
+
+        self.storage.remove_fact(fact_id)
+        self.assertEquals(self.storage.fetchone("SELECT count(*) FROM fact_index")[0], 1)
+
+
+class TestCatalog(StorageTestCase):
+    def test_fact_insert_skips_catalog(self):
+        day = dt.datetime(2013, 5, 6, 9, 0)
+        self.add("coding@hamster, #bugs", day, day + dt.timedelta(hours = 1))
+
+        self.storage.queries = []
+        self.add("Coding@Hamster, #bugs", day + dt.timedelta(hours = 2), day + dt.timedelta(hours = 3))
+        touched = [query for query, params in self.storage.queries
+                   if any(table in query for table in ("activities", "categories", "tags"))]
+        self.assertEquals(touched, [])
+
+        facts = self.storage.get_facts(day.date(), None, "")
+        self.assertEquals(len(set(fact["activity_id"] for fact in facts)), 1)
+
+    def test_own_changes(self):
+        category_id = self.storage.add_category("hamster")
+        self.assertEquals(self.storage.get_category_id("Hamster"), category_id)
+        self.storage.update_category(category_id, "project")
+        self.assertEquals(self.storage.get_category_id("hamster"), None)
+        self.assertEquals(self.storage.get_category_id("project"), category_id)
+
+        activity_id = self.storage.add_activity("coding", category_id)
+        self.assertEquals(self.storage.get_activity_by_name("coding", category_id)["category"], "project")
+        self.storage.remove_activity(activity_id)
+        self.assertEquals(self.storage.get_activity_by_name("coding", category_id), {})
+
+    def test_others_changes(self):
+        category_id = self.storage.add_category("hamster")
+        self.assertEquals(self.storage.get_category_id("hamster"), category_id)
+
+        other = db.sqlite.connect(self.storage.db_path)
+        other.execute("UPDATE categories SET name = 'project' WHERE id = ?", (category_id,))
+        other.commit()
+        other.close()
+
+        self.assertEquals(self.storage.get_category_id("hamster"), None)
+        self.assertEquals(self.storage.get_category_id("project"), category_id)
+
+
+class TestActivities(StorageTestCase):
+    def names(self, search):
+        return [activity["name"] for activity in self.storage.get_activities(search)]
+
+    def stats(self):
+        return self.storage.fetchall("SELECT activity_id, last_used, facts FROM activity_stats ORDER BY activity_id")
+
+    def expected_stats(self):
+        return self.storage.fetchall("""SELECT activity_id, max(start_time), count(*)
+                                          FROM facts GROUP BY activity_id ORDER BY activity_id""")
+
+    def assertStats(self):
+        # last use comes back as datetime from the stats and as text from max()
+        rows = lambda rows: [tuple(unicode(value) for value in row) for row in rows]
+        self.assertEquals(rows(self.stats()), rows(self.expected_stats()))
+
+    def test_ranking(self):
+        day = dt.datetime(2013, 5, 6, 9, 0)
+        self.add("code review", day)
+        self.add("coding", day + dt.timedelta(hours = 1))
+        self.add("decoding", day + dt.timedelta(hours = 2))
+        self.add("cooking", day - dt.timedelta(days = 1))
+        self.storage.add_activity("cocoa")
+
+        # prefix matches first, most recent on top, then the ones that have
+        # it in the middle. never used ones go last
+        self.assertEquals(self.names("co"), ["coding", "code review", "cooking", "cocoa", "decoding"])
+        self.assertEquals(self.names("cod"), ["coding", "code review", "decoding"])
+        self.assertEquals(self.names("review"), ["code review"])
+        self.assertEquals(self.names("")[0], "decoding")
+
+    def test_stats_follow_facts(self):
+        day = dt.datetime(2013, 5, 6, 9, 0)
+        first = self.add("coding", day, day + dt.timedelta(hours = 1))
+        latest = self.add("coding", day + dt.timedelta(days = 1))
+        self.add("meeting", day + dt.timedelta(hours = 2))
+        self.assertStats()
+
+        self.storage.remove_fact(latest)
+        self.assertStats()
+
+        self.storage.update_fact(first, "meeting", day + dt.timedelta(hours = 3), None)
+        self.assertEquals([row["facts"] for row in self.stats()], [0, 2])
+        self.assertEquals(self.stats()[0]["last_used"], None)
+        self.assertEquals(self.names("")[:2], ["meeting", "coding"])
+
+    def test_no_facts_read(self):
+        day = dt.datetime(2013, 5, 6, 9, 0)
+        for i in range(20):
+            self.add("activity %d" % (i % 5), day + dt.timedelta(hours = i))
+
+        self.storage.queries = []
+        self.storage.get_activities("act")
+        for query, params in self.storage.queries:
+            plan = [row[-1] for row in self.storage.connection.execute("EXPLAIN QUERY PLAN " + query, params)]
+            self.assertEquals([detail for detail in plan if "facts" in detail], [])
+
+
+class TestAddFacts(StorageTestCase):
+    def batch(self, count, day = dt.datetime(2013, 5, 6, 9, 0)):
+        facts = []
+        for i in range(count):
+            start = day + dt.timedelta(hours = i)
+            facts.append(("coding@hamster, #bugs #tag%d" % (i % 3), start, start + dt.timedelta(minutes = 50), -1, -1))
+        return facts
+
+    def test_matches_one_by_one(self):
+        facts = self.batch(10)
+        ids = self.storage.add_facts(facts)
+        self.assertEquals(len(ids), 10)
+        batch = self.storage.get_facts(dt.date(2013, 5, 6), dt.date(2013, 5, 7), "")
+
+        self.tearDown()
+        self.setUp()
+        for fact in facts:
+            self.storage.add_fact(*fact)
+        single = self.storage.get_facts(dt.date(2013, 5, 6), dt.date(2013, 5, 7), "")
+
+        fields = lambda fact: (fact["start_time"], fact["end_time"], fact["name"], fact["category"], fact["tags"])
+        self.assertEquals([fields(fact) for fact in batch], [fields(fact) for fact in single])
+        self.assertEquals(ids, [fact["id"] for fact in batch])
+
+    def test_lookups_once(self):
+        self.storage.queries = []
+        self.storage.add_facts(self.batch(30))
+        lookups = [query for query, params in self.storage.queries if "from categories" in query.lower()]
+        self.assertEquals(len(lookups), 1)
+        tag_lookups = [query for query, params in self.storage.queries if "from tags" in query.lower()]
+        self.assertTrue(len(tag_lookups) <= 2) # the second one after creating them
+
+    def test_signals_once(self):
+        signals = []
+        self.storage.facts_changed = lambda: signals.append("facts")
+        self.storage.tags_changed = lambda: signals.append("tags")
+        self.storage.add_facts(self.batch(5))
+        self.assertEquals(sorted(signals), ["facts", "tags"])
+
+    def test_skips_and_rolls_back(self):
+        facts = self.batch(2) + [("", dt.datetime(2013, 5, 7, 9, 0), None, -1, -1)]
+        self.assertEquals(self.storage.add_facts(facts)[2], 0)
+
+        self.assertRaises(Exception, self.storage.add_facts, self.batch(2, dt.datetime(2013, 6, 1, 9, 0)) + [("broken", "no time", None, -1, -1)])
+        self.assertEquals(self.storage.get_facts(dt.date(2013, 6, 1), None, ""), [])
+
+
+class TestTimeEntryOutbox(StorageTestCase):
+    def test_one_entry_per_fact(self):
+        day = dt.date(2013, 5, 6)
+        self.assertEquals(self.storage.queue_time_entry(1, 12, 8, 1.5, "coding", day), "pending")
+        self.assertEquals(self.storage.queue_time_entry(1, 12, 8, 2.0, "coding", day), "pending")
+        self.storage.queue_time_entry(2, 13, 8, 0.5, "docs", day)
+
+        due = self.storage.get_due_time_entries()
+        self.assertEquals([(entry["fact_id"], entry["hours"]) for entry in due], [(1, 2.0), (2, 0.5)])
+
+        self.storage.time_entry_sent(1)
+        # sent entries are not touched when queued again
+        self.assertEquals(self.storage.queue_time_entry(1, 12, 8, 3.0, "coding", day), "sent")
+        self.assertEquals([entry["fact_id"] for entry in self.storage.get_due_time_entries()], [2])
+
+    def test_retries(self):
+        now = dt.datetime(2013, 5, 6, 12, 0)
+        self.storage.queue_time_entry(1, 12, 8, 1.5, "coding", now.date())
+        self.storage.queue_time_entry(2, 13, 8, 0.5, "docs", now.date())
+
+        self.storage.time_entry_failed(1, "timed out", now + dt.timedelta(minutes = 1))
+        self.storage.time_entry_failed(2, "unprocessable")
+        self.assertEquals(self.storage.get_due_time_entries(now), [])
+        due = self.storage.get_due_time_entries(now + dt.timedelta(minutes = 1))
+        self.assertEquals([(entry["fact_id"], entry["attempts"]) for entry in due], [(1, 1)])
+
+        status = self.storage.get_time_entry_status(2)
+        self.assertEquals((status["status"], status["last_error"]), ("rejected", "unprocessable"))
+        self.assertEquals(self.storage.get_time_entry_status(3), None)
+
+
+class TestRedmineIssues(StorageTestCase):
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.issues = [(12, u"Fix the bug", u"Hamster", "2013-05-06T09:00:00Z"),
+                       (13, u"Write docs", u"Hamster", "2013-05-07T09:00:00Z"),
+                       (14, u"Release notes", u"Website", "2013-05-05T09:00:00Z")]
+        self.storage.update_redmine_issues(self.issues)
+
+    def search(self, search):
+        return [issue["id"] for issue in self.storage.search_redmine_issues(search)]
+
+    def test_search(self):
+        self.assertEquals(self.search(""), [13, 12, 14])
+        self.assertEquals(self.search("hams"), [13, 12])
+        self.assertEquals(self.search("re no"), [14])
+        self.assertEquals(self.search("bug, web"), [12, 14])
+        self.assertEquals(self.search("#14"), [14])
+        self.assertEquals(self.search("nothing"), [])
+
+    def test_update(self):
+        self.assertEquals(self.storage.update_redmine_issues(self.issues), 0)
+
+        # 12 renamed, 13 gone, 15 new
+        issues = [(12, u"Fix the crash", u"Hamster", "2013-05-08T09:00:00Z"),
+                  self.issues[2],
+                  (15, u"Translations", u"Hamster", "2013-05-01T09:00:00Z")]
+        self.assertEquals(self.storage.update_redmine_issues(issues), 3)
+        self.assertEquals(self.search("hamster"), [12, 15])
+        self.assertEquals(self.search("bug"), [])
+        self.assertEquals(self.search("crash"), [12])
+
+    def test_issue_id(self):
+        self.assertEquals(self.storage.get_redmine_issue_id(u"Write docs"), 13)
+        self.assertEquals(self.storage.get_redmine_issue_id(u"Write"), None)
+
+
+class TestConnection(StorageTestCase):
+    def test_wal(self):
+        self.assertEquals(self.storage.fetchone("PRAGMA journal_mode")[0], "wal")
+
+    def test_readers_do_not_block_writes(self):
+        self.add("coding@hamster", dt.datetime(2013, 5, 6, 9, 0), dt.datetime(2013, 5, 6, 10, 0))
+
+        # a reader in the middle of a long read, like an export would be
+        reader = db.sqlite.connect(self.storage.db_path, timeout = 0.1, isolation_level = None)
+        reader.execute("BEGIN")
+        self.assertEquals(reader.execute("SELECT count(*) FROM facts").fetchone()[0], 1)
+
+        self.add("meeting@office", dt.datetime(2013, 5, 6, 10, 0), dt.datetime(2013, 5, 6, 11, 0))
+
+        # reader keeps seeing what it started with
+        self.assertEquals(reader.execute("SELECT count(*) FROM facts").fetchone()[0], 1)
+        reader.execute("COMMIT")
+        self.assertEquals(reader.execute("SELECT count(*) FROM facts").fetchone()[0], 2)
+        reader.close()
+
+
+class TestChanges(StorageTestCase):
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.changes = []
+        self.storage.facts_changed_detailed = lambda *args: self.changes.append(("facts",) + args)
+        self.storage.activities_changed_detailed = lambda *args: self.changes.append(("activities",) + args)
+        self.storage.tags_changed_detailed = lambda *args: self.changes.append(("tags",) + args)
+
+    def facts_changes(self):
+        return [change[1:] for change in self.changes if change[0] == "facts"]
+
+    def test_add_and_remove(self):
+        fact_id = self.add("coding@hamster", dt.datetime(2013, 5, 6, 9, 0), dt.datetime(2013, 5, 7, 10, 0))
+        self.assertEquals(self.facts_changes(), [([fact_id], dt.date(2013, 5, 6), dt.date(2013, 5, 7))])
+
+        self.changes = []
+        self.storage.remove_fact(fact_id)
+        self.assertEquals(self.facts_changes(), [([fact_id], dt.date(2013, 5, 6), dt.date(2013, 5, 7))])
+
+    def test_update_spans_old_and_new(self):
+        fact_id = self.add("coding@hamster", dt.datetime(2013, 5, 6, 9, 0), dt.datetime(2013, 5, 6, 10, 0))
+        self.changes = []
+        new_id = self.storage.update_fact(fact_id, "coding@hamster", dt.datetime(2013, 5, 9, 9, 0), dt.datetime(2013, 5, 9, 10, 0))
+        self.assertEquals(self.facts_changes(), [(sorted([fact_id, new_id]), dt.date(2013, 5, 6), dt.date(2013, 5, 9))])
+
+    def test_overlap_reports_neighbours(self):
+        first = self.add("coding@hamster", dt.datetime(2013, 5, 6, 9, 0), dt.datetime(2013, 5, 6, 12, 0))
+        self.changes = []
+        second = self.add("meeting@office", dt.datetime(2013, 5, 6, 10, 0), dt.datetime(2013, 5, 6, 11, 0))
+        ids = self.facts_changes()[0][0]
+        self.assertTrue(first in ids and second in ids)
+        # the split off tail of the first one is a new fact too
+        self.assertEquals(len(ids), 3)
+
+    def test_day_start(self):
+        fact_id = self.add("late", dt.datetime(2013, 5, 7, 1, 0), dt.datetime(2013, 5, 7, 2, 0))
+        self.assertEquals(self.facts_changes(), [([fact_id], dt.date(2013, 5, 6), dt.date(2013, 5, 6))])
+
+    def test_activities_and_tags(self):
+        self.add("coding@hamster, #bugs", dt.datetime(2013, 5, 6, 9, 0), dt.datetime(2013, 5, 6, 10, 0))
+        tag_id = self.storage.fetchone("SELECT id FROM tags WHERE name = 'bugs'")[0]
+        self.assertEquals([change for change in self.changes if change[0] == "tags"], [("tags", [tag_id])])
+
+        self.changes = []
+        category_id = self.storage.get_category_id("hamster")
+        self.storage.update_category(category_id, "hamster project")
+        changes = [change for change in self.changes if change[0] == "activities"]
+        self.assertEquals(len(changes), 1)
+        self.assertEquals(changes[0][2], [category_id])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+# - coding: utf-8 -
+import sys, os.path
+# hamster module lives in src
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import unittest
+import shutil
+import tempfile
+import datetime as dt
+from hamster import importers, db
+from hamster.lib import Fact, RedmineFact, i18n
+try:
+    from hamster import reports
+except ImportError:
+    reports = None # the writers need the gtk stack
+
+
+# what reports.TSVWriter, XMLWriter and ICalWriter put out
+TSV = """activity\tstart time\tend time\tduration minutes\tcategory\tdescription\ttags\tredmine_issue\tredmine_activity
+coding\t2013-05-06 09:00:00\t2013-05-06 10:30:00\t90\thamster\tfixing \xc4\x81 bug\tbugs, urgent\t-1\t-1
+meeting\t2013-05-06 10:30:00\t2013-05-06 11:00:00\t30\tUnsorted\t\t\t12\t3
+broken\tnot a time\t\t0\t\t\t\t-1\t-1
+"""
+
+XML = """<?xml version="1.0" ?><activities><activity category="hamster" description="fixing \xc4\x81 bug" duration_minutes="90" end_time="2013-05-06 10:30:00" name="coding" redmine_activity="-1" redmine_issue="-1" start_time="2013-05-06 09:00:00" tags="bugs, urgent"/><activity category="Unsorted" description="" duration_minutes="30" end_time="2013-05-06 11:00:00" name="meeting" redmine_activity="3" redmine_issue="12" start_time="2013-05-06 10:30:00" tags=""/></activities>"""
+
+ICAL = """BEGIN:VCALENDAR
+VERSION:1.0
+BEGIN:VEVENT
+CATEGORIES:hamster
+DTSTART:20130506T090000
+DTEND:20130506T103000
+SUMMARY:coding
+DESCRIPTION:fixing \xc4\x81 bug
+REDMINEISSUE:-1
+REDMINEACTIVITY:-1
+END:VEVENT
+BEGIN:VEVENT
+CATEGORIES:
+DTSTART:20130506T103000
+DTEND:20130506T110000
+SUMMARY:meeting
+DESCRIPTION:
+REDMINEISSUE:12
+REDMINEACTIVITY:3
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+class TestReaders(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, format, contents):
+        path = os.path.join(self.dir, "export." + format)
+        with open(path, "w") as f:
+            f.write(contents)
+        return list(importers.read(path, format))
+
+    def check(self, facts, with_tags = True):
+        self.assertEquals(len(facts), 2)
+        coding, meeting = facts
+
+        self.assertEquals((coding.activity, coding.category, coding.description),
+                          (u"coding", u"hamster", u"fixing ā bug"))
+        self.assertEquals((coding.start_time, coding.end_time),
+                          (dt.datetime(2013, 5, 6, 9, 0), dt.datetime(2013, 5, 6, 10, 30)))
+        if with_tags:
+            self.assertEquals(coding.tags, [u"bugs", u"urgent"])
+        self.assertFalse(isinstance(coding, RedmineFact))
+
+        self.assertEquals(meeting.category, None)
+        self.assertEquals((meeting.redmine_issue_id, meeting.redmine_time_activity_id), (12, 3))
+
+    def test_tsv(self):
+        self.check(self.read("tsv", TSV))
+
+    def test_xml(self):
+        self.check(self.read("xml", XML))
+
+    def test_ical(self):
+        # ical export leaves out the tags
+        self.check(self.read("ical", ICAL), with_tags = False)
+
+    def test_ical_of_before(self):
+        # unsorted facts used to go out as None
+        self.check(self.read("ical", ICAL.replace("CATEGORIES:\n", "CATEGORIES:None\n")), with_tags = False)
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, importers.read, "export.html", "html")
+
+
+@unittest.skipIf(reports is None, "reports need gtk")
+class TestRoundTrip(unittest.TestCase):
+    def setUp(self):
+        i18n.setup_i18n()
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def facts(self):
+        start = dt.datetime(2013, 5, 6, 9, 0)
+        return [Fact.from_row(u"coding", category = u"hamster", description = u"fixing ā bug",
+                              tags = [u"bugs", u"urgent"], start_time = start,
+                              end_time = start + dt.timedelta(minutes = 90), delta = dt.timedelta(minutes = 90)),
+                RedmineFact.from_row(u"meeting", 12, 3, category = None, description = None, tags = [],
+                                     start_time = start + dt.timedelta(minutes = 90),
+                                     end_time = start + dt.timedelta(minutes = 120), delta = dt.timedelta(minutes = 30))]
+
+    def round_trip(self, format):
+        path = os.path.join(self.dir, "export." + format)
+        reports.simple(self.facts(), dt.date(2013, 5, 6), dt.date(2013, 5, 6), format, path)
+        return list(importers.read(path, format))
+
+    def check(self, facts, with_tags = True):
+        self.assertEquals([(fact.activity, fact.category, fact.description, fact.start_time, fact.end_time)
+                           for fact in facts],
+                          [(fact.activity, fact.category, fact.description, fact.start_time, fact.end_time)
+                           for fact in self.facts()])
+        self.assertEquals(facts[1].category, None)
+        self.assertEquals((facts[1].redmine_issue_id, facts[1].redmine_time_activity_id), (12, 3))
+        if with_tags:
+            self.assertEquals([fact.tags for fact in facts], [[u"bugs", u"urgent"], []])
+
+    def test_tsv(self):
+        self.check(self.round_trip("tsv"))
+
+    def test_xml(self):
+        self.check(self.round_trip("xml"))
+
+    def test_ical(self):
+        self.check(self.round_trip("ical"), with_tags = False)
+
+
+class TestImport(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage = db.Storage(database_dir = self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_facts_make_it_to_storage(self):
+        path = os.path.join(self.dir, "export.tsv")
+        with open(path, "w") as f:
+            f.write(TSV)
+
+        batch = []
+        for fact in importers.read(path, "tsv"):
+            batch.append((fact.serialized_name(), fact.start_time, fact.end_time,
+                          getattr(fact, "redmine_issue_id", -1), getattr(fact, "redmine_time_activity_id", -1)))
+        self.storage.add_facts(batch)
+
+        facts = self.storage.get_facts(dt.date(2013, 5, 6), None, "")
+        self.assertEquals([(fact["name"], fact["category"], fact["tags"]) for fact in facts],
+                          [(u"coding", u"hamster", [u"bugs", u"urgent"]), (u"meeting", u"Unsorted", [])])
+        self.assertEquals((facts[0]["redmine_issue"], facts[1]["redmine_issue"]), (-1, 12))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,405 @@
+# - coding: utf-8 -
+import sys, os.path
+# hamster module lives in src
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import unittest
+import json
+import shutil
+import tempfile
+import datetime as dt
+import hashlib
+import threading
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from hamster import redmine, outbox, sync, db
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keeps the connection open between requests
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body = None, headers = None):
+        data = json.dumps(body) if body is not None else ""
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path, dict(self.headers)))
+        if self.headers.get("X-Redmine-API-Key") != self.server.key:
+            return self.reply(401)
+
+        body = self.server.get(urlparse.urlparse(self.path))
+        if body is None:
+            return self.reply(404)
+
+        etag = '"%s"' % hashlib.md5(json.dumps(body, sort_keys = True)).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            return self.reply(304, headers = {"ETag": etag})
+        self.reply(200, body, {"ETag": etag})
+
+    def do_POST(self):
+        self.server.requests.append(("POST", self.path, dict(self.headers)))
+        entry = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["time_entry"]
+        if entry["issue_id"] not in [issue["id"] for issue in self.server.issues]:
+            return self.reply(422, {"errors": ["Issue is invalid"]})
+        self.server.add_time_entry(entry)
+        self.reply(201, {"time_entry": entry})
+
+    def do_PUT(self):
+        self.server.requests.append(("PUT", self.path, dict(self.headers)))
+        changes = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["time_entry"]
+        entry_id = int(self.path[len("/time_entries/"):-len(".json")])
+        entries = [entry for entry in self.server.time_entries if entry["id"] == entry_id]
+        if not entries:
+            return self.reply(404)
+        if changes["issue_id"] not in [issue["id"] for issue in self.server.issues]:
+            return self.reply(422, {"errors": ["Issue is invalid"]})
+        entries[0].update(changes)
+        self.reply(204)
+
+
+class StubRedmine(ThreadingMixIn, HTTPServer):
+    """just enough of redmine's rest api to talk to, on a local port"""
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StubHandler)
+        self.key = "secret"
+        self.requests, self.connections = [], 0
+        self.user_id = 7
+        self.issues = [{"id": 12, "subject": "Fix the bug"}, {"id": 13, "subject": "Write docs"}]
+        self.activities = [{"id": 8, "name": "Development"}, {"id": 9, "name": "Design"}]
+        self.time_entries = [] # as posted, with the id they got
+
+        self.thread = threading.Thread(target = self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+    def get(self, url):
+        if url.path == "/users/current.json":
+            return {"user": {"id": self.user_id}}
+        elif url.path == "/issues.json":
+            query = urlparse.parse_qs(url.query)
+            offset, limit = int(query.get("offset", [0])[0]), int(query.get("limit", [25])[0])
+            return {"issues": self.issues[offset:offset + limit], "total_count": len(self.issues),
+                    "offset": offset, "limit": limit}
+        elif url.path.startswith("/issues/"):
+            issue_id = int(url.path[len("/issues/"):-len(".json")])
+            for issue in self.issues:
+                if issue["id"] == issue_id:
+                    return {"issue": issue}
+        elif url.path == "/enumerations/time_entry_activities.json":
+            return {"time_entry_activities": self.activities}
+        elif url.path == "/time_entries.json":
+            query = urlparse.parse_qs(url.query)
+            offset, limit = int(query.get("offset", [0])[0]), int(query.get("limit", [25])[0])
+            entries = [{"id": entry["id"], "user": {"id": self.user_id},
+                        "issue": {"id": entry["issue_id"]}, "activity": {"id": entry["activity_id"]},
+                        "hours": entry["hours"], "comments": entry["comments"], "spent_on": entry["spent_on"]}
+                       for entry in self.time_entries
+                       if query["from"][0] <= entry["spent_on"] <= query["to"][0]]
+            return {"time_entries": entries[offset:offset + limit], "total_count": len(entries),
+                    "offset": offset, "limit": limit}
+        return None
+
+    def add_time_entry(self, entry):
+        entry["id"] = 1000 + len(self.time_entries)
+        self.time_entries.append(entry)
+        return entry
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def gets(self, path, method = "GET"):
+        return [request for request in self.requests if request[0] == method and request[1].startswith(path)]
+
+
+class RedmineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StubRedmine()
+        self.connector = redmine.RedmineConnector(self.server.url, self.server.key)
+
+    def tearDown(self):
+        self.connector.close()
+        self.server.stop()
+
+
+class TestConnector(RedmineTestCase):
+    def test_keeps_connection(self):
+        self.connector.get_issues()
+        self.connector.get_activities()
+        self.connector.get_arbitrary_issue_data(12)
+        self.connector.add_time_entry(12, 1.5, 8, "fixing")
+        self.assertEquals(len(self.server.requests), 5)
+        self.assertEquals(self.server.connections, 1)
+        self.assertEquals(self.server.time_entries[0]["issue_id"], 12)
+
+    def test_reconnects(self):
+        self.connector.get_activities()
+        # server closing an idle connection
+        self.connector._RedmineConnector__connection.sock.close()
+        self.connector.forget()
+        self.assertEquals(self.connector.get_redmine_activity_id("Design"), 9)
+        self.assertEquals(self.server.connections, 2)
+
+    def test_caches(self):
+        for i in range(3):
+            self.assertEquals(self.connector.get_redmine_issue_id("Write docs"), 13)
+            self.assertEquals(self.connector.get_redmine_activity_id("Development"), 8)
+        self.assertEquals(self.connector.get_redmine_issue_id("Unknown"), None)
+        self.assertEquals(len(self.server.gets("/users/current.json")), 1)
+        self.assertEquals(len(self.server.gets("/issues.json")), 1)
+        self.assertEquals(len(self.server.gets("/enumerations/")), 1)
+
+    def test_revalidates(self):
+        self.connector.issues_ttl = 0
+        self.connector.get_issues()
+        self.connector.get_issues()
+        requests = self.server.gets("/issues.json")
+        self.assertEquals(len(requests), 2)
+        self.assertTrue("if-none-match" in requests[1][2])
+
+        # a changed list comes through, and so do the ids
+        self.server.issues.append({"id": 14, "subject": "Release"})
+        self.assertEquals(self.connector.get_redmine_issue_id("Release"), 14)
+
+    def test_pages(self):
+        self.server.issues = [{"id": i, "subject": "Issue %d" % i} for i in range(1, 451)]
+        self.connector.page_size = 100
+        issues = self.connector.get_issues()
+        self.assertEquals([issue["id"] for issue in issues["issues"]], range(1, 451))
+        self.assertEquals(issues["total_count"], 450)
+        self.assertEquals(len(self.server.gets("/issues.json")), 5)
+        # first page over the kept alive connection, the rest side by side
+        self.assertEquals(self.server.connections, 1 + 4)
+
+        # unchanged pages are revalidated and the list stays the same
+        self.connector.issues_ttl = 0
+        self.assertTrue(self.connector.get_issues() is issues)
+        self.assertTrue(all("if-none-match" in request[2] for request in self.server.gets("/issues.json")[5:]))
+        self.assertEquals(self.connector.get_redmine_issue_id("Issue 321"), 321)
+
+    def test_parallel_errors(self):
+        def call(item, connection):
+            if item == "html":
+                raise ValueError("not json")
+            return item * 2
+
+        self.assertEquals(self.connector.in_parallel(range(6), call, 2), [0, 2, 4, 6, 8, 10])
+        # the worker's own exception, not a missing result
+        self.assertRaises(ValueError, self.connector.in_parallel, [1, 2, "html", 4], call, 2)
+
+    def test_check_connection(self):
+        self.assertTrue(self.connector.check_connection())
+        self.assertTrue(self.connector.check_connection())
+        self.assertEquals(len(self.server.gets("/users/current.json")), 2)
+
+        self.assertFalse(redmine.RedmineConnector(self.server.url, "wrong").check_connection())
+
+    def test_errors(self):
+        self.assertRaises(redmine.RedmineConnectionException, self.connector.get_arbitrary_issue_data, 99)
+        self.server.stop()
+        self.connector.close()
+        self.assertRaises(redmine.RedmineConnectionException, self.connector.get_arbitrary_issue_data, 12)
+        self.server = StubRedmine() # for tearDown
+
+    def test_disk_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(cache_dir, "redmine", "cache.json")
+            connector = redmine.RedmineConnector(self.server.url, self.server.key, path)
+            self.assertEquals(connector.get_cached_issues(), None)
+            issues = connector.get_issues()
+            activities = connector.get_activities()
+            connector.close()
+
+            # next run has the lists without asking
+            requests = len(self.server.requests)
+            connector = redmine.RedmineConnector(self.server.url, self.server.key, path)
+            self.assertEquals(connector.get_cached_issues(), issues)
+            self.assertEquals(connector.get_cached_activities(), activities)
+            self.assertEquals(len(self.server.requests), requests)
+
+            # and revalidates them rather than downloading again
+            connector.issues_ttl = 0
+            self.assertEquals(connector.get_issues(), issues)
+            self.assertTrue("if-none-match" in self.server.gets("/issues.json")[-1][2])
+            connector.close()
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_shared_connectors(self):
+        self.assertTrue(redmine.get_connector(self.server.url, "a") is redmine.get_connector(self.server.url, "a"))
+        self.assertFalse(redmine.get_connector(self.server.url, "a") is redmine.get_connector(self.server.url, "b"))
+
+
+class TestOutbox(RedmineTestCase):
+    def setUp(self):
+        RedmineTestCase.setUp(self)
+        self.db_dir = tempfile.mkdtemp()
+        self.storage = db.Storage(database_dir = self.db_dir)
+        self.outbox = outbox.TimeEntryOutbox(self.storage, lambda: self.connector)
+        self.now = dt.datetime(2013, 5, 6, 12, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+        RedmineTestCase.tearDown(self)
+
+    def status(self, fact_id):
+        return self.storage.get_time_entry_status(fact_id)["status"]
+
+    def test_sends_once(self):
+        self.storage.queue_time_entry(1, 12, 8, 1.5, "coding", dt.date(2013, 5, 6))
+        self.storage.queue_time_entry(2, 99, 8, 0.5, "no such issue", dt.date(2013, 5, 6))
+        self.assertEquals(self.outbox.flush(self.now), 1)
+        self.assertEquals((self.status(1), self.status(2)), ("sent", "rejected"))
+        self.assertEquals(self.server.time_entries[0]["spent_on"], "2013-05-06")
+
+        self.storage.queue_time_entry(1, 12, 8, 1.5, "coding", dt.date(2013, 5, 6))
+        self.assertEquals(self.outbox.flush(self.now), 0)
+        self.assertEquals(len(self.server.time_entries), 1)
+
+    def test_backs_off(self):
+        self.storage.queue_time_entry(1, 12, 8, 1.5, "coding", dt.date(2013, 5, 6))
+        self.storage.queue_time_entry(2, 13, 8, 0.5, "docs", dt.date(2013, 5, 6))
+        self.server.stop()
+        self.connector.close()
+
+        self.assertEquals(self.outbox.flush(self.now), 0)
+        self.assertEquals(self.outbox.flush(self.now), 0) # nothing due yet
+        attempts = [self.storage.get_time_entry_status(fact_id)["attempts"] for fact_id in (1, 2)]
+        self.assertEquals(attempts, [1, 1])
+
+        self.server = StubRedmine()
+        self.connector = redmine.RedmineConnector(self.server.url, self.server.key)
+        self.assertEquals(self.outbox.flush(self.now + dt.timedelta(seconds = self.outbox.backoff[0])), 2)
+        self.assertEquals((self.status(1), self.status(2)), ("sent", "sent"))
+
+    def test_off(self):
+        self.storage.queue_time_entry(1, 12, 8, 1.5, "coding", dt.date(2013, 5, 6))
+        self.assertEquals(outbox.TimeEntryOutbox(self.storage, lambda: None).flush(self.now), 0)
+        self.assertEquals(self.status(1), "pending")
+
+
+class TestSync(RedmineTestCase):
+    def setUp(self):
+        RedmineTestCase.setUp(self)
+        self.db_dir = tempfile.mkdtemp()
+        self.storage = db.Storage(database_dir = self.db_dir)
+        self.sync = sync.TimeEntrySync(self.storage, lambda: self.connector)
+        self.monday = dt.date(2013, 5, 6)
+        self.sunday = dt.date(2013, 5, 12)
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+        RedmineTestCase.tearDown(self)
+
+    def add(self, activity, day, hour, hours, issue = 12, redmine_activity = 8):
+        start = dt.datetime.combine(day, dt.time(hour))
+        return self.storage.add_fact(activity, start, start + dt.timedelta(hours = hours),
+                                     redmine_issue = issue, redmine_activity = redmine_activity)
+
+    def add_week(self):
+        for day in range(5):
+            for hour in range(9, 17):
+                self.add("coding", self.monday + dt.timedelta(days = day), hour, 0.5)
+
+    def pushes(self):
+        return len(self.server.gets("/time_entries", "POST") + self.server.gets("/time_entries", "PUT"))
+
+    def test_week(self):
+        self.add_week()
+        self.storage.add_fact("reading", dt.datetime(2013, 5, 6, 8), dt.datetime(2013, 5, 6, 9)) # not for redmine
+        self.add("blink", self.monday, 7, 0.01) # too short
+
+        counts = self.sync.sync(self.monday, self.sunday)
+        self.assertEquals((counts["created"], counts["failed"]), (40, 0))
+        self.assertEquals(len(self.server.time_entries), 40)
+        self.assertEquals(self.server.time_entries[0]["hours"], 0.5)
+        # pushed side by side, over connections of their own
+        self.assertTrue(self.server.connections > 1)
+
+        # all in there now
+        self.assertEquals(self.sync.sync(self.monday, self.sunday)["unchanged"], 40)
+        self.assertEquals(self.pushes(), 40)
+
+    def test_pages(self):
+        self.connector.page_size = 15
+        self.add_week()
+        self.sync.sync(self.monday, self.sunday)
+        requests = len(self.server.gets("/time_entries.json"))
+        self.assertEquals(self.sync.sync(self.monday, self.sunday)["unchanged"], 40)
+        self.assertEquals(len(self.server.gets("/time_entries.json")) - requests, 3)
+
+    def test_changed(self):
+        fact_id = self.add("coding", self.monday, 9, 1)
+        self.add("docs", self.monday, 11, 1, issue = 13)
+        self.sync.sync(self.monday, self.sunday)
+
+        # changed in redmine, the fact wins
+        self.server.time_entries[1]["hours"] = 3
+        # edited here, which makes a new fact
+        self.storage.remove_fact(fact_id)
+        self.add("coding", self.monday, 9, 1.5)
+
+        counts = self.sync.sync(self.monday, self.sunday)
+        self.assertEquals((counts["updated"], counts["created"]), (2, 0))
+        self.assertEquals([entry["hours"] for entry in self.server.time_entries], [1.5, 1])
+
+    def test_links(self):
+        # sent before the ids were noted down
+        self.server.add_time_entry({"issue_id": 12, "activity_id": 8, "hours": 1,
+                                    "comments": "coding", "spent_on": "2013-05-06"})
+        self.add("coding", self.monday, 9, 1)
+        self.assertEquals(self.sync.sync(self.monday, self.sunday)["linked"], 1)
+        self.assertEquals(self.sync.sync(self.monday, self.sunday)["unchanged"], 1)
+        self.assertEquals(self.pushes(), 0)
+
+    def test_outbox(self):
+        fact_id = self.add("coding", self.monday, 9, 1)
+        self.storage.queue_time_entry(fact_id, 12, 8, 1.0, "coding", self.monday)
+        # waiting in the outbox, left to it
+        self.assertEquals(sum(self.sync.sync(self.monday, self.sunday).values()), 0)
+
+        outbox.TimeEntryOutbox(self.storage, lambda: self.connector).flush(dt.datetime(2013, 5, 6, 12))
+        self.assertEquals(self.sync.sync(self.monday, self.sunday)["unchanged"], 1)
+        self.assertEquals(len(self.server.time_entries), 1)
+
+    def test_rejected(self):
+        fact_id = self.add("coding", self.monday, 9, 1, issue = 99)
+        self.assertEquals(self.sync.sync(self.monday, self.sunday)["rejected"], 1)
+        self.assertEquals(self.storage.get_time_entry_status(fact_id)["status"], "rejected")
+
+    def test_errors(self):
+        self.add("coding", self.monday, 9, 1)
+        self.server.stop()
+        self.connector.close()
+        self.assertRaises(redmine.RedmineConnectionException, self.sync.sync, self.monday, self.sunday)
+        self.server = StubRedmine() # for tearDown
+
+    def test_off(self):
+        self.add("coding", self.monday, 9, 1)
+        self.assertEquals(sync.TimeEntrySync(self.storage, lambda: None).sync(self.monday, self.sunday), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# - coding: utf-8 -
+import sys, os.path
+# hamster module lives in src
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import unittest
+import datetime as dt
+from hamster.lib import scheduler, trophies
+
+
+class TestDeadlines(unittest.TestCase):
+    def test_next_step(self):
+        start = dt.datetime(2013, 5, 6, 9, 0, 30)
+        minute = dt.timedelta(minutes = 1)
+        self.assertEquals(scheduler.next_step(start, minute, dt.datetime(2013, 5, 6, 9, 5)),
+                          dt.datetime(2013, 5, 6, 9, 5, 30))
+        # right on a step, the next one
+        self.assertEquals(scheduler.next_step(start, minute, dt.datetime(2013, 5, 6, 9, 5, 30)),
+                          dt.datetime(2013, 5, 6, 9, 6, 30))
+        self.assertEquals(scheduler.next_step(start, minute, dt.datetime(2013, 5, 6, 8)), start)
+
+    def test_next_day_start(self):
+        self.assertEquals(scheduler.next_day_start(dt.datetime(2013, 5, 6, 12), 5 * 60),
+                          dt.datetime(2013, 5, 7, 5))
+        # still yesterday before the day start
+        self.assertEquals(scheduler.next_day_start(dt.datetime(2013, 5, 7, 3), 5 * 60),
+                          dt.datetime(2013, 5, 7, 5))
+
+
+class Achievements(object):
+    """takes down what gets unlocked"""
+    def __init__(self):
+        self.unlocked = []
+
+    def unlock_achievement(self, application, achievement_id):
+        self.unlocked.append(achievement_id)
+
+
+class TestTrophies(unittest.TestCase):
+    def setUp(self):
+        self.storage, trophies.storage = trophies.storage, Achievements()
+
+    def tearDown(self):
+        trophies.storage = self.storage
+
+    def test_timer_checks_rows(self):
+        now = dt.datetime.now()
+        start = now - dt.timedelta(minutes = 15)
+        # rows as the service has them
+        facts = [{"start_time": start - dt.timedelta(hours = 2), "end_time": start,
+                  "delta": dt.timedelta(hours = 2)},
+                 {"start_time": start, "end_time": None, "delta": None}]
+
+        when = trophies.next_ongoing(start, 125, start + dt.timedelta(minutes = 5))
+        self.assertEquals(when, start + dt.timedelta(minutes = 10)) # welcome
+
+        timers = scheduler.Scheduler()
+        timers._due["trophies"] = (when, trophies.check_ongoing, (facts,))
+        timers._on_timeout()
+        self.assertTrue("welcome" in trophies.storage.unlocked)
+        self.assertFalse(set(["in_the_zone", "overwhelmed"]) & set(trophies.storage.unlocked))
+        self.assertTrue(facts[-1]["delta"] >= dt.timedelta(minutes = 15))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,8 @@ import sys, os.path
 sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
 
 import unittest
-from hamster.lib import Fact
+import datetime as dt
+from hamster.lib import Fact, RedmineFact
 
 class TestActivityInputParsing(unittest.TestCase):
     def test_plain_name(self):
@@ -78,5 +79,36 @@ class TestActivityInputParsing(unittest.TestCase):
         self.assertEquals(activity.description, "description #ta non-tag")
         self.assertEquals(set(activity.tags), set(["bag", "tag"]))
 
+class TestFactFromRow(unittest.TestCase):
+    def test_fields_as_is(self):
+        # no parsing of the activity name
+        fact = Fact.from_row("12:30 odd@name, really", category = "work",
+                             tags = ["a", "b"], id = 5)
+        self.assertEquals(fact.activity, "12:30 odd@name, really")
+        self.assertEquals(fact.category, "work")
+        self.assertEquals(fact.tags, ["a", "b"])
+        self.assertEquals(fact.id, 5)
+        assert fact.start_time is None
+        assert fact.description is None
+
+    def test_same_as_parsed(self):
+        start_time = dt.datetime(2013, 5, 6, 9, 0)
+        parsed = Fact("coding@hamster, fixing things #bug #ui", start_time = start_time)
+        fact = Fact.from_row("coding", category = "hamster", description = "fixing things",
+                             tags = ["bug", "ui"], start_time = start_time)
+        self.assertEquals(dict(fact), dict(parsed))
+        self.assertEquals(fact.serialized_name(), parsed.serialized_name())
+
+    def test_copy(self):
+        fact = RedmineFact.from_row("coding", 12, 3, category = "hamster", tags = ["bug"],
+                                    start_time = dt.datetime(2013, 5, 6, 9, 0))
+        copy = fact.copy()
+        self.assertEquals(dict(copy), dict(fact))
+
+        copy.delta = dt.timedelta(minutes = 5)
+        copy.tags.append("ui")
+        assert fact.delta is None
+        self.assertEquals(fact.tags, ["bug"])
+
 if __name__ == '__main__':
     unittest.main()
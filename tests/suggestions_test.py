@@ -0,0 +1,54 @@
+# - coding: utf-8 -
+import sys, os.path
+# hamster module lives in src
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import unittest
+from hamster.lib import suggestions
+
+
+def activities(*names):
+    return [{"name": name} for name in names]
+
+
+class TestNarrow(unittest.TestCase):
+    def test_starting_go_first(self):
+        res = suggestions.narrow(activities(u"homework", u"work", u"Workshop", u"walk"), u"wor")
+        self.assertEquals([activity["name"] for activity in res], [u"work", u"Workshop", u"homework"])
+
+
+class TestCandidates(unittest.TestCase):
+    def test_typing_on(self):
+        candidates = suggestions.Candidates(limit = 3)
+        self.assertFalse(candidates.covers(u"w"))
+
+        serial = candidates.request()
+        self.assertTrue(candidates.receive(serial, u"wo", activities(u"work", u"wood")))
+        self.assertTrue(candidates.complete(u"wor"))
+        self.assertFalse(candidates.covers(u"w"))
+
+        candidates.receive(candidates.request(), u"w", activities(u"work", u"wood", u"walk"))
+        self.assertTrue(candidates.covers(u"wo"))
+        self.assertFalse(candidates.complete(u"wo")) # there might be more
+
+    def test_outdated_reply(self):
+        candidates = suggestions.Candidates()
+        candidates.receive(candidates.request(), u"wor", activities(u"work"))
+
+        # backspace asks for "wo", typing the "r" back cancels it
+        serial = candidates.request()
+        self.assertTrue(candidates.complete(u"wor"))
+        candidates.cancel()
+
+        self.assertFalse(candidates.receive(serial, u"wo", activities(u"work", u"wood")))
+        self.assertEquals((candidates.key, candidates.activities), (u"wor", activities(u"work")))
+
+    def test_reset(self):
+        candidates = suggestions.Candidates()
+        candidates.receive(candidates.request(), u"wor", activities(u"work"))
+        candidates.reset()
+        self.assertFalse(candidates.covers(u"work"))
+
+
+if __name__ == '__main__':
+    unittest.main()